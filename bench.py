@@ -0,0 +1,898 @@
+# Copyright 2025 TENGO BY FELICIO DE SOUZA
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ___________________________________________________________________________
+# -*- coding: utf-8 -*-
+"""Benchmarks hors ligne de Tengo Bot (aucun token Telegram ni clé Gemini nécessaires).
+
+    python bench.py matcher --sizes 1000 10000 100000
+    python bench.py scheduler --clients 100 --capacity 12
+    python bench.py media --files 20 --size-mb 20
+    python bench.py render --iterations 2000 --fuzz 20000
+    python bench.py history --chats 100000
+    python bench.py scale --workers 1 2 4
+    python bench.py paths --requests 2000
+    python bench.py embeddings --sizes 1000 10000 100000
+    python bench.py load --catalog-sizes 1000 10000 --json resultats.json
+"""
+import argparse
+import asyncio
+import hashlib
+import html
+import html.parser
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import httpx
+from PIL import Image, ImageDraw
+from telegram import Update
+
+import tengo
+
+SYLLABLES = ["ka", "shi", "no", "to", "ri", "mu", "ya", "ken", "zo", "ra", "sen", "hi", "do", "ma", "yu", "kyo", "jin", "ai", "sa", "tsu"]
+WORDS = ["the", "of", "hero", "academy", "world", "sword", "night", "blade", "sky", "king", "demon", "girl", "online", "chronicle", "legend"]
+GENRES = ["Action", "Aventure", "Comédie", "Drame", "Fantasy", "Isekai", "Romance", "Horreur", "Mecha", "Sport", "Slice of Life", "Shōnen"]
+
+def random_title(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(1, 4)):
+        if rng.random() < 0.6:
+            parts.append(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize())
+        else:
+            parts.append(rng.choice(WORDS).capitalize())
+    return ' '.join(parts)
+
+def generate_catalog(size: int, seed: int = 0) -> tuple[str, list[str]]:
+    """Catalogue Markdown synthétique au format de l'export (titre en gras, alias, genre, saisons)."""
+    rng = random.Random(seed)
+    titles, seen, blocks = [], set(), []
+    while len(titles) < size:
+        title = random_title(rng)
+        if title.lower() in seen: continue
+        seen.add(title.lower())
+        titles.append(title)
+        alias = random_title(rng)
+        genres = ", ".join(rng.sample(GENRES, 2))
+        seasons = "\n".join(f"* _Saison {n}_ _{rng.choice(['VF', 'VOSTFR'])}_ [Lien](https://t.me/c/{len(titles)}/{n})"
+                            for n in range(1, rng.randint(2, 4)))
+        blocks.append(f"**{title}** (Alias: {alias})\nGenre : {genres}\n{seasons}")
+    return "\n\n".join(blocks), titles
+
+def make_typo(rng: random.Random, text: str) -> str:
+    chars = list(text)
+    for _ in range(1 + len(text) // 12):
+        i = rng.randrange(len(chars))
+        op = rng.random()
+        if op < 0.4: chars[i] = rng.choice("abcdefghijklmnopqrstuvwxyz")
+        elif op < 0.7 and len(chars) > 1: del chars[i]
+        else: chars.insert(i, rng.choice("abcdefghijklmnopqrstuvwxyz"))
+    return ''.join(chars)
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def bench_matcher(sizes: list[int], queries: int, seed: int):
+    rng = random.Random(seed)
+    print(f"{'entrées':>8} {'build s':>8} {'requête':>10} {'p50 µs':>9} {'p99 µs':>9} {'clairs':>7} {'justes':>7}")
+    for size in sizes:
+        md_text, titles = generate_catalog(size, seed)
+        started = time.perf_counter()
+        index = tengo.CatalogIndex.from_markdown(md_text)
+        build_seconds = time.perf_counter() - started
+        samples = rng.sample(titles, min(queries, len(titles)))
+        kinds = {
+            "exact": [(t.lower(), t) for t in samples],
+            "faute": [(make_typo(rng, t), t) for t in samples],
+            "phrase": [(f"est-ce que vous avez {t} en vf ?", t) for t in samples],
+            "absent": [(random_title(rng) + " zzz", None) for _ in samples],
+        }
+        for kind, pairs in kinds.items():
+            timings, clear, correct = [], 0, 0
+            for query, expected in pairs:
+                t0 = time.perf_counter()
+                result = index.matcher.match(query)
+                timings.append((time.perf_counter() - t0) * 1e6)
+                if result and result.is_clear:
+                    clear += 1
+                    correct += result.entry.title == expected
+            print(f"{size:>8} {build_seconds:>8.2f} {kind:>10} {percentile(timings, 50):>9.1f} {percentile(timings, 99):>9.1f} "
+                  f"{clear / len(pairs):>7.0%} {correct / max(clear, 1):>7.0%}")
+
+class SimulatedBackend:
+    """Backend Gemini simulé : au-delà de `capacity` appels simultanés, il répond 429 ; sa latence
+    augmente avec la charge."""
+
+    def __init__(self, capacity: int, base_latency: float, rng: random.Random):
+        self.capacity = capacity
+        self.base_latency = base_latency
+        self.rng = rng
+        self.in_flight = 0
+        self.rejected = 0
+
+    async def call(self):
+        self.in_flight += 1
+        try:
+            if self.in_flight > self.capacity:
+                await asyncio.sleep(self.base_latency / 10)
+                self.rejected += 1
+                raise RuntimeError("429 Resource has been exhausted (e.g. check quota).")
+            load = self.in_flight / self.capacity
+            await asyncio.sleep(self.base_latency * (1 + load) * self.rng.uniform(0.8, 1.2))
+        finally:
+            self.in_flight -= 1
+
+async def run_scheduler_simulation(clients: int, requests: int, capacity: int, base_latency: float, seed: int, adaptive: bool = True):
+    rng = random.Random(seed)
+    backend = SimulatedBackend(capacity, base_latency, rng)
+    if adaptive:
+        scheduler = tengo.GeminiScheduler(initial_limit=2, max_limit=64, max_queue=clients, max_wait=base_latency * 20,
+                                          target_latency=base_latency * 4)
+    else:
+        # Référence : pas de contrôle d'admission, comme avec le seul concurrent_updates().
+        scheduler = tengo.GeminiScheduler(initial_limit=clients, max_limit=clients, min_limit=clients, max_queue=clients,
+                                          max_wait=float("inf"), target_latency=float("inf"))
+    outcomes = {"ok": 0, "busy": 0, "429": 0}
+    busy_by_kind = {kind: 0 for kind in tengo.GeminiScheduler.KINDS}
+    latencies = []
+    limits = []
+
+    async def client(user_id: int):
+        for _ in range(requests):
+            kind = rng.choices(("text", "image", "voice"), weights=(8, 1, 1))[0]
+            started = time.perf_counter()
+            try:
+                async with scheduler.slot(kind, user_id):
+                    await backend.call()
+                outcomes["ok"] += 1
+                latencies.append(time.perf_counter() - started)
+            except tengo.GeminiBusyError:
+                outcomes["busy"] += 1
+                busy_by_kind[kind] += 1
+            except RuntimeError:
+                outcomes["429"] += 1
+            await asyncio.sleep(rng.uniform(0, base_latency))
+
+    async def sample_limit():
+        while True:
+            limits.append(scheduler.limit)
+            await asyncio.sleep(base_latency)
+
+    sampler = asyncio.create_task(sample_limit())
+    started = time.perf_counter()
+    await asyncio.gather(*(client(user_id) for user_id in range(clients)))
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+    return outcomes, busy_by_kind, latencies, limits, elapsed, scheduler.stats
+
+def bench_scheduler(clients: int, requests: int, capacity: int, base_latency: float, seed: int, adaptive: bool):
+    outcomes, busy_by_kind, latencies, limits, elapsed, stats = asyncio.run(
+        run_scheduler_simulation(clients, requests, capacity, base_latency, seed, adaptive))
+    total = sum(outcomes.values())
+    print(f"{clients} clients x {requests} requêtes, capacité simulée {capacity}, latence de base {base_latency * 1000:.0f} ms")
+    print(f"débit: {outcomes['ok'] / elapsed:.1f} req/s | ok {outcomes['ok']}/{total} | occupé {outcomes['busy']} | 429 {outcomes['429']}")
+    print("occupé par type: " + ", ".join(f"{kind} {count}" for kind, count in busy_by_kind.items()))
+    if latencies:
+        print(f"latence p50 {percentile(latencies, 50) * 1000:.0f} ms | p95 {percentile(latencies, 95) * 1000:.0f} ms | p99 {percentile(latencies, 99) * 1000:.0f} ms")
+    print(f"limite de concurrence: début {limits[0]:.1f}, max {max(limits):.1f}, fin {limits[-1]:.1f}, moyenne {statistics.mean(limits):.1f}")
+    print(f"scheduler: {stats}")
+
+def media_transport(size: int, chunk_size: int = 64 * 1024) -> httpx.MockTransport:
+    """Faux serveur de fichiers Telegram : renvoie `size` octets en flux, par morceaux."""
+    async def body():
+        for offset in range(0, size, chunk_size):
+            yield bytes(min(chunk_size, size - offset))
+    return httpx.MockTransport(lambda request: httpx.Response(200, content=body()))
+
+async def run_media_flood(files: int, size: int, hold: float, baseline: bool):
+    transport = media_transport(size)
+    downloader = tengo.MediaDownloader(transport=transport)
+    client = httpx.AsyncClient(transport=transport)
+    telegram_file = types.SimpleNamespace(file_path="https://api.telegram.org/file/botTOKEN/voice/file.oga", file_size=size)
+
+    async def handler():
+        if baseline:  # chemin d'origine : download_as_bytearray() puis bytes(...)
+            buf = bytearray()
+            buf.extend((await client.get(telegram_file.file_path)).content)
+            data = bytes(buf)
+            await asyncio.sleep(hold)  # appel Gemini simulé
+            return len(data)
+        async with downloader.fetch(telegram_file, size) as (data, _):
+            await asyncio.sleep(hold)
+            return len(data)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(handler() for _ in range(files)))
+    elapsed = time.perf_counter() - started
+    await client.aclose()
+    await downloader.close()
+    return results, elapsed, downloader.stats
+
+def bench_media(files: int, size_mb: float, hold: float, baseline: bool):
+    size = int(size_mb * 1024 * 1024)
+    tracemalloc.start()
+    results, elapsed, stats = asyncio.run(run_media_flood(files, size, hold, baseline))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    path = "chemin d'origine" if baseline else "MediaDownloader"
+    print(f"{files} téléchargements simultanés de {size_mb:.0f} Mo ({path}), {sum(results) / 1e6:.0f} Mo reçus en {elapsed:.2f}s")
+    print(f"pic d'allocations Python: {peak / 1024 / 1024:.0f} Mo | RSS max du processus: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} Mo")
+    if not baseline: print(f"téléchargeur: {stats}")
+
+# Rendu Markdown -> HTML d'origine (une dizaine de re.sub successifs), conservé pour comparaison.
+def legacy_markdown_to_telegram_html(md_text: str) -> str:
+    if not md_text: return ""
+    text = html.escape(md_text)
+    def code_block_replacer(match):
+        inner_content = html.unescape(match.group(1).strip())
+        safe_inner_content = html.escape(inner_content)
+        return f'<pre>{safe_inner_content}</pre>'
+    text = re.sub(r'```(?:[^\n]*\n)?(.*?)```', code_block_replacer, text, flags=re.DOTALL | re.MULTILINE)
+    text = re.sub(r'`(.*?)`', r'<code>\1</code>', text)
+    def link_replacer(match):
+        link_text_escaped = match.group(1)
+        url_escaped = match.group(2)
+        url_decoded = html.unescape(url_escaped)
+        if not url_decoded or not url_decoded.strip().startswith(('http', 'tg')):
+            tengo.logger.warning(f"URL invalide ignorée: '{url_decoded}' pour '{html.unescape(link_text_escaped)}'")
+            return link_text_escaped
+        safe_url = html.escape(url_decoded, quote=True)
+        return f'<a href="{safe_url}">{link_text_escaped}</a>'
+    text = re.sub(r'\[([^\]]+)\]\(\s*([^\s\)]+)\s*\)', link_replacer, text)
+    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
+    text = re.sub(r'(?<!\w)_(.*?)_(?!\w)', r'<i>\1</i>', text)
+    text = re.sub(r'^(\s*[*+-]\s+)', '• ', text, flags=re.MULTILINE)
+    text = re.sub(r'^(\s*\d+\.\s+)', '• ', text, flags=re.MULTILINE)
+    text = re.sub(r'\n\s*\n', '\n\n', text)
+    return text.strip()
+
+TELEGRAM_HTML_TAGS = {"b", "i", "code", "pre", "a"}
+
+class TelegramHTMLValidator(html.parser.HTMLParser):
+    """Vérifie qu'un texte respecte le sous-ensemble HTML de Telegram : balises autorisées, bien
+    imbriquées et fermées, `href` seul attribut (sur <a>), pas de `&` ni `<` nus."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.stack: list[str] = []
+        self.errors: list[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in TELEGRAM_HTML_TAGS: self.errors.append(f"balise non supportée <{tag}>")
+        if [name for name, _ in attrs] != (["href"] if tag == "a" else []): self.errors.append(f"attributs invalides sur <{tag}>: {attrs}")
+        if self.stack and self.stack[-1] in ("code", "pre"): self.errors.append(f"<{tag}> dans <{self.stack[-1]}>")
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack[-1] != tag: self.errors.append(f"</{tag}> inattendu (pile: {self.stack})")
+        else: self.stack.pop()
+
+    def handle_data(self, data):
+        if "<" in data or ">" in data: self.errors.append(f"chevron nu: {data[:30]!r}")
+
+    def unknown_decl(self, data):
+        self.errors.append(f"déclaration inattendue: {data[:30]!r}")
+
+    @classmethod
+    def check(cls, text: str) -> list[str]:
+        validator = cls()
+        if re.search(r"&(?!(?:lt|gt|amp|quot|#\d+|#x[0-9a-fA-F]+);)", text): validator.errors.append("& nu")
+        validator.feed(text)
+        validator.close()
+        if validator.stack: validator.errors.append(f"balises non fermées: {validator.stack}")
+        return validator.errors
+
+FUZZ_TOKENS = ["**", "*", "_", "`", "```", "[", "]", "(", ")", "](", "https://t.me/c/1/2", "tg://x", "ftp://x",
+               " ", " ", "\n", "\n\n", "* ", "1. ", "Naruto", "VF", "a_b", "<", ">", "&", "&amp;", "\"", "'", "é"]
+
+def sample_answer(rng: random.Random, lines: int = 25) -> str:
+    """Réponse Gemini typique : liste d'animes en gras avec statuts en italique et liens."""
+    out = ["Voici ce que j'ai trouvé dans le catalogue :", ""]
+    for n in range(lines):
+        out.append(f"* **{random_title(rng)}** _{rng.choice(['VF', 'VOSTFR'])}_ _Saison {rng.randint(1, 5)}_ "
+                   f"[Lien](https://t.me/c/{rng.randint(1000, 9999)}/{n}) — genre `{rng.choice(GENRES)}` & co")
+    return "\n".join(out)
+
+def bench_render(iterations: int, fuzz: int, seed: int):
+    rng = random.Random(seed)
+    tengo.logger.setLevel("ERROR")  # les liens invalides générés par le fuzz sont journalisés
+    answers = [sample_answer(rng) for _ in range(20)]
+    for name, render in (("ancien rendu", legacy_markdown_to_telegram_html), ("rendu une passe", tengo.markdown_to_telegram_html)):
+        started = time.perf_counter()
+        for i in range(iterations): render(answers[i % len(answers)])
+        elapsed = time.perf_counter() - started
+        print(f"{name}: {iterations / elapsed:.0f} réponses/s ({elapsed / iterations * 1e6:.0f} µs/réponse de {len(answers[0])} caractères)")
+    invalid = {"ancien rendu": 0, "rendu une passe": 0, "découpage": 0}
+    example = None
+    for _ in range(fuzz):
+        text = "".join(rng.choice(FUZZ_TOKENS) for _ in range(rng.randint(1, 400)))
+        if TelegramHTMLValidator.check(legacy_markdown_to_telegram_html(text)): invalid["ancien rendu"] += 1
+        rendered = tengo.markdown_to_telegram_html(text)
+        errors = TelegramHTMLValidator.check(rendered)
+        if errors:
+            invalid["rendu une passe"] += 1
+            example = example or (text, errors)
+        limit = rng.randint(200, 1000)
+        chunks = tengo.split_telegram_html(rendered, limit)
+        visible = lambda fragment: re.sub(r"\s+", "", html.unescape(re.sub(r"<[^>]*>", "", fragment)))
+        errors = [error for chunk in chunks for error in TelegramHTMLValidator.check(chunk)]
+        errors += [f"message de {len(chunk)} > {limit}" for chunk in chunks if len(chunk) > limit]
+        if visible(rendered) != "".join(map(visible, chunks)): errors.append("texte perdu ou dupliqué au découpage")
+        if errors:
+            invalid["découpage"] += 1
+            example = example or (text, errors)
+    print(f"fuzz: {fuzz} textes aléatoires, HTML invalide (donc renvoi en texte brut) : {invalid}")
+    if example: print(f"exemple invalide: {example[0]!r} -> {example[1]}")
+
+async def fill_history_store(store, chats: int, turns: int, user_chars: int, model_chars: int, seed: int):
+    rng = random.Random(seed)
+    for chat_id in range(chats):
+        for turn in range(turns):
+            # Textes distincts par chat, comme en production (pas de partage de chaînes).
+            if turn % 2 == 0: await store.append(chat_id, "user", f"{chat_id}:{turn} " + "q" * rng.randint(user_chars // 2, user_chars * 3 // 2))
+            else: await store.append(chat_id, "model", f"{chat_id}:{turn} " + "r" * rng.randint(model_chars // 2, model_chars * 3 // 2))
+
+def bench_history(chats: int, turns: int, user_chars: int, model_chars: int, seed: int):
+    for label, user_size, model_size in (("structure seule (textes vides)", 0, 0), ("textes typiques", user_chars, model_chars)):
+        store = tengo.HistoryStore(backend=None, max_chats=chats + 1)
+        tracemalloc.start()
+        started = time.perf_counter()
+        asyncio.run(fill_history_store(store, chats, turns, user_size, model_size, seed))
+        elapsed = time.perf_counter() - started
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{chats} chats x {turns} tours, {label}: {current / 1024 / 1024:.0f} Mo en mémoire "
+              f"({current / chats:.0f} octets/chat, {current / chats * 100_000 / 1024 / 1024:.0f} Mo pour 100k chats), rempli en {elapsed:.1f}s")
+
+def scale_worker(db_path: str, partition: int, partitions: int, expected: int, catalog_size: int,
+                 latency: float, seed: int, barrier, results):
+    """Worker simulé : vrai décodage des mises à jour, matcher et rendu HTML, appel Gemini remplacé par une attente."""
+    md_text, _ = generate_catalog(catalog_size, seed)
+    index = tengo.CatalogIndex.from_markdown(md_text)
+    answer = sample_answer(random.Random(seed + partition))
+    update_queue = tengo.SQLiteUpdateQueue(db_path, partitions)
+    last_update_ids: dict[int, int] = {}
+    out_of_order = 0
+
+    async def run():
+        stop = asyncio.Event()
+        done = 0
+
+        async def handle(text: str):
+            nonlocal done
+            index.matcher.match(text)
+            await asyncio.sleep(latency)
+            tengo.split_telegram_html(tengo.markdown_to_telegram_html(answer))
+            done += 1
+            if done == expected: stop.set()
+
+        async def dispatch(payload: dict):
+            nonlocal out_of_order
+            update = Update.de_json(payload, None)
+            chat_id = update.effective_chat.id
+            out_of_order += update.update_id < last_update_ids.get(chat_id, -1)
+            last_update_ids[chat_id] = update.update_id
+            await handle(update.message.text)
+
+        if expected: await tengo.consume_updates(update_queue, partition, dispatch, stop)
+
+    barrier.wait()
+    asyncio.run(run())
+    update_queue.close()
+    results.put((partition, out_of_order))
+
+def bench_scale(worker_counts: list[int], updates: int, chats: int, catalog_size: int, latency: float, seed: int):
+    rng = random.Random(seed)
+    _, titles = generate_catalog(catalog_size, seed)
+    payloads = []
+    for update_id in range(updates):
+        chat_id = rng.randint(1, chats)
+        title = rng.choice(titles)
+        payloads.append({"update_id": update_id, "message": {
+            "message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+            "text": rng.choice([title, make_typo(rng, title), f"vous avez {title} en vf ?"])}})
+    context = multiprocessing.get_context("spawn")
+    print(f"{updates} mises à jour, {chats} chats, catalogue de {catalog_size} entrées, Gemini simulé à {latency * 1000:.0f} ms, "
+          f"{os.cpu_count()} cœurs disponibles")
+    if max(worker_counts) > (os.cpu_count() or 1):
+        print("attention : plus de workers que de cœurs, l'accélération mesurée ne dit rien du passage à l'échelle")
+    print(f"{'workers':>8} {'maj/s':>9} {'accél.':>8} {'effic.':>8} {'hors ordre':>11}")
+    reference = None
+    for count in worker_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "updates.sqlite3")
+            update_queue = tengo.SQLiteUpdateQueue(db_path, count)
+            update_queue.put_many(payloads)
+            update_queue.close()
+            expected = [0] * count
+            for payload in payloads: expected[update_queue.chat_id_of(payload) % count] += 1
+            barrier, results = context.Barrier(count + 1), context.Queue()
+            processes = [context.Process(target=scale_worker, args=(db_path, i, count, expected[i], catalog_size, latency, seed, barrier, results))
+                         for i in range(count)]
+            for process in processes: process.start()
+            barrier.wait()
+            started = time.perf_counter()
+            out_of_order = sum(results.get()[1] for _ in processes)
+            elapsed = time.perf_counter() - started
+            for process in processes: process.join()
+        throughput = updates / elapsed
+        reference = reference or throughput
+        print(f"{count:>8} {throughput:>9.0f} {throughput / reference:>7.2f}x {throughput / reference / count:>8.0%} {out_of_order:>11}")
+
+def update_payload(update_id: int, chat_id: int, text: str) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"}, "text": text}}
+
+class FakeTelegramBot:
+    """Bot Telegram factice : compte les envois et éditions, renvoie des messages numérotés."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent = 0
+        self.edited = 0
+        self._next_message_id = 1_000_000
+        self.files: dict[str, bytes] = {}
+
+    def transport(self) -> httpx.MockTransport:
+        """Faux serveur de fichiers servant les contenus enregistrés dans `files`."""
+        return httpx.MockTransport(lambda request: httpx.Response(200, content=self.files[request.url.path.rsplit("/", 1)[-1]]))
+
+    async def get_file(self, file_id: str, **kwargs):
+        return types.SimpleNamespace(file_id=file_id, file_size=len(self.files[file_id]),
+                                     file_path=f"https://api.telegram.org/file/botFAKE/{file_id}")
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.latency: await asyncio.sleep(self.latency)
+        self.sent += 1
+        self._next_message_id += 1
+        return types.SimpleNamespace(message_id=self._next_message_id, chat_id=chat_id, text=text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        if self.latency: await asyncio.sleep(self.latency)
+        self.edited += 1
+        return True
+
+class FakeGeminiResponse:
+    """Réponse au format du SDK : candidats, usage, et itération asynchrone pour le streaming."""
+
+    def __init__(self, text: str, latency: float, finish_reason: int = 1, prompt_tokens: int = 0, chunks: int = 4):
+        self._text = text
+        self.latency = latency
+        self.chunks = chunks
+        part = types.SimpleNamespace(text=text)
+        self.candidates = [types.SimpleNamespace(content=types.SimpleNamespace(parts=[part] if text else []),
+                                                 finish_reason=finish_reason, safety_ratings=None)]
+        self.prompt_feedback = None
+        self.usage_metadata = types.SimpleNamespace(prompt_token_count=prompt_tokens, cached_content_token_count=0)
+
+    @property
+    def text(self) -> str:
+        if not self._text: raise ValueError("Réponse sans texte (finish_reason).")
+        return self._text
+
+    async def __aiter__(self):
+        if not self._text:
+            await asyncio.sleep(self.latency)
+            return
+        size = -(-len(self._text) // self.chunks)
+        for start in range(0, len(self._text), size):
+            await asyncio.sleep(self.latency / self.chunks)
+            yield types.SimpleNamespace(text=self._text[start:start + size])
+
+FINISH_REASONS = {"STOP": 1, "MAX_TOKENS": 2, "SAFETY": 3, "RECITATION": 4, "OTHER": 5}
+
+class FakeGeminiModel:
+    """Remplace `tengo.gemini_model` : latence réglable, erreurs et finish_reason tirés au sort,
+    réponses au format attendu par chaque appelant (texte, identification d'image, transcription,
+    chemin rapide vocal). Compte les appels et les octets envoyés."""
+    model_name = "fake-gemini"
+
+    def __init__(self, latency: float, rng: random.Random, titles: list[str] = (), error_rate: float = 0.0,
+                 finish_reasons: dict[str, float] | None = None):
+        self.latency = latency
+        self.rng = rng
+        self.titles = list(titles) or ["Inconnu"]
+        self.error_rate = error_rate
+        self.finish_reasons = finish_reasons or {"STOP": 1.0}
+        self.calls = 0
+        self.errors = 0
+        self.prompt_bytes = 0
+        self.media_bytes = 0
+
+    def _title_for(self, data: bytes) -> str:
+        return self.titles[int.from_bytes(hashlib.sha256(data).digest()[:4], "big") % len(self.titles)]
+
+    async def generate_content_async(self, contents, stream: bool = False, request_options=None):
+        prompt, media = (contents, None) if isinstance(contents, str) else (contents[0], contents[1])
+        self.calls += 1
+        self.prompt_bytes += len(prompt.encode("utf-8"))
+        if media: self.media_bytes += len(media["data"])
+        latency = self.latency * self.rng.uniform(0.8, 1.2)
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            await asyncio.sleep(latency / 4)
+            raise RuntimeError("503 The service is currently unavailable.")
+        finish_reason = FINISH_REASONS[self.rng.choices(list(self.finish_reasons), weights=list(self.finish_reasons.values()))[0]]
+        if media and prompt.startswith("Analyse cette image"):
+            text = self._title_for(media["data"])
+        elif media and "TRANSCRIPTION" in prompt:
+            text = f"TRANSCRIPTION: {self._title_for(media['data'])}\n{sample_answer(self.rng, lines=self.rng.randint(1, 8))}"
+        elif media:
+            text = self._title_for(media["data"])
+        else:
+            text = sample_answer(self.rng, lines=self.rng.randint(1, 8))
+        if finish_reason in (FINISH_REASONS["SAFETY"], FINISH_REASONS["RECITATION"]): text = ""
+        response = FakeGeminiResponse(text, latency, finish_reason=finish_reason, prompt_tokens=len(prompt) // 4)
+        if not stream: await asyncio.sleep(latency)
+        return response
+
+def answer_path() -> str:
+    """Chemin suivi par la dernière requête, d'après les étapes de sa trace."""
+    stages = [stage for stage, _ in tengo.trace_stages_var.get() or []]
+    if "fast_path" in stages: return "fast"
+    if any(stage.startswith("gemini:") for stage in stages): return "gemini"
+    return "cache"
+
+def install_fakes(catalog_path: str, model: FakeGeminiModel, bot: FakeTelegramBot | None = None):
+    """Branche tengo sur un catalogue local, un Gemini et un serveur de fichiers factices, sans
+    persistance, ffmpeg ni tâches de fond."""
+    tengo.logger.setLevel("ERROR")
+    tengo.catalog_cache = tengo.CatalogCache(catalog_path, ttl=0)
+    tengo.history_store = tengo.HistoryStore(backend=None)
+    tengo.response_cache = tengo.ResponseCache(db_path=None)
+    tengo.image_cache = tengo.ImageHashCache(db_path=None)
+    tengo.voice_cache = tengo.TranscriptionCache(db_path=None)
+    tengo.gemini_scheduler = tengo.GeminiScheduler()
+    tengo.telegram_sender = tengo.TelegramSendQueue()
+    tengo.embedding_provider = tengo.HashingEmbeddingProvider()  # hors ligne : pas d'API d'embeddings
+    if bot: tengo.media_downloader = tengo.MediaDownloader(transport=bot.transport())
+    tengo.gemini_context_cache.enabled = False
+    tengo.HISTORY_SUMMARY = False
+    tengo.FFMPEG_PATH = None
+    tengo.gemini_model = model
+
+async def run_path_mix(catalog_path: str, titles: list[str], requests: int, concurrency: int, latency: float, seed: int, fast_path: bool):
+    rng = random.Random(seed)
+    tengo.FAST_PATH_ENABLED = fast_path
+    model = FakeGeminiModel(latency, rng)
+    bot = FakeTelegramBot()
+    install_fakes(catalog_path, model, bot)
+    await tengo.catalog_cache.get()
+    await tengo.catalog_cache.wait_for_embeddings()  # plongements calculés avant la mesure, pas pendant
+    context = types.SimpleNamespace(bot=bot)
+    queries = []
+    for _ in range(requests):
+        title = rng.choice(titles)
+        kind = rng.choices(("titre", "faute", "phrase", "question", "reco"), weights=(35, 15, 15, 20, 15))[0]
+        queries.append({"titre": title, "faute": make_typo(rng, title), "phrase": f"vous avez {title} en vf ?",
+                        "question": f"{title} c'est combien d'épisodes ?", "reco": f"des animes similaires à {title}"}[kind])
+    latencies: dict[str, list[float]] = {}
+    pending = iter(enumerate(queries))
+
+    async def client():
+        for update_id, query in pending:
+            update = Update.de_json(update_payload(update_id, rng.randint(1, 500), query), bot)
+            tengo.start_trace(f"u{update_id}")
+            started = time.perf_counter()
+            await tengo.process_query_and_respond(query, update, context)
+            latencies.setdefault(answer_path(), []).append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    await tengo.telegram_sender.drain()  # réponses encore en file d'envoi
+    return latencies, time.perf_counter() - started, model
+
+def bench_embeddings(sizes: list[int], queries: int, changed: float, seed: int):
+    """Construction des plongements (à froid, inchangés, incrémentale) et ciblage des recommandations
+    avec et sans eux, avec le fournisseur local déterministe."""
+    rng = random.Random(seed)
+    provider = tengo.HashingEmbeddingProvider()
+    print(f"{'entrées':>8} {'froid s':>8} {'repris s':>9} {'incr. s':>8} {'matrice Mo':>11} "
+          f"{'ciblage':>9} {'p50 ms':>8} {'p99 ms':>8} {'contexte Ko':>12} {'complet':>8}")
+    for size in sizes:
+        md_text, titles = generate_catalog(size, seed)
+        index = tengo.CatalogIndex.from_markdown(md_text)
+        with tempfile.TemporaryDirectory() as tmp:
+            prefix = os.path.join(tmp, "catalogue.md.embeddings")
+            timings = []
+            for _ in range(2):
+                started = time.perf_counter()
+                embeddings = tengo.CatalogEmbeddings.build(index, provider, prefix)
+                timings.append(time.perf_counter() - started)
+            blocks = md_text.split("\n\n")
+            for position in rng.sample(range(len(blocks)), max(1, int(len(blocks) * changed))):
+                blocks[position] = blocks[position].replace("Genre : ", "Genre : Mecha, ", 1)
+            changed_index = tengo.CatalogIndex.from_markdown("\n\n".join(blocks))
+            started = time.perf_counter()
+            tengo.CatalogEmbeddings.build(changed_index, provider, prefix)
+            timings.append(time.perf_counter() - started)
+            embeddings = tengo.CatalogEmbeddings.build(index, provider, prefix)
+            requests = [rng.choice((f"des animes similaires à {rng.choice(titles)}",
+                                    f"recommande moi un anime de {rng.choice(GENRES).lower()}",
+                                    "conseille moi un anime triste avec de la musique")) for _ in range(queries)]
+            for label, used in (("genres", None), ("plongem.", embeddings)):
+                latencies, sizes_chars, full = [], [], 0
+                for query in requests:
+                    started = time.perf_counter()
+                    context = asyncio.run(tengo.retrieve_catalog_context(query, [{"parts": [query]}], index, used))
+                    latencies.append(time.perf_counter() - started)
+                    if context: sizes_chars.append(len(context))
+                    else: full += 1
+                head = (f"{size:>8} {timings[0]:>8.2f} {timings[1]:>9.3f} {timings[2]:>8.2f} {embeddings.matrix.nbytes / 2**20:>11.1f}"
+                        if used is None else f"{'':>8} {'':>8} {'':>9} {'':>8} {'':>11}")
+                print(f"{head} {label:>9} {percentile(latencies, 50) * 1000:>8.2f} {percentile(latencies, 99) * 1000:>8.2f} "
+                      f"{statistics.mean(sizes_chars) / 1024 if sizes_chars else 0:>12.1f} {full / len(requests):>8.0%}")
+            del embeddings
+
+def bench_paths(catalog_size: int, requests: int, concurrency: int, latency: float, seed: int, fast_path: bool):
+    md_text, titles = generate_catalog(catalog_size, seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        catalog_path = os.path.join(tmp, "catalogue.md")
+        with open(catalog_path, "w", encoding="utf-8") as f: f.write(md_text)
+        latencies, elapsed, model = asyncio.run(run_path_mix(catalog_path, titles, requests, concurrency, latency, seed, fast_path))
+    print(f"{requests} requêtes, catalogue de {catalog_size} entrées, Gemini simulé à {latency * 1000:.0f} ms, "
+          f"chemin rapide {'actif' if fast_path else 'désactivé'} : {requests / elapsed:.0f} req/s, {model.calls} appels Gemini")
+    print(f"{'chemin':>8} {'requêtes':>9} {'part':>6} {'p50 ms':>9} {'p99 ms':>9}")
+    for path, values in sorted(latencies.items()):
+        values = [value * 1000 for value in values]
+        print(f"{path:>8} {len(values):>9} {len(values) / requests:>6.0%} {percentile(values, 50):>9.2f} {percentile(values, 99):>9.2f}")
+
+def synthetic_photo(rng: random.Random, width: int = 640, height: int = 480) -> bytes:
+    """JPEG aléatoire mais réaliste pour le dHash : fond dégradé et quelques formes."""
+    image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(3, 8)):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.ellipse((x, y, x + rng.randint(40, 200), y + rng.randint(40, 200)),
+                     fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+def photo_payload(update_id: int, chat_id: int, file_id: str, file_unique_id: str, size: int) -> dict:
+    payload = update_payload(update_id, chat_id, "")
+    del payload["message"]["text"]
+    payload["message"]["photo"] = [
+        {"file_id": f"{file_id}-s", "file_unique_id": f"{file_unique_id}-s", "width": 90, "height": 67, "file_size": size // 20},
+        {"file_id": file_id, "file_unique_id": file_unique_id, "width": 640, "height": 480, "file_size": size}]
+    return payload
+
+def voice_payload(update_id: int, chat_id: int, file_id: str, file_unique_id: str, size: int, duration: int) -> dict:
+    payload = update_payload(update_id, chat_id, "")
+    del payload["message"]["text"]
+    payload["message"]["voice"] = {"file_id": file_id, "file_unique_id": file_unique_id, "duration": duration,
+                                   "mime_type": "audio/ogg", "file_size": size}
+    return payload
+
+def build_workload(rng: random.Random, bot: FakeTelegramBot, titles: list[str], requests: int, mix: dict[str, float]) -> list[tuple[str, dict]]:
+    """Requêtes `(type, mise à jour)` tirées une fois pour toutes à partir de la graine : la même
+    charge est rejouée d'un commit à l'autre. Une partie des photos et vocaux sont des renvois."""
+    photos = [synthetic_photo(rng) for _ in range(20)]
+    workload = []
+    for update_id in range(requests):
+        kind = rng.choices(list(mix), weights=list(mix.values()))[0]
+        chat_id = rng.randint(1, 500)
+        if kind == "photo":
+            file_id = f"photo{update_id}"
+            bot.files[file_id] = rng.choice(photos)
+            payload = photo_payload(update_id, chat_id, file_id, f"uphoto{rng.randrange(40)}", len(bot.files[file_id]))
+        elif kind == "voice":
+            file_id = f"voice{update_id}"
+            duration = rng.choice((3, 5, 8, 15, 30))
+            bot.files[file_id] = rng.randbytes(duration * 2000)
+            payload = voice_payload(update_id, chat_id, file_id, f"uvoice{update_id}", len(bot.files[file_id]), duration)
+        else:
+            title = rng.choice(titles)
+            query = rng.choice((title, make_typo(rng, title), f"{title} c'est combien d'épisodes ?", f"des animes similaires à {title}"))
+            payload = update_payload(update_id, chat_id, query)
+        workload.append((kind, payload))
+    return workload
+
+async def run_load(catalog_path: str, titles: list[str], requests: int, concurrency: int, latency: float,
+                   error_rate: float, finish_reasons: dict[str, float], mix: dict[str, float], seed: int):
+    rng = random.Random(seed)
+    bot = FakeTelegramBot()
+    model = FakeGeminiModel(latency, random.Random(seed + 1), titles, error_rate, finish_reasons)
+    install_fakes(catalog_path, model, bot)
+    tengo.logger.setLevel("CRITICAL")  # les erreurs Gemini injectées sont attendues
+    await tengo.catalog_cache.get()
+    await tengo.catalog_cache.wait_for_embeddings()
+    context = types.SimpleNamespace(bot=bot)
+    workload = iter(build_workload(rng, bot, titles, requests, mix))
+    latencies: dict[str, list[float]] = {kind: [] for kind in mix}
+
+    async def client():
+        for kind, payload in workload:
+            update = Update.de_json(payload, bot)
+            tengo.start_trace(f"u{update.update_id}")
+            started = time.perf_counter()
+            if kind == "photo": await tengo.handle_photo(update, context)
+            elif kind == "voice": await tengo.handle_voice(update, context)
+            else: await tengo.process_query_and_respond(update.message.text, update, context)
+            latencies[kind].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    await tengo.telegram_sender.drain()  # réponses encore en file d'envoi
+    elapsed = time.perf_counter() - started
+    await tengo.media_downloader.close()
+    return latencies, elapsed, model, bot
+
+def load_scenario(catalog_size: int, requests: int, concurrency: int, latency: float, error_rate: float,
+                  finish_reasons: dict[str, float], mix: dict[str, float], seed: int, results):
+    """Un scénario par processus : pic de RSS propre à chaque taille de catalogue."""
+    md_text, titles = generate_catalog(catalog_size, seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        catalog_path = os.path.join(tmp, "catalogue.md")
+        with open(catalog_path, "w", encoding="utf-8") as f: f.write(md_text)
+        latencies, elapsed, model, bot = asyncio.run(
+            run_load(catalog_path, titles, requests, concurrency, latency, error_rate, finish_reasons, mix, seed))
+    all_latencies = [value for values in latencies.values() for value in values]
+    summary = lambda values: {"count": len(values), **{f"p{pct}_ms": round(percentile([v * 1000 for v in values], pct), 2) if values else None
+                                                       for pct in (50, 95, 99)}}
+    results.put({
+        "catalog_size": catalog_size, "requests": requests, "seconds": round(elapsed, 3),
+        "throughput": round(requests / elapsed, 2),
+        "latency": {"all": summary(all_latencies), **{kind: summary(values) for kind, values in latencies.items()}},
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "gemini_calls": model.calls, "gemini_errors": model.errors,
+        "prompt_bytes": model.prompt_bytes, "media_bytes": model.media_bytes,
+        "telegram_sent": bot.sent, "telegram_edited": bot.edited,
+    })
+
+def parse_weights(text: str) -> dict[str, float]:
+    """`"text=8,photo=1"` -> {"text": 8.0, "photo": 1.0}"""
+    return {key.strip(): float(value) for key, value in (item.split("=") for item in text.split(",") if item)}
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_load(catalog_sizes: list[int], requests: int, concurrency: int, latency: float, error_rate: float,
+               finish_reasons: dict[str, float], mix: dict[str, float], seed: int, json_path: str | None, compare_path: str | None):
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for catalog_size in catalog_sizes:
+        queue = context.Queue()
+        process = context.Process(target=load_scenario, args=(catalog_size, requests, concurrency, latency, error_rate,
+                                                              finish_reasons, mix, seed, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+    revision = git_revision()
+    print(f"commit {revision or '?'} | {requests} requêtes ({', '.join(f'{k} {v:g}' for k, v in mix.items())}), {concurrency} clients, "
+          f"Gemini simulé à {latency * 1000:.0f} ms, {error_rate:.0%} d'erreurs, graine {seed}")
+    print(f"{'entrées':>8} {'type':>6} {'req/s':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'RSS Mo':>7} {'prompt Ko/appel':>16} {'appels':>7}")
+    for result in results:
+        for kind, stats in result["latency"].items():
+            if not stats["count"]: continue
+            head = (f"{result['throughput']:>7.1f}", f"{result['peak_rss_mb']:>7.0f}",
+                    f"{result['prompt_bytes'] / 1024 / max(result['gemini_calls'], 1):>16.1f}", f"{result['gemini_calls']:>7}") \
+                if kind == "all" else (f"{'':>7}", f"{'':>7}", f"{'':>16}", f"{'':>7}")
+            print(f"{result['catalog_size']:>8} {kind:>6} {head[0]} {stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f} "
+                  f"{head[1]} {head[2]} {head[3]}")
+    report = {"commit": revision, "python": sys.version.split()[0], "seed": seed,
+              "parameters": {"requests": requests, "concurrency": concurrency, "latency": latency, "error_rate": error_rate,
+                             "embeddings": tengo.HashingEmbeddingProvider().name,
+                             "finish_reasons": finish_reasons, "mix": mix},
+              "results": results}
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f: json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Résultats écrits dans {json_path}")
+    if compare_path:
+        with open(compare_path, encoding="utf-8") as f: baseline = json.load(f)
+        previous = {result["catalog_size"]: result for result in baseline["results"]}
+        print(f"Comparaison avec {compare_path} (commit {baseline.get('commit') or '?'}) :")
+        for result in results:
+            before = previous.get(result["catalog_size"])
+            if not before: continue
+            delta = lambda new, old: f"{(new - old) / old:+.1%}" if old else "n/a"
+            print(f"{result['catalog_size']:>8} débit {delta(result['throughput'], before['throughput'])}, "
+                  f"p50 {delta(result['latency']['all']['p50_ms'], before['latency']['all']['p50_ms'])}, "
+                  f"p99 {delta(result['latency']['all']['p99_ms'], before['latency']['all']['p99_ms'])}, "
+                  f"RSS {delta(result['peak_rss_mb'], before['peak_rss_mb'])}, "
+                  f"prompt {delta(result['prompt_bytes'], before['prompt_bytes'])}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=0)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    matcher_parser = subparsers.add_parser("matcher", help="latence du matcher de titres local")
+    matcher_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    matcher_parser.add_argument("--queries", type=int, default=200)
+    scheduler_parser = subparsers.add_parser("scheduler", help="contrôle d'admission face à un backend lent/saturé simulé")
+    scheduler_parser.add_argument("--clients", type=int, default=100)
+    scheduler_parser.add_argument("--requests", type=int, default=20)
+    scheduler_parser.add_argument("--capacity", type=int, default=12)
+    scheduler_parser.add_argument("--latency", type=float, default=0.05, help="latence de base du backend (s)")
+    scheduler_parser.add_argument("--baseline", action="store_true", help="sans contrôle d'admission, pour comparaison")
+    media_parser = subparsers.add_parser("media", help="mémoire lors d'un afflux de photos/vocaux")
+    media_parser.add_argument("--files", type=int, default=20)
+    media_parser.add_argument("--size-mb", type=float, default=20)
+    media_parser.add_argument("--hold", type=float, default=0.5, help="durée de l'appel Gemini simulé (s)")
+    media_parser.add_argument("--baseline", action="store_true", help="chemin d'origine, pour comparaison")
+    render_parser = subparsers.add_parser("render", help="débit et validité du rendu Markdown -> HTML Telegram")
+    render_parser.add_argument("--iterations", type=int, default=2000)
+    render_parser.add_argument("--fuzz", type=int, default=20000)
+    history_parser = subparsers.add_parser("history", help="empreinte mémoire du niveau LRU des historiques")
+    history_parser.add_argument("--chats", type=int, default=100_000)
+    history_parser.add_argument("--turns", type=int, default=tengo.HISTORY_LENGTH)
+    history_parser.add_argument("--user-chars", type=int, default=80)
+    history_parser.add_argument("--model-chars", type=int, default=800)
+    scale_parser = subparsers.add_parser("scale", help="débit selon le nombre de workers (file SQLite partagée)")
+    scale_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    scale_parser.add_argument("--updates", type=int, default=4000)
+    scale_parser.add_argument("--chats", type=int, default=500)
+    scale_parser.add_argument("--catalog-size", type=int, default=10000)
+    scale_parser.add_argument("--latency", type=float, default=0.2, help="durée de l'appel Gemini simulé (s)")
+    paths_parser = subparsers.add_parser("paths", help="part de trafic et latence par chemin (catalogue, cache, Gemini)")
+    paths_parser.add_argument("--catalog-size", type=int, default=10000)
+    paths_parser.add_argument("--requests", type=int, default=2000)
+    paths_parser.add_argument("--concurrency", type=int, default=8)
+    paths_parser.add_argument("--latency", type=float, default=0.8, help="durée de l'appel Gemini simulé (s)")
+    paths_parser.add_argument("--no-fast-path", action="store_true", help="tout envoyer à Gemini, pour comparaison")
+    embeddings_parser = subparsers.add_parser("embeddings", help="plongements du catalogue : construction et ciblage des recommandations")
+    embeddings_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    embeddings_parser.add_argument("--queries", type=int, default=300)
+    embeddings_parser.add_argument("--changed", type=float, default=0.01, help="part des entrées modifiées pour la reconstruction incrémentale")
+    load_parser = subparsers.add_parser("load", help="charge de bout en bout (texte, photo, vocal) avec Telegram et Gemini factices")
+    load_parser.add_argument("--catalog-sizes", type=int, nargs="+", default=[1000, 10000])
+    load_parser.add_argument("--requests", type=int, default=1000)
+    load_parser.add_argument("--concurrency", type=int, default=8)
+    load_parser.add_argument("--latency", type=float, default=0.5, help="durée de l'appel Gemini simulé (s)")
+    load_parser.add_argument("--error-rate", type=float, default=0.02, help="part des appels Gemini en erreur")
+    load_parser.add_argument("--finish-reasons", type=parse_weights, default="STOP=0.96,MAX_TOKENS=0.02,SAFETY=0.02",
+                             help="poids des finish_reason simulés")
+    load_parser.add_argument("--mix", type=parse_weights, default="text=8,photo=1,voice=1", help="poids des types de requêtes")
+    load_parser.add_argument("--json", help="écrit les résultats (avec le commit) dans ce fichier")
+    load_parser.add_argument("--compare", help="fichier JSON d'un run précédent à comparer")
+    args = parser.parse_args()
+    if args.command == "matcher":
+        bench_matcher(args.sizes, args.queries, args.seed)
+    elif args.command == "scheduler":
+        bench_scheduler(args.clients, args.requests, args.capacity, args.latency, args.seed, not args.baseline)
+    elif args.command == "media":
+        bench_media(args.files, args.size_mb, args.hold, args.baseline)
+    elif args.command == "render":
+        bench_render(args.iterations, args.fuzz, args.seed)
+    elif args.command == "history":
+        bench_history(args.chats, args.turns, args.user_chars, args.model_chars, args.seed)
+    elif args.command == "scale":
+        bench_scale(args.workers, args.updates, args.chats, args.catalog_size, args.latency, args.seed)
+    elif args.command == "paths":
+        bench_paths(args.catalog_size, args.requests, args.concurrency, args.latency, args.seed, not args.no_fast_path)
+    elif args.command == "embeddings":
+        bench_embeddings(args.sizes, args.queries, args.changed, args.seed)
+    elif args.command == "load":
+        bench_load(args.catalog_sizes, args.requests, args.concurrency, args.latency, args.error_rate,
+                   args.finish_reasons, args.mix, args.seed, args.json, args.compare)
+
+if __name__ == "__main__":
+    main()
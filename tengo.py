@@ -16,13 +16,34 @@
 import os
 import logging
 import asyncio
+import contextlib
 from dotenv import load_dotenv
 import datetime
 import re
 import html
-from collections import deque
+import unicodedata
+from collections import deque, Counter, OrderedDict
 import io
+import hashlib
+import json
+import heapq
+import time
+import sqlite3
+import threading
+import shutil
+import signal
+import secrets
+import hmac
+import multiprocessing
+import contextvars
+import tempfile
+import sys
+import zlib
+STARTUP_STARTED = time.perf_counter()  # avant les imports tiers : base des durées de démarrage
 import httpx
+import numpy as np
+from prometheus_client import Counter as MetricCounter, Histogram, REGISTRY, generate_latest, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.ext import (
@@ -31,41 +52,198 @@ from telegram.ext import (
     MessageHandler,
     filters,
     ContextTypes,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    TypeHandler
 )
-from telegram.constants import ParseMode
-from telegram.error import BadRequest
-
-import google.generativeai as genai
+from telegram.constants import ParseMode, ChatType
+from telegram.error import BadRequest, RetryAfter
 
 load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash-002")
 MARKDOWN_EXPORT_PATH = os.getenv("MARKDOWN_EXPORT_PATH", "messages.md")
 
 MAX_CONTEXT_LENGTH = 900000
 HISTORY_LENGTH = 12
 MAX_VOICE_SIZE = 25 * 1024 * 1024
 MAX_IMAGE_SIZE = 20 * 1024 * 1024
+CATALOG_REFRESH_TTL = int(os.getenv("CATALOG_REFRESH_TTL", "300"))
+CATALOG_FETCH_RETRIES = int(os.getenv("CATALOG_FETCH_RETRIES", "3"))
+CATALOG_FETCH_BACKOFF = float(os.getenv("CATALOG_FETCH_BACKOFF", "1.0"))
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "1") != "0"
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "1") != "0"
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "8"))
+RETRIEVAL_MIN_SCORE = 0.5
+RETRIEVAL_RECOMMENDATION_LIMIT = 60
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "gemini")
+EMBEDDINGS_PATH = os.getenv("EMBEDDINGS_PATH", "")
+EMBEDDING_DIMENSIONS = 256
+EMBEDDINGS_RELOAD_INTERVAL = 10.0
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_CHARS = 5_000_000
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB")
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "0") == "1"
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+GEMINI_CONTEXT_CACHE_REFRESH_RATIO = 0.2
+GEMINI_CONTEXT_CACHE_RETRY_BACKOFF = 30.0
+GEMINI_CONTEXT_CACHE_RETRY_MAX = 900.0
+GEMINI_CONTEXT_CACHE_EXPIRY_MARGIN = 5.0
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "1") != "0"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+CHAT_DEBOUNCE = float(os.getenv("CHAT_DEBOUNCE", "0.5"))
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv("TELEGRAM_CONCURRENT_UPDATES", "64"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_RETRY_AFTER_LIMIT = 5
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "32"))
+GEMINI_MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "50"))
+GEMINI_MAX_QUEUE_WAIT = float(os.getenv("GEMINI_MAX_QUEUE_WAIT", "20"))
+GEMINI_TARGET_LATENCY = float(os.getenv("GEMINI_TARGET_LATENCY", "30"))
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "5000"))
+IMAGE_CACHE_DB = os.getenv("IMAGE_CACHE_DB", "image_cache.sqlite3")
+IMAGE_HASH_MAX_DISTANCE = int(os.getenv("IMAGE_HASH_MAX_DISTANCE", "6"))
+VOICE_CACHE_SIZE = int(os.getenv("VOICE_CACHE_SIZE", "2000"))
+VOICE_CACHE_DB = os.getenv("VOICE_CACHE_DB")
+VOICE_PREPROCESS = os.getenv("VOICE_PREPROCESS", "1") != "0"
+VOICE_SILENCE_THRESHOLD = os.getenv("VOICE_SILENCE_THRESHOLD", "-45dB")
+VOICE_FAST_PATH_MAX_DURATION = int(os.getenv("VOICE_FAST_PATH_MAX_DURATION", "10"))
+FFMPEG_PATH = shutil.which("ffmpeg")
+PHOTO_MIN_SIDE = int(os.getenv("PHOTO_MIN_SIDE", "512"))
+MEDIA_MEMORY_BUDGET = int(os.getenv("MEDIA_MEMORY_BUDGET", str(64 * 1024 * 1024)))
+MEDIA_SPOOL_SIZE = int(os.getenv("MEDIA_SPOOL_SIZE", str(1024 * 1024)))
+HISTORY_DB = os.getenv("HISTORY_DB", "history.sqlite3")
+HISTORY_CACHE_CHATS = int(os.getenv("HISTORY_CACHE_CHATS", "10000"))
+HISTORY_IDLE_TTL = float(os.getenv("HISTORY_IDLE_TTL", "3600"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "2"))
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "1") != "0"
+HISTORY_SUMMARY_TRIGGER = int(os.getenv("HISTORY_SUMMARY_TRIGGER", "8"))
+HISTORY_VERBATIM_TURNS = int(os.getenv("HISTORY_VERBATIM_TURNS", "4"))
+HISTORY_SUMMARY_MAX_CHARS = 1000
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WORKERS = int(os.getenv("WORKERS", "0"))
+UPDATE_QUEUE_DB = os.getenv("UPDATE_QUEUE_DB", "updates.sqlite3")
+if WORKERS > 0:
+    # Les workers sont des processus distincts : les caches de réponses et de transcriptions ne sont
+    # partagés qu'à travers SQLite, d'où un fichier par défaut.
+    RESPONSE_CACHE_DB = RESPONSE_CACHE_DB or "response_cache.sqlite3"
+    VOICE_CACHE_DB = VOICE_CACHE_DB or "voice_cache.sqlite3"
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "0.05"))
+WORKER_CHECK_INTERVAL = 2.0
+WORKER_RESTART_BACKOFF_MAX = 60.0
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+BUSY_MESSAGE = "Désolé, je suis très sollicité en ce moment. Réessayez dans quelques instants 🙏"
 
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    format="%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s", level=logging.INFO
 )
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-try:
-    safety_settings = {}
-    gemini_model = genai.GenerativeModel(
-        'gemini-1.5-flash',
-        safety_settings=safety_settings
-    )
-    genai.configure(api_key=GEMINI_API_KEY)
-    logger.info(f"Gemini API configurée avec succès (modèle: {gemini_model.model_name}).")
-except Exception as e:
-    logger.critical(f"Erreur critique config Gemini: {e}", exc_info=True)
-    gemini_model = None
+# --- Métriques Prometheus et traces par requête ---
+trace_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("trace_id", default="-")
+trace_stages_var: contextvars.ContextVar[list | None] = contextvars.ContextVar("trace_stages", default=None)
+
+class TraceIdFilter(logging.Filter):
+    """Ajoute l'identifiant de trace de la mise à jour en cours à chaque ligne de log."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id_var.get()
+        return True
+
+for _handler in logging.getLogger().handlers: _handler.addFilter(TraceIdFilter())
+
+STAGE_SECONDS = Histogram("tengo_stage_seconds", "Durée de chaque étape du traitement", ["stage", "kind"],
+                          buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+STAGE_ERRORS = MetricCounter("tengo_stage_errors_total", "Étapes terminées par une exception", ["stage", "kind", "error"])
+PROMPT_CHARS = Histogram("tengo_gemini_prompt_chars", "Taille des prompts envoyés à Gemini (caractères)", ["kind"],
+                         buckets=(250, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000))
+PROMPT_TOKENS = Histogram("tengo_gemini_prompt_tokens", "Tokens de prompt comptés par Gemini", ["kind"],
+                          buckets=(100, 250, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000))
+GEMINI_FINISH_REASONS = MetricCounter("tengo_gemini_finish_reason_total", "Réponses Gemini par finish_reason", ["kind", "reason"])
+GEMINI_BLOCK_REASONS = MetricCounter("tengo_gemini_block_reason_total", "Prompts bloqués par Gemini par block_reason", ["kind", "reason"])
+ANSWER_SECONDS = Histogram("tengo_answer_seconds", "Durée de traitement d'une requête, envoi Telegram compris, par chemin de réponse", ["path"],
+                           buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+def start_trace(trace_id: str):
+    """Démarre la trace de la tâche en cours : les étapes mesurées ensuite lui sont rattachées,
+    y compris dans les tâches créées depuis celle-ci (contextvars)."""
+    trace_id_var.set(trace_id)
+    trace_stages_var.set([])
+
+@contextlib.contextmanager
+def trace_stage(stage: str, kind: str = ""):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        STAGE_ERRORS.labels(stage, kind, type(e).__name__).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage, kind).observe(elapsed)
+        stages = trace_stages_var.get()
+        if stages is not None: stages.append((f"{stage}:{kind}" if kind else stage, elapsed))
+
+def trace_summary() -> str:
+    stages = trace_stages_var.get() or []
+    return ", ".join(f"{stage} {elapsed * 1000:.0f}ms" for stage, elapsed in stages)
+
+def _reason_name(reason) -> str:
+    return getattr(reason, "name", None) or str(reason)
+
+def record_gemini_response(kind: str, response, prompt_chars: int):
+    """Taille du prompt (caractères et tokens), finish_reason et block_reason d'une réponse Gemini."""
+    PROMPT_CHARS.labels(kind).observe(prompt_chars)
+    usage = getattr(response, 'usage_metadata', None)
+    prompt_tokens = getattr(usage, 'prompt_token_count', 0) if usage else 0
+    if prompt_tokens: PROMPT_TOKENS.labels(kind).observe(prompt_tokens)
+    candidates = getattr(response, 'candidates', None)
+    feedback = getattr(response, 'prompt_feedback', None)
+    if candidates and candidates[0].finish_reason:
+        GEMINI_FINISH_REASONS.labels(kind, _reason_name(candidates[0].finish_reason)).inc()
+    if feedback and feedback.block_reason:
+        GEMINI_BLOCK_REASONS.labels(kind, _reason_name(feedback.block_reason)).inc()
+
+# Le SDK google.generativeai coûte près d'une seconde à l'import : le client est créé par
+# get_gemini_model(), au préchauffage (en parallèle de la poignée de main Telegram) ou au premier appel.
+gemini_model = None
+_gemini_model_lock = threading.Lock()
+_gemini_model_failed = False
+
+def get_gemini_model():
+    global gemini_model, _gemini_model_failed
+    if gemini_model is not None or _gemini_model_failed: return gemini_model
+    with _gemini_model_lock:
+        if gemini_model is None and not _gemini_model_failed:
+            try:
+                import google.generativeai as genai
+                safety_settings = {}
+                model = genai.GenerativeModel(
+                    GEMINI_MODEL,
+                    safety_settings=safety_settings
+                )
+                genai.configure(api_key=GEMINI_API_KEY)
+                gemini_model = model
+                logger.info(f"Gemini API configurée avec succès (modèle: {gemini_model.model_name}).")
+            except Exception as e:
+                logger.critical(f"Erreur critique config Gemini: {e}", exc_info=True)
+                _gemini_model_failed = True
+    return gemini_model
+
+async def gemini_client():
+    """`get_gemini_model()` sans bloquer la boucle si le SDK n'est pas encore importé."""
+    if gemini_model is not None or _gemini_model_failed: return gemini_model
+    return await asyncio.to_thread(get_gemini_model)
 
 BOT_NAME = "Tengo Bot"
 CREATOR_NAME = "Félicio de SOUZA"
@@ -76,70 +254,1152 @@ MAIN_CHANNEL_LINK = "https://t.me/animelisting_oc"
 COLLECTION_LINK = "https://t.me/addlist/xCEpCGbzm1gyNzJk"
 
 def read_markdown_export(source_path: str) -> tuple[str | None, str | None]:
-    if source_path.startswith(('http://', 'https://')):
-        logger.info(f"Tentative de téléchargement MD depuis URL: {source_path}")
+    """Lit l'export Markdown local (les URL passent par CatalogCache et son client async)."""
+    try:
+        absolute_path = os.path.abspath(source_path)
+        logger.info(f"Tentative de lecture MD locale: {absolute_path}")
+        with open(absolute_path, 'r', encoding='utf-8') as f: content = f.read()
+        file_size = len(content)
+        logger.info(f"Lecture locale OK. Taille: {file_size} chars.")
+        if file_size == 0: return None, "Erreur interne: Source locale vide."
+        return content, None
+    except FileNotFoundError:
+        logger.error(f"Fichier MD local non trouvé: {absolute_path}")
+        return None, f"Erreur: Base de connaissances inaccessible (fichier non trouvé à {source_path}). Vérifiez le chemin."
+    except Exception as e:
+        logger.error(f"Erreur lecture MD locale ({absolute_path}): {e}", exc_info=True)
+        return None, "Erreur interne lecture données locales."
+
+CATALOG_TITLE_RE = re.compile(r'^\s*(?:#{1,6}\s*|[*+-]\s+|\d+\.\s+)?\*\*(.+?)\*\*')
+CATALOG_ALIAS_RE = re.compile(r'\(\s*Alias(?:es)?\s*:\s*([^)]*)\)', re.IGNORECASE)
+CATALOG_LINK_RE = re.compile(r'\[([^\]]+)\]\(\s*([^\s\)]+)\s*\)')
+CATALOG_STATUS_RE = re.compile(r'(?<!\w)_(.+?)_(?!\w)')
+CATALOG_SEASON_RE = re.compile(r'(?<![^\W_])(?:(?:Saison|Season|Partie|Part)\s*\d+|Films?|OAV|OVA|Specials?)(?![^\W_])', re.IGNORECASE)
+CATALOG_GENRE_RE = re.compile(r'^\s*(?:[*+-]\s+)?_?Genres?_?\s*:\s*(.+)$', re.IGNORECASE)
+CATALOG_HASHTAG_RE = re.compile(r'(?<![\w&])#(\w+)')
+
+def normalize_title(text: str) -> str:
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+    text = re.sub(r"['’`]", '', text)
+    return ' '.join(re.sub(r"[\W_]+", ' ', text).split())
+
+class CatalogEntry:
+    __slots__ = ("title", "aliases", "seasons", "statuses", "links", "genres", "text")
+
+    def __init__(self, title: str, aliases: tuple = (), seasons: tuple = (), statuses: tuple = (),
+                 links: tuple = (), genres: tuple = (), text: str = ""):
+        self.title = title
+        self.aliases = aliases
+        self.seasons = seasons
+        self.statuses = statuses
+        self.links = links
+        self.genres = genres
+        self.text = text
+
+    def __repr__(self) -> str:
+        return f"CatalogEntry({self.title!r}, aliases={self.aliases!r})"
+
+    @property
+    def names(self) -> tuple[str, ...]:
+        return (self.title,) + self.aliases
+
+def _split_names(raw: str) -> list[str]:
+    return [name.strip() for name in re.split(r'[,;/|]', raw) if name.strip()]
+
+def _unique(items) -> tuple:
+    return tuple(dict.fromkeys(items))
+
+def _build_catalog_entry(title: str, lines: list[str]) -> CatalogEntry:
+    block = "\n".join(lines)
+    aliases, genres, seasons = [], [], []
+    for alias_match in CATALOG_ALIAS_RE.finditer(block):
+        aliases.extend(_split_names(alias_match.group(1)))
+    for line in lines:
+        genre_match = CATALOG_GENRE_RE.match(line)
+        if genre_match:
+            genres.extend(_split_names(genre_match.group(1)))
+    genres.extend(tag.replace('_', ' ') for tag in CATALOG_HASHTAG_RE.findall(block))
+    # Les liens et les alias ne doivent pas être pris pour des statuts ou des saisons.
+    body = CATALOG_ALIAS_RE.sub('', CATALOG_LINK_RE.sub(lambda m: m.group(1), block))
+    body = body.replace(f"**{title}**", '', 1)
+    seasons.extend(m.group(0) for m in CATALOG_SEASON_RE.finditer(body))
+    statuses = [s.strip() for s in CATALOG_STATUS_RE.findall(body) if s.strip()]
+    return CatalogEntry(
+        title=title,
+        aliases=_unique(a for a in aliases if a.casefold() != title.casefold()),
+        seasons=_unique(s.strip() for s in seasons),
+        statuses=_unique(statuses),
+        links=_unique((text.strip(), url) for text, url in CATALOG_LINK_RE.findall(block)),
+        genres=_unique(g.strip() for g in genres),
+        text=block.strip())
+
+def parse_catalog(md_text: str) -> list[CatalogEntry]:
+    """Découpe l'export Markdown en entrées : chaque ligne commençant par `**Titre**`
+    ouvre une entrée qui court jusqu'au titre suivant."""
+    entries = []
+    title, lines = None, []
+    for line in md_text.splitlines():
+        title_match = CATALOG_TITLE_RE.match(line)
+        if title_match and title_match.group(1).strip():
+            if title: entries.append(_build_catalog_entry(title, lines))
+            title, lines = title_match.group(1).strip(), [line]
+        elif title:
+            lines.append(line)
+    if title: entries.append(_build_catalog_entry(title, lines))
+    return entries
+
+def title_trigrams(normalized: str) -> set[str]:
+    padded = f" {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class CatalogIndex:
+    """Entrées du catalogue et index de recherche par titre/alias : exact, normalisé
+    (casse, accents, ponctuation ignorés), trigrammes et genres."""
+    __slots__ = ("version", "entries", "positions", "exact", "normalized", "names", "trigrams", "genres", "matcher")
+
+    def __init__(self, entries: list[CatalogEntry], version: str | None = None):
+        self.version = version
+        self.entries = entries
+        self.positions = {entry: position for position, entry in enumerate(entries)}
+        self.exact: dict[str, list[int]] = {}
+        self.normalized: dict[str, list[int]] = {}
+        self.names: list[tuple[str, int, int]] = []  # (nom normalisé, position de l'entrée, nb de trigrammes)
+        self.trigrams: dict[str, list[int]] = {}
+        self.genres: dict[str, list[int]] = {}
+        for position, entry in enumerate(entries):
+            for name in entry.names:
+                normalized = normalize_title(name)
+                self._add(self.exact, name, position)
+                self._add(self.normalized, normalized, position)
+                if not normalized: continue
+                grams = title_trigrams(normalized)
+                name_id = len(self.names)
+                self.names.append((normalized, position, len(grams)))
+                for gram in grams:
+                    self.trigrams.setdefault(gram, []).append(name_id)
+            for genre in entry.genres:
+                self._add(self.genres, normalize_title(genre), position)
+        self.matcher = TitleMatcher(self)
+
+    @staticmethod
+    def _add(index: dict[str, list[int]], key: str, position: int):
+        if not key: return
+        positions = index.setdefault(key, [])
+        if not positions or positions[-1] != position: positions.append(position)
+
+    @classmethod
+    def from_markdown(cls, md_text: str, version: str | None = None) -> "CatalogIndex":
+        return cls(parse_catalog(md_text), version)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def lookup(self, name: str) -> list[CatalogEntry]:
+        positions = self.exact.get(name.strip()) or self.normalized.get(normalize_title(name), [])
+        return [self.entries[p] for p in positions]
+
+    def search(self, text: str, limit: int = RETRIEVAL_TOP_K, min_score: float = RETRIEVAL_MIN_SCORE) -> list[tuple[float, CatalogEntry]]:
+        return [(score, self.entries[position]) for position, score in self.rank(normalize_title(text), limit, min_score)]
+
+    def rank(self, normalized: str, limit: int = RETRIEVAL_TOP_K, min_score: float = RETRIEVAL_MIN_SCORE) -> list[tuple[int, float]]:
+        """Positions des entrées dont un titre/alias ressemble au texte normalisé (trigrammes)."""
+        best: dict[int, float] = {}
+        for name_id, score in self.rank_names(normalized, limit * 3, min_score):
+            position = self.names[name_id][1]
+            if score > best.get(position, 0.0): best[position] = score
+        return heapq.nlargest(limit, best.items(), key=lambda item: item[1])
+
+    def rank_names(self, normalized: str, limit: int, min_score: float) -> list[tuple[int, float]]:
+        """Noms (titres/alias) les plus proches du texte normalisé.
+
+        Le score est le meilleur entre le coefficient de Dice et la part des trigrammes du nom
+        présents dans le texte, ce qui retrouve aussi un titre noyé dans une phrase. Les trigrammes
+        très fréquents ne génèrent pas de candidats : ils ne servent qu'à la vérification."""
+        query_grams = title_trigrams(normalized)
+        if len(query_grams) < 2: return []
+        postings = sorted((self.trigrams[gram] for gram in query_grams if gram in self.trigrams), key=len)
+        if not postings: return []
+        selective = [posting for posting in postings if len(posting) <= TRIGRAM_MAX_POSTINGS] or postings[:1]
+        shared_counts = Counter()
+        for posting in selective:
+            shared_counts.update(posting)
+        if len(selective) < len(postings):
+            shared_counts = {name_id: len(query_grams & title_trigrams(self.names[name_id][0]))
+                             for name_id, _ in shared_counts.most_common(limit * 8)}
+        scored = []
+        for name_id, shared in shared_counts.items():
+            gram_count = self.names[name_id][2]
+            score = 2 * shared / (gram_count + len(query_grams))
+            if gram_count >= 4:
+                score = max(score, 0.9 * shared / gram_count)
+            if score >= min_score: scored.append((name_id, score))
+        return heapq.nlargest(limit, scored, key=lambda item: item[1])
+
+    def positions_for_genres_in(self, text: str) -> list[int]:
+        words = " " + normalize_title(re.sub(r"['’]", ' ', text)) + " "
+        positions: dict[int, None] = {}  # ensemble ordonné
+        for genre, genre_positions in self.genres.items():
+            if f" {genre} " in words or f" {genre}s " in words:
+                positions.update(dict.fromkeys(genre_positions))
+        return list(positions)
+
+TITLE_ABBREVIATIONS = {
+    "snk": "shingeki no kyojin", "aot": "attack on titan", "jjk": "jujutsu kaisen",
+    "mha": "my hero academia", "bnha": "boku no hero academia", "hxh": "hunter x hunter",
+    "fma": "fullmetal alchemist", "fmab": "fullmetal alchemist brotherhood", "op": "one piece",
+    "dbz": "dragon ball z", "dbs": "dragon ball super", "kny": "kimetsu no yaiba",
+    "ds": "demon slayer", "sao": "sword art online", "csm": "chainsaw man", "opm": "one punch man",
+    "tpn": "the promised neverland", "ngnl": "no game no life", "jojo": "jojos bizarre adventure",
+    "rezero": "re zero", "tensura": "tensei shitara slime datta ken", "konosuba": "kono subarashii sekai ni shukufuku wo",
+    "danmachi": "is it wrong to try to pick up girls in a dungeon", "oregairu": "my teen romantic comedy snafu",
+    "shield hero": "the rising of the shield hero", "tate no yusha": "tate no yuusha no nariagari",
+}
+MATCH_CLEAR_SCORE = 0.7
+MATCH_CLEAR_SCORE_SHORT = 0.85
+MATCH_MARGIN = 0.15
+BK_TREE_QUERY_MAX_LENGTH = 12
+TRIGRAM_MAX_POSTINGS = 2000
+
+def edit_distance(a: str, b: str) -> int:
+    """Distance de Levenshtein (algorithme bit-parallèle de Myers/Hyyrö)."""
+    if a == b: return 0
+    if len(a) > len(b): a, b = b, a
+    if not a: return len(b)
+    peq: dict[str, int] = {}
+    for i, char in enumerate(a):
+        peq[char] = peq.get(char, 0) | (1 << i)
+    mask = (1 << len(a)) - 1
+    last = 1 << (len(a) - 1)
+    pv, mv, score = mask, 0, len(a)
+    for char in b:
+        eq = peq.get(char, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & last: score += 1
+        elif mh & last: score -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return score
+
+class BKTree:
+    __slots__ = ("root", "size")
+
+    def __init__(self, words=()):
+        self.root = None  # noeud = (mot, {distance: noeud enfant})
+        self.size = 0
+        for word in words: self.add(word)
+
+    def add(self, word: str):
+        if self.root is None:
+            self.root = (word, {})
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            distance = edit_distance(word, node[0])
+            if distance == 0: return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (word, {})
+                self.size += 1
+                return
+            node = child
+
+    def search(self, word: str, max_distance: int) -> list[tuple[int, str]]:
+        results = []
+        stack = [self.root] if self.root else []
+        while stack:
+            candidate, children = stack.pop()
+            distance = edit_distance(word, candidate)
+            if distance <= max_distance: results.append((distance, candidate))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(results)
+
+class MatchResult:
+    __slots__ = ("entry", "score", "method", "candidates")
+
+    def __init__(self, entry: CatalogEntry | None, score: float, method: str, candidates: list[tuple[float, CatalogEntry]]):
+        self.entry = entry
+        self.score = score
+        self.method = method
+        self.candidates = candidates
+
+    @property
+    def is_clear(self) -> bool:
+        return self.entry is not None
+
+class TitleMatcher:
+    """Résolution locale d'un titre (fautes de frappe, abréviations) sans appel à Gemini.
+
+    Ordre : nom exact normalisé, table d'abréviations, acronymes dérivés des titres, puis
+    candidats flous (trigrammes + BK-tree en distance d'édition). Un résultat n'est « clair »
+    que si le meilleur candidat dépasse le seuil avec une marge suffisante sur le suivant ;
+    sinon les candidats sont rendus pour laisser Gemini trancher."""
+    __slots__ = ("index", "acronyms", "bk_tree")
+
+    def __init__(self, index: "CatalogIndex"):
+        self.index = index
+        self.acronyms: dict[str, list[int]] = {}
+        for normalized, position, _ in index.names:
+            words = normalized.split()
+            if len(words) >= 3:
+                CatalogIndex._add(self.acronyms, ''.join(word[0] for word in words), position)
+        self.bk_tree = BKTree(name for name in index.normalized if len(name) <= BK_TREE_QUERY_MAX_LENGTH + 2)
+
+    def match(self, text: str) -> MatchResult | None:
+        normalized = normalize_title(text)
+        if not normalized: return None
+        positions = self.index.normalized.get(normalized)
+        if positions: return self._result({p: 1.0 for p in positions}, "exact")
+        expanded = TITLE_ABBREVIATIONS.get(normalized) or TITLE_ABBREVIATIONS.get(normalized.replace(' ', ''))
+        if expanded:
+            positions = self.index.normalized.get(expanded)
+            if positions: return self._result({p: 1.0 for p in positions}, "abbreviation")
+            normalized = expanded
+        elif normalized in self.acronyms:
+            return self._result({p: 0.9 for p in self.acronyms[normalized]}, "acronym")
+        threshold = MATCH_CLEAR_SCORE if len(normalized) >= 8 else MATCH_CLEAR_SCORE_SHORT
+        scores: dict[int, float] = {}
+        padded_query = f" {normalized} "
+        query_grams = title_trigrams(normalized)
+        contained: list[tuple[str, int]] = []
+        for name_id, _ in self.index.rank_names(normalized, 20, 0.3):
+            name, position, gram_count = self.index.names[name_id]
+            if f" {name} " in padded_query:
+                contained.append((name, position))
+                continue
+            # Nom non cité tel quel : similarité globale (Dice ou distance d'édition), pas d'inclusion.
+            dice = 2 * len(query_grams & title_trigrams(name)) / (gram_count + len(query_grams))
+            score = max(dice, 1 - edit_distance(normalized, name) / max(len(name), len(normalized)))
+            if score > scores.get(position, 0.0): scores[position] = score
+        # Titre cité dans une phrase : on garde le nom cité le plus long ("X saison 2" plutôt que "X").
+        for name, position in contained:
+            if not any(name != other and name in other for other, _ in contained):
+                scores[position] = max(scores.get(position, 0.0), 0.95)
+        if len(normalized) <= BK_TREE_QUERY_MAX_LENGTH and max(scores.values(), default=0.0) < threshold:
+            # Peu de trigrammes en commun sur un nom court : recherche par distance d'édition.
+            for distance, name in self.bk_tree.search(normalized, 1 if len(normalized) <= 5 else 2):
+                similarity = 1 - distance / max(len(name), len(normalized))
+                for position in self.index.normalized[name]:
+                    if similarity > scores.get(position, 0.0): scores[position] = similarity
+        if not scores: return None
+        return self._result(scores, "fuzzy", threshold)
+
+    def _result(self, scores: dict[int, float], method: str, threshold: float = 0.0) -> MatchResult:
+        ranked = heapq.nlargest(RETRIEVAL_TOP_K, scores.items(), key=lambda item: item[1])
+        candidates = [(score, self.index.entries[position]) for position, score in ranked]
+        best_score = candidates[0][0]
+        runner_up = candidates[1][0] if len(candidates) > 1 else 0.0
+        clear = best_score >= threshold and best_score - runner_up >= (MATCH_MARGIN if threshold else 1e-9)
+        return MatchResult(candidates[0][1] if clear else None, best_score, method, candidates)
+
+class CatalogSnapshot:
+    __slots__ = ("content", "version", "etag", "last_modified", "mtime", "size", "loaded_at", "index", "embeddings")
+
+    def __init__(self, content: str, etag: str | None = None, last_modified: str | None = None,
+                 mtime: float | None = None, size: int | None = None):
+        self.content = content
+        self.version = hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+        self.etag = etag
+        self.last_modified = last_modified
+        self.mtime = mtime
+        self.size = size
+        self.loaded_at = time.monotonic()
+        self.index: CatalogIndex | None = None
+        self.embeddings: CatalogEmbeddings | None = None
+
+def embedding_text(entry: CatalogEntry) -> str:
+    """Texte plongé pour une entrée : titre, alias et genres (liens et statuts n'ont pas de sens à comparer)."""
+    parts = [entry.title, *entry.aliases]
+    if entry.genres: parts.append("Genres : " + ", ".join(entry.genres))
+    return "\n".join(parts)
+
+class HashingEmbeddingProvider:
+    """Plongements locaux et déterministes : mots et trigrammes de caractères hachés (crc32, signe
+    tiré du bit de poids fort) dans `dimensions` composantes. Aucun appel réseau."""
+    local = True
+
+    def __init__(self, dimensions: int = EMBEDDING_DIMENSIONS):
+        self.dimensions = dimensions
+        self.name = f"hashing-{dimensions}"
+
+    def _features(self, text: str) -> list[tuple[str, float]]:
+        words = normalize_title(text).split()
+        # Les trigrammes rapprochent les variantes ("shonen"/"shounen", "musique"/"music").
+        return [(word, 2.0) for word in words] + [(gram, 0.5) for word in words if len(word) > 3 for gram in title_trigrams(word)]
+
+    def embed_documents(self, texts: list[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            columns, weights = [], []
+            for feature, weight in self._features(text):
+                digest = zlib.crc32(feature.encode('utf-8'))
+                columns.append(digest % self.dimensions)
+                weights.append(weight if digest & 0x80000000 else -weight)
+            if columns: np.add.at(matrix[row], columns, weights)
+        return matrix
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self.embed_documents([text])[0]
+
+class GeminiEmbeddingProvider:
+    """Plongements Gemini (`genai.embed_content`, envoyé par lots de 100 par le SDK)."""
+    local = False
+
+    def __init__(self, model: str = "models/text-embedding-004"):
+        self.model = model
+        self.name = f"gemini:{model}"
+
+    def _embed(self, texts: list[str], task_type: str) -> np.ndarray:
+        import google.generativeai as genai
+        get_gemini_model()  # configure la clé API (et importe le SDK, y compris dans le fil de plongements de l'ingress)
+        result = genai.embed_content(model=self.model, content=texts, task_type=task_type)
+        return np.asarray(result["embedding"], dtype=np.float32)
+
+    def embed_documents(self, texts: list[str]) -> np.ndarray:
+        return self._embed(texts, "retrieval_document")
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self._embed([text], "retrieval_query")[0]
+
+def make_embedding_provider(name: str):
+    if name == "local": return HashingEmbeddingProvider()
+    if name == "gemini": return GeminiEmbeddingProvider()
+    if name: logger.warning(f"EMBEDDING_PROVIDER inconnu ('{name}') : recommandations sans plongements.")
+    return None
+
+embedding_provider = make_embedding_provider(EMBEDDING_PROVIDER)
+
+def embeddings_path_for(source_path: str) -> str:
+    """Préfixe des fichiers de plongements : EMBEDDINGS_PATH, sinon à côté de l'export local
+    (dans le dossier courant pour une URL)."""
+    if EMBEDDINGS_PATH: return EMBEDDINGS_PATH
+    if source_path.startswith(('http://', 'https://')): return "catalogue.embeddings"
+    return f"{source_path}.embeddings"
+
+class CatalogEmbeddings:
+    """Plongements normalisés du catalogue, une ligne par entrée dans l'ordre de l'index.
+
+    La matrice float32 est un fichier `.npy` ouvert en mémoire partagée (`mmap_mode="r"`) : les
+    workers se partagent les mêmes pages. `<préfixe>.json` indique le fournisseur, le fichier de la
+    matrice et l'empreinte du texte de chaque ligne ; à la reconstruction, seules les entrées
+    nouvelles ou modifiées sont recalculées. La matrice est écrite sous un nouveau nom avant la mise
+    à jour (atomique) du `.json` : une reconstruction interrompue ne laisse jamais de lignes décalées."""
+    __slots__ = ("provider", "matrix", "computed", "reused")
+
+    def __init__(self, provider, matrix: np.ndarray, computed: int = 0, reused: int = 0):
+        self.provider = provider
+        self.matrix = matrix
+        self.computed = computed
+        self.reused = reused
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    @staticmethod
+    def _load_previous(prefix: str, provider) -> tuple[np.ndarray | None, list[str], str | None]:
         try:
-            response = httpx.get(source_path, timeout=30)
-            response.raise_for_status()
-            content = response.text
-
-            file_size = len(content)
-            logger.info(f"Téléchargement OK. Taille: {file_size} chars.")
-            if file_size == 0: return None, "Erreur interne: Source distante vide."
-            return content, None
-        except httpx.HTTPStatusError as e:
-            logger.error(f"Erreur HTTP téléchargement MD ({source_path}): {e}", exc_info=True)
-            return None, f"Erreur HTTP lors de l'accès à la source distante: {e.response.status_code}"
-        except httpx.RequestError as e:
-            logger.error(f"Erreur requête téléchargement MD ({source_path}): {e}", exc_info=True)
-            return None, f"Erreur de requête lors de l'accès à la source distante: {e}"
-        except Exception as e:
-            logger.error(f"Erreur inattendue téléchargement MD ({source_path}): {e}", exc_info=True)
-            return None, "Erreur interne lors du téléchargement des données distantes."
-    else:
+            with open(f"{prefix}.json", encoding="utf-8") as f: meta = json.load(f)
+            if meta.get("provider") != provider.name: return None, [], None
+            matrix_path = os.path.join(os.path.dirname(prefix), meta["matrix"])
+            matrix = np.load(matrix_path, mmap_mode="r")
+            if matrix.shape[0] != len(meta["keys"]): return None, [], None
+            return matrix, meta["keys"], matrix_path
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, [], None
+
+    @staticmethod
+    def _keys(texts: list[str]) -> list[str]:
+        return [hashlib.sha1(text.encode('utf-8')).hexdigest()[:16] for text in texts]
+
+    @classmethod
+    def load(cls, index: CatalogIndex, provider, prefix: str) -> "CatalogEmbeddings | None":
+        """Plongements déjà calculés pour exactement ces entrées, sans rien calculer ni écrire (workers)."""
+        keys = cls._keys([embedding_text(entry) for entry in index.entries])
+        previous, previous_keys, _ = cls._load_previous(prefix, provider)
+        return cls(provider, previous, 0, len(keys)) if previous is not None and previous_keys == keys else None
+
+    @classmethod
+    def build(cls, index: CatalogIndex, provider, prefix: str) -> "CatalogEmbeddings":
+        texts = [embedding_text(entry) for entry in index.entries]
+        keys = cls._keys(texts)
+        previous, previous_keys, previous_path = cls._load_previous(prefix, provider)
+        if previous is not None and previous_keys == keys:
+            return cls(provider, previous, 0, len(keys))
+        previous_rows = {key: row for row, key in enumerate(previous_keys)}
+        reused = [(row, previous_rows[key]) for row, key in enumerate(keys) if key in previous_rows]
+        missing = [row for row, key in enumerate(keys) if key not in previous_rows]
+        fresh = provider.embed_documents([texts[row] for row in missing]) if missing else None
+        if fresh is not None:
+            norms = np.linalg.norm(fresh, axis=1, keepdims=True)
+            fresh /= np.where(norms > 0, norms, 1.0)
+        dimensions = fresh.shape[1] if fresh is not None else previous.shape[1]
+
+        digest = hashlib.sha1(f"{provider.name}:{','.join(keys)}".encode('utf-8')).hexdigest()[:16]
+        matrix_path = f"{prefix}.{digest}.npy"
+        directory = os.path.dirname(os.path.abspath(prefix))
+        matrix_fd, matrix_tmp = tempfile.mkstemp(dir=directory, suffix=".npy")
+        os.close(matrix_fd)
+        matrix = np.lib.format.open_memmap(matrix_tmp, mode="w+", dtype=np.float32, shape=(len(keys), dimensions))
+        if reused:
+            rows, previous_positions = map(list, zip(*reused))
+            matrix[rows] = previous[previous_positions]
+        if missing: matrix[missing] = fresh
+        matrix.flush()
+        del matrix
+        os.replace(matrix_tmp, matrix_path)
+        meta_fd, meta_tmp = tempfile.mkstemp(dir=directory, suffix=".json")
+        with os.fdopen(meta_fd, "w", encoding="utf-8") as f:
+            json.dump({"provider": provider.name, "matrix": os.path.basename(matrix_path), "keys": keys}, f)
+        os.replace(meta_tmp, f"{prefix}.json")
+        if previous_path and os.path.abspath(previous_path) != os.path.abspath(matrix_path):
+            with contextlib.suppress(OSError): os.remove(previous_path)
+        return cls(provider, np.load(matrix_path, mmap_mode="r"), len(missing), len(reused))
+
+    def vector_for(self, positions: list[int]) -> np.ndarray:
+        return self.matrix[positions].sum(axis=0)
+
+    def nearest(self, vector: np.ndarray, limit: int, among: list[int] | None = None, exclude=()) -> list[int]:
+        """Positions des `limit` entrées les plus proches de `vector` (cosinus), parmi `among` si donné."""
+        norm = float(np.linalg.norm(vector))
+        if not norm or limit <= 0: return []
+        candidates = np.asarray(among, dtype=np.intp) if among is not None else None
+        scores = (self.matrix[candidates] if candidates is not None else self.matrix) @ (vector / norm).astype(np.float32)
+        count = min(limit + len(exclude), len(scores))
+        if not count: return []
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        positions = candidates[top] if candidates is not None else top
+        return [int(position) for position in positions if int(position) not in exclude][:limit]
+
+class CatalogCache:
+    """Catalogue chargé une fois puis rechargé uniquement si la source a changé.
+
+    Fichier local : comparaison mtime/taille (lecture dans un thread). URL : GET conditionnel
+    (ETag / Last-Modified) via un httpx.AsyncClient partagé, avec retries et backoff exponentiel.
+    En cas d'échec, la dernière version connue continue d'être servie (stale-while-revalidate).
+    La nouvelle version remplace l'ancienne en une seule affectation (swap atomique)."""
+
+    def __init__(self, source_path: str, ttl: int = CATALOG_REFRESH_TTL,
+                 retries: int = CATALOG_FETCH_RETRIES, backoff: float = CATALOG_FETCH_BACKOFF):
+        self.source_path = source_path
+        self.ttl = ttl
+        self.retries = retries
+        self.backoff = backoff
+        self.is_url = source_path.startswith(('http://', 'https://'))
+        self._snapshot: CatalogSnapshot | None = None
+        self._last_error: str | None = None
+        self._checked_at = 0.0
+        self._client: httpx.AsyncClient | None = None
+        self._refresh_lock = asyncio.Lock()
+        self._revalidate_task: asyncio.Task | None = None
+        self._refresh_task: asyncio.Task | None = None
+        self._embed_task: asyncio.Task | None = None
+        self._embed_lock = asyncio.Lock()
+        self.build_embeddings = True  # False dans les workers : un seul processus écrit les fichiers
+        self.metrics = {
+            "cold_fetch_count": 0, "cold_fetch_seconds_total": 0.0, "cold_fetch_seconds_last": None,
+            "warm_fetch_count": 0, "warm_fetch_seconds_total": 0.0, "warm_fetch_seconds_last": None,
+            "not_modified": 0, "fetch_failures": 0, "stale_served": 0,
+            "embeddings_computed": 0, "embeddings_reused": 0, "embedding_failures": 0,
+        }
+
+    @property
+    def snapshot(self) -> CatalogSnapshot | None:
+        return self._snapshot
+
+    async def get(self) -> tuple[str | None, str | None]:
+        snapshot = self._snapshot
+        if snapshot is None:
+            await self.refresh()
+            snapshot = self._snapshot
+            if snapshot is None:
+                return None, self._last_error
+        elif self._is_stale() and self._refresh_task is None:
+            self._schedule_revalidation()
+        if self._last_error:
+            self.metrics["stale_served"] += 1
+        return snapshot.content, None
+
+    def _is_stale(self) -> bool:
+        return self.ttl > 0 and time.monotonic() - self._checked_at > self.ttl
+
+    def _schedule_revalidation(self):
+        if self._revalidate_task and not self._revalidate_task.done(): return
+        self._revalidate_task = asyncio.create_task(self.refresh())
+
+    async def refresh(self) -> bool:
+        async with self._refresh_lock:
+            current = self._snapshot
+            metric = "warm" if current else "cold"
+            started = time.perf_counter()
+            with trace_stage("catalog_load", metric):
+                if self.is_url:
+                    new_snapshot, error = await self._fetch_url(current)
+                else:
+                    new_snapshot, error = await asyncio.to_thread(self._read_local, current)
+            elapsed = time.perf_counter() - started
+            self._checked_at = time.monotonic()
+            if error:
+                self._last_error = error
+                self.metrics["fetch_failures"] += 1
+                if current: logger.warning(f"Rafraîchissement catalogue échoué, version {current.version} conservée: {error}")
+                return False
+            self.metrics[f"{metric}_fetch_count"] += 1
+            self.metrics[f"{metric}_fetch_seconds_total"] += elapsed
+            self.metrics[f"{metric}_fetch_seconds_last"] = elapsed
+            self._last_error = None
+            if new_snapshot is None:
+                self.metrics["not_modified"] += 1
+                logger.debug(f"Catalogue inchangé (version {current.version if current else '?'}, {elapsed:.3f}s).")
+                return False
+            with trace_stage("catalog_parse"):
+                new_snapshot.index = await asyncio.to_thread(CatalogIndex.from_markdown, new_snapshot.content, new_snapshot.version)
+            self._snapshot = new_snapshot
+            logger.info(f"Catalogue chargé (version {new_snapshot.version}, {len(new_snapshot.content)} chars, "
+                        f"{len(new_snapshot.index)} entrées, {metric} {elapsed:.3f}s).")
+            if embedding_provider and new_snapshot.index.entries:
+                self._embed_task = asyncio.create_task(self._build_embeddings(new_snapshot))
+            return True
+
+    async def _build_embeddings(self, snapshot: CatalogSnapshot):
+        """Plongements de la nouvelle version, en arrière-plan : le catalogue est servi sans eux
+        (filtre par genre seul) le temps du calcul. Sans `build_embeddings`, les fichiers écrits par
+        un autre processus sont relus toutes les EMBEDDINGS_RELOAD_INTERVAL secondes jusqu'à correspondre."""
+        async with self._embed_lock:
+            if snapshot is not self._snapshot: return
+            started = time.perf_counter()
+            prefix = embeddings_path_for(self.source_path)
+            try:
+                if self.build_embeddings:
+                    with trace_stage("catalog_embed"):
+                        embeddings = await asyncio.to_thread(CatalogEmbeddings.build, snapshot.index, embedding_provider, prefix)
+                else:
+                    while (embeddings := await asyncio.to_thread(CatalogEmbeddings.load, snapshot.index, embedding_provider, prefix)) is None:
+                        if snapshot is not self._snapshot: return
+                        logger.info(f"Plongements de la version {snapshot.version} pas encore calculés, nouvel essai dans {EMBEDDINGS_RELOAD_INTERVAL:.0f}s.")
+                        await asyncio.sleep(EMBEDDINGS_RELOAD_INTERVAL)
+            except Exception as e:
+                self.metrics["embedding_failures"] += 1
+                logger.error(f"Erreur calcul des plongements du catalogue ({embedding_provider.name}): {e}", exc_info=True)
+                return
+            snapshot.embeddings = embeddings
+            self.metrics["embeddings_computed"] += embeddings.computed
+            self.metrics["embeddings_reused"] += embeddings.reused
+            logger.info(f"Plongements du catalogue prêts ({embedding_provider.name}, {len(embeddings)} entrées, "
+                        f"{embeddings.computed} calculées, {embeddings.reused} reprises, {time.perf_counter() - started:.2f}s).")
+
+    async def wait_for_embeddings(self):
+        if self._embed_task: await asyncio.shield(self._embed_task)
+
+    def _read_local(self, current: CatalogSnapshot | None) -> tuple[CatalogSnapshot | None, str | None]:
         try:
-            absolute_path = os.path.abspath(source_path)
-            logger.info(f"Tentative de lecture MD locale: {absolute_path}")
-            with open(absolute_path, 'r', encoding='utf-8') as f: content = f.read()
-            file_size = len(content)
-            logger.info(f"Lecture locale OK. Taille: {file_size} chars.")
-            if file_size == 0: return None, "Erreur interne: Source locale vide."
-            return content, None
-        except FileNotFoundError:
-            logger.error(f"Fichier MD local non trouvé: {absolute_path}")
-            return None, f"Erreur: Base de connaissances inaccessible (fichier non trouvé à {source_path}). Vérifiez le chemin."
-        except Exception as e:
-            logger.error(f"Erreur lecture MD locale ({absolute_path}): {e}", exc_info=True)
-            return None, "Erreur interne lecture données locales."
+            stat = os.stat(self.source_path)
+        except OSError:
+            stat = None
+        if stat and current and current.mtime == stat.st_mtime and current.size == stat.st_size:
+            return None, None
+        content, error = read_markdown_export(self.source_path)
+        if not content:
+            return None, error
+        return CatalogSnapshot(content, mtime=stat.st_mtime if stat else None, size=stat.st_size if stat else None), None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(30, connect=10),
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+                follow_redirects=True)
+        return self._client
+
+    async def _fetch_url(self, current: CatalogSnapshot | None) -> tuple[CatalogSnapshot | None, str | None]:
+        headers = {}
+        if current and current.etag: headers['If-None-Match'] = current.etag
+        if current and current.last_modified: headers['If-Modified-Since'] = current.last_modified
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff * (2 ** (attempt - 1))
+                logger.info(f"Nouvelle tentative de téléchargement MD dans {delay:.1f}s ({attempt}/{self.retries})...")
+                await asyncio.sleep(delay)
+            try:
+                response = await self._get_client().get(self.source_path, headers=headers)
+                if response.status_code == 304:
+                    return None, None
+                response.raise_for_status()
+                content = response.text
+                if not content: return None, "Erreur interne: Source distante vide."
+                return CatalogSnapshot(content, etag=response.headers.get('ETag'),
+                                       last_modified=response.headers.get('Last-Modified')), None
+            except httpx.HTTPStatusError as e:
+                logger.error(f"Erreur HTTP téléchargement MD ({self.source_path}): {e}")
+                error = f"Erreur HTTP lors de l'accès à la source distante: {e.response.status_code}"
+                if e.response.status_code < 500 and e.response.status_code != 429:
+                    break
+            except httpx.RequestError as e:
+                logger.error(f"Erreur requête téléchargement MD ({self.source_path}): {e}")
+                error = f"Erreur de requête lors de l'accès à la source distante: {e}"
+            except Exception as e:
+                logger.error(f"Erreur inattendue téléchargement MD ({self.source_path}): {e}", exc_info=True)
+                return None, "Erreur interne lors du téléchargement des données distantes."
+        return None, error
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Erreur rafraîchissement catalogue en arrière-plan: {e}", exc_info=True)
+
+    def start_background_refresh(self):
+        if self.ttl <= 0 or self._refresh_task: return
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+        logger.info(f"Rafraîchissement du catalogue en arrière-plan toutes les {self.ttl}s.")
+
+    async def stop_background_refresh(self):
+        for task in (self._refresh_task, self._revalidate_task, self._embed_task):
+            if task and not task.done():
+                task.cancel()
+                try: await task
+                except asyncio.CancelledError: pass
+        self._refresh_task = self._revalidate_task = self._embed_task = None
+        if self._client:
+            await self._client.aclose()
+            self._client = None
+
+catalog_cache = CatalogCache(MARKDOWN_EXPORT_PATH)
+
+MARKDOWN_TOKEN_RE = re.compile(r"""
+      ```(?:[^\n]*\n)?(?P<pre>.*?)```
+    | `(?P<code>[^`\n]+)`
+    | \[(?P<link_text>[^\]]+)\]\(\s*(?P<link_url>[^\s)]+)\s*\)
+    | \*\*(?P<bold_text>[^*_`\[\n]+)\*\*
+    | _(?P<italic_text>[^*_`\[\n]+)_(?!\w)
+    | (?P<bold>\*\*)
+    | (?P<italic>_)
+    | (?P<newline>\n(?:\s*\n)?)(?P<bullet>[ \t]*(?:[*+-]|\d+\.)[ \t]+)?
+""", re.VERBOSE | re.DOTALL)
+MARKDOWN_INLINE_CHARS_RE = re.compile(r"[*_`\[\n]")
+MARKDOWN_MARKERS = {"b": "**", "i": "_"}
+
+def _render_markdown(text: str) -> str:
+    """Rendu en une passe d'un texte déjà échappé (l'échappement ne touche pas aux marqueurs
+    Markdown) : chaque jeton est traité une fois, le texte entre deux jetons est recopié tel quel.
+    Les balises <b>/<i> sont suivies sur une pile : un marqueur fermant ferme sa balise et rend
+    littéraux les marqueurs ouverts après elle (pas de chevauchement), et tout marqueur encore ouvert
+    en fin de ligne redevient littéral. Le HTML produit est donc toujours équilibré.
+    Les puces ne sont reconnues qu'après un saut de ligne : le texte doit commencer par "\n"."""
+    out: list[str] = []
+    append = out.append
+    open_tags: list[tuple[str, int]] = []  # (balise, indice de la balise ouvrante dans `out`)
+
+    def marker(tag: str, start: int, end: int):
+        depth = next((i for i, (open_tag, _) in enumerate(open_tags) if open_tag == tag), None)
+        if tag == "i":
+            can_open = start == 0 or not (text[start - 1].isalnum() or text[start - 1] == "_")
+            can_close = end == len(text) or not (text[end].isalnum() or text[end] == "_")
+        else:
+            can_open = can_close = True
+        if depth is not None and can_close:
+            for open_tag, index in open_tags[depth + 1:]: out[index] = MARKDOWN_MARKERS[open_tag]
+            del open_tags[depth:]
+            append(f"</{tag}>")
+        elif depth is None and can_open:
+            open_tags.append((tag, len(out)))
+            append(f"<{tag}>")
+        else:
+            append(MARKDOWN_MARKERS[tag])
+
+    position = 0
+    for match in MARKDOWN_TOKEN_RE.finditer(text):
+        start = match.start()
+        if start > position: append(text[position:start])
+        position = match.end()
+        kind = match.lastgroup
+        if kind == "bold_text" or kind == "italic_text":
+            # Cas courant (**Titre**, _VF_) en un seul jeton ; sinon, équivalent à marqueur + texte + marqueur.
+            tag = "b" if kind == "bold_text" else "i"
+            if not open_tags and (tag == "b" or start == 0 or not (text[start - 1].isalnum() or text[start - 1] == "_")):
+                append(f"<{tag}>{match.group(kind)}</{tag}>")
+            else:
+                width = len(MARKDOWN_MARKERS[tag])
+                marker(tag, start, start + width)
+                append(match.group(kind))
+                marker(tag, position - width, position)
+        elif kind == "bold":
+            marker("b", start, position)
+        elif kind == "italic":
+            marker("i", start, position)
+        elif kind == "newline" or kind == "bullet":
+            for open_tag, index in open_tags: out[index] = MARKDOWN_MARKERS[open_tag]
+            open_tags.clear()
+            newline = match.group("newline")
+            if kind == "bullet": append("\n• ")  # comme avant : pas de ligne vide avant une puce
+            else: append("\n\n" if len(newline) > 1 and newline.count("\n") > 1 else "\n")
+        elif kind == "link_url":
+            link_text = match.group("link_text")
+            if MARKDOWN_INLINE_CHARS_RE.search(link_text): link_text = _render_markdown(link_text)
+            url = match.group("link_url")
+            if url.startswith(("http", "tg")):
+                append(f'<a href="{url.replace(chr(34), "&quot;")}">{link_text}</a>')
+            else:
+                logger.warning(f"URL invalide ignorée: '{html.unescape(url)}' pour '{html.unescape(match.group('link_text'))}'")
+                append(link_text)
+        elif kind == "code":
+            append(f"<code>{match.group('code')}</code>")
+        else:
+            for open_tag, index in open_tags: out[index] = MARKDOWN_MARKERS[open_tag]
+            open_tags.clear()
+            append(f"<pre>{match.group('pre').strip()}</pre>")
+    if position < len(text): append(text[position:])
+    for open_tag, index in open_tags: out[index] = MARKDOWN_MARKERS[open_tag]
+    return "".join(out)
 
 def markdown_to_telegram_html(md_text: str) -> str:
     if not md_text: return ""
-    text = html.escape(md_text)
-    def code_block_replacer(match):
-        inner_content = html.unescape(match.group(1).strip())
-        safe_inner_content = html.escape(inner_content)
-        return f'<pre>{safe_inner_content}</pre>'
-    text = re.sub(r'```(?:[^\n]*\n)?(.*?)```', code_block_replacer, text, flags=re.DOTALL | re.MULTILINE)
-    text = re.sub(r'`(.*?)`', r'<code>\1</code>', text)
-    def link_replacer(match):
-        link_text_escaped = match.group(1)
-        url_escaped = match.group(2)
-        url_decoded = html.unescape(url_escaped)
-        if not url_decoded or not url_decoded.strip().startswith(('http', 'tg')):
-            logger.warning(f"URL invalide ignorée: '{url_decoded}' pour '{html.unescape(link_text_escaped)}'")
-            return link_text_escaped
-        safe_url = html.escape(url_decoded, quote=True)
-        return f'<a href="{safe_url}">{link_text_escaped}</a>'
-    text = re.sub(r'\[([^\]]+)\]\(\s*([^\s\)]+)\s*\)', link_replacer, text)
-    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
-    text = re.sub(r'(?<!\w)_(.*?)_(?!\w)', r'<i>\1</i>', text)
-    text = re.sub(r'^(\s*[*+-]\s+)', '• ', text, flags=re.MULTILINE)
-    text = re.sub(r'^(\s*\d+\.\s+)', '• ', text, flags=re.MULTILINE)
-    text = re.sub(r'\n\s*\n', '\n\n', text)
-    return text.strip()
-
-async def transcribe_voice(voice_data: bytes) -> str | None:
-    if not gemini_model:
+    return _render_markdown("\n" + html.escape(md_text, quote=False)).strip()
+
+HTML_CHUNK_TOKEN_RE = re.compile(r"<[^>]*>|&#?\w+;|\n| +|[^<&\n ]+|[<&]")
+HTML_TAG_NAME_RE = re.compile(r"</?(\w+)")
+HTML_CHUNK_TAG_RE = re.compile(r"<[^>]*>")
+
+def split_telegram_html(html_text: str, limit: int = TELEGRAM_MAX_MESSAGE_LENGTH) -> list[str]:
+    """Découpe un HTML Telegram en messages d'au plus `limit` caractères, balises comprises.
+
+    La coupe se fait entre deux jetons (jamais dans une balise ou une entité), de préférence au
+    dernier saut de ligne s'il laisse un message au moins à moitié plein. Les balises ouvertes au
+    point de coupe sont fermées en fin de message et rouvertes au début du suivant."""
+    if len(html_text) <= limit: return [html_text]
+    chunks: list[str] = []
+    pieces: list[str] = []
+    stack: list[tuple[str, str]] = []  # (nom, balise ouvrante)
+    breaks: list[tuple[int, tuple]] = []  # (indice du saut de ligne dans `pieces`, pile à cet endroit)
+    length = content_start = 0
+    max_word = max(1, limit // 4)
+
+    def closers(tags) -> str:
+        return "".join(f"</{name}>" for name, _ in reversed(tags))
+
+    def flush():
+        nonlocal pieces, length, content_start, breaks
+        cut = None
+        for index, tags in reversed(breaks):
+            if index > content_start and sum(map(len, pieces[:index])) >= limit // 2:
+                cut = (index, tags)
+                break
+        if cut:
+            index, tags = cut
+            head, tail = pieces[:index], pieces[index + 1:]
+            breaks = [(i - index - 1, t) for i, t in breaks if i > index]
+        else:
+            tags, head, tail = tuple(stack), pieces, []
+            breaks = []
+        chunk = ("".join(head) + closers(tags)).strip()
+        if HTML_CHUNK_TAG_RE.sub("", chunk).strip(): chunks.append(chunk)
+        reopeners = [opening for _, opening in tags]
+        pieces = reopeners + tail
+        breaks = [(i + len(reopeners), t) for i, t in breaks]
+        content_start = len(reopeners)
+        length = sum(map(len, pieces))
+
+    for token in HTML_CHUNK_TOKEN_RE.findall(html_text):
+        words = [token[i:i + max_word] for i in range(0, len(token), max_word)] if token[0] not in "<&" else [token]
+        for word in words:
+            new_stack = stack
+            if word.startswith("<") and (tag_name := HTML_TAG_NAME_RE.match(word)):
+                if word.startswith("</"): new_stack = stack[:-1] if stack and stack[-1][0] == tag_name.group(1) else stack
+                else: new_stack = stack + [(tag_name.group(1), word)]
+            if length + len(word) + len(closers(new_stack)) > limit and len(pieces) > content_start:
+                flush()
+            stack = new_stack
+            if word == "\n": breaks.append((len(pieces), tuple(stack)))
+            pieces.append(word)
+            length += len(word)
+    chunk = "".join(pieces).strip()
+    if HTML_CHUNK_TAG_RE.sub("", chunk).strip(): chunks.append(chunk)
+    return chunks
+
+class GeminiBusyError(Exception):
+    pass
+
+class GeminiScheduler:
+    """Contrôle d'admission devant Gemini : files par type de travail (texte, image, voix) servies au
+    prorata de KIND_WEIGHTS (tourniquet pondéré lissé : le texte passe le plus souvent sans affamer les
+    médias), partage équitable entre utilisateurs (tourniquet) et concurrence adaptative AIMD :
+    +1/limite par succès rapide, limite divisée par deux sur 429, timeout ou latence trop élevée.
+    File pleine ou attente trop longue : GeminiBusyError immédiate.
+
+    Les travaux de fond (résumés d'historique) ne font jamais la queue : ils ne passent que s'il reste
+    un créneau libre sans personne en attente, et seuls leurs 429/timeouts comptent pour l'AIMD."""
+
+    KINDS = ("text", "image", "voice")
+    KIND_WEIGHTS = {"text": 6, "image": 2, "voice": 2}
+    BACKGROUND_KINDS = ("summary",)
+
+    def __init__(self, initial_limit: int = GEMINI_CONCURRENCY, max_limit: int = GEMINI_MAX_CONCURRENCY,
+                 max_queue: int = GEMINI_MAX_QUEUE, max_wait: float = GEMINI_MAX_QUEUE_WAIT,
+                 target_latency: float = GEMINI_TARGET_LATENCY, min_limit: int = 1):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.waiting = 0
+        self._queues: dict[str, OrderedDict] = {kind: OrderedDict() for kind in self.KINDS}
+        self._credits = {kind: 0 for kind in self.KINDS}
+        self._last_decrease = 0.0
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "queue_timeouts": 0,
+                      "overloads": 0, "slow": 0, "decreases": 0, "background_skipped": 0}
+
+    def overloaded(self) -> bool:
+        return self.waiting >= self.max_queue
+
+    def queue_depths(self) -> dict[str, int]:
+        return {kind: sum(len(waiters) for waiters in queues.values()) for kind, queues in self._queues.items()}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, kind: str, user_id: int | None = None):
+        background = kind in self.BACKGROUND_KINDS
+        with trace_stage("gemini_queue", kind):
+            if background: self._acquire_background()
+            else: await self._acquire(kind, user_id)
+        started = time.monotonic()
+        try:
+            with trace_stage("gemini", kind):
+                yield
+        except Exception as e:
+            overloaded = self._is_overload(e)
+            if overloaded or not background: self._on_result(time.monotonic() - started, overloaded=overloaded)
+            raise
+        else:
+            if not background: self._on_result(time.monotonic() - started, overloaded=False)
+        finally:
+            self._release()
+
+    def _acquire_background(self):
+        if self.waiting or self.in_flight >= int(self.limit):
+            self.stats["background_skipped"] += 1
+            raise GeminiBusyError(f"Travail de fond reporté ({self.in_flight} appels en cours, {self.waiting} en attente).")
+        self.in_flight += 1
+        self.stats["admitted"] += 1
+
+    async def _acquire(self, kind: str, user_id: int | None):
+        if self.in_flight < int(self.limit) and not self.waiting:
+            self.in_flight += 1
+            self.stats["admitted"] += 1
+            return
+        if self.overloaded():
+            self.stats["rejected"] += 1
+            raise GeminiBusyError(f"File Gemini pleine ({self.waiting} en attente, limite {int(self.limit)}).")
+        future = asyncio.get_running_loop().create_future()
+        self._queues[kind].setdefault(user_id, deque()).append(future)
+        self.waiting += 1
+        self.stats["queued"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Créneau attribué au moment même de l'abandon.
+                if isinstance(e, asyncio.TimeoutError): return
+                self._release()
+                raise
+            future.cancel()
+            self._remove_waiter(kind, user_id, future)
+            if isinstance(e, asyncio.CancelledError): raise
+            self.stats["queue_timeouts"] += 1
+            raise GeminiBusyError(f"Attente Gemini trop longue (> {self.max_wait}s).") from None
+
+    def _remove_waiter(self, kind: str, user_id: int | None, future: asyncio.Future):
+        waiters = self._queues[kind].get(user_id)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            self.waiting -= 1
+            if not waiters: del self._queues[kind][user_id]
+
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.waiting and self.in_flight < int(self.limit):
+            future = self._next_waiter()
+            if future is None: return
+            self.in_flight += 1
+            self.stats["admitted"] += 1
+            future.set_result(True)
+
+    def _next_kind(self) -> str | None:
+        active = [kind for kind in self.KINDS if self._queues[kind]]
+        if not active: return None
+        for kind in self.KINDS:
+            if kind in active: self._credits[kind] += self.KIND_WEIGHTS[kind]
+            else: self._credits[kind] = 0
+        kind = max(active, key=self._credits.__getitem__)
+        self._credits[kind] -= sum(self.KIND_WEIGHTS[active_kind] for active_kind in active)
+        return kind
+
+    def _next_waiter(self) -> asyncio.Future | None:
+        while (kind := self._next_kind()) is not None:
+            queue = self._queues[kind]
+            user_id, waiters = next(iter(queue.items()))
+            future = waiters.popleft()
+            self.waiting -= 1
+            if waiters: queue.move_to_end(user_id)
+            else: del queue[user_id]
+            if not future.done(): return future
+        return None
+
+    @staticmethod
+    def _is_overload(error: Exception) -> bool:
+        text = f"{type(error).__name__} {error}".lower()
+        return any(marker in text for marker in ("429", "resourceexhausted", "resource exhausted", "quota",
+                                                 "deadline", "timeout", "503", "unavailable"))
+
+    def _on_result(self, latency: float, overloaded: bool):
+        if overloaded or latency > self.target_latency:
+            self.stats["overloads" if overloaded else "slow"] += 1
+            now = time.monotonic()
+            # Une seule diminution par fenêtre de latence cible : les échecs simultanés ont la même cause.
+            if now - self._last_decrease >= min(self.target_latency, 5.0):
+                self.limit = max(float(self.min_limit), self.limit / 2)
+                self._last_decrease = now
+                self.stats["decreases"] += 1
+                logger.warning(f"Gemini saturé ({'429/timeout' if overloaded else f'{latency:.1f}s'}), concurrence réduite à {int(self.limit)}.")
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+        self._dispatch()
+
+gemini_scheduler = GeminiScheduler()
+
+class TranscriptionCache:
+    """Transcriptions déjà faites, indexées par `file_unique_id` Telegram (avant téléchargement)
+    et par empreinte SHA-256 du contenu (même audio renvoyé sous un autre fichier), avec un niveau
+    SQLite optionnel partagé entre workers."""
+
+    def __init__(self, max_entries: int = VOICE_CACHE_SIZE, db_path: str | None = VOICE_CACHE_DB):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_key(sha256_digest: str) -> str:
+        return "sha256:" + sha256_digest
+
+    async def get(self, key: str, count_miss: bool = True) -> str | None:
+        """Transcription connue pour `key`. `count_miss=False` pour une première recherche suivie d'une
+        autre (empreinte du contenu) : un message vocal ne compte qu'un seul échec."""
+        text = self._entries.get(key)
+        if text is None and self.db_path and self.max_entries > 0:
+            text = await asyncio.to_thread(self._db_get, key)
+            if text: self._store(key, text)
+        if text is None:
+            if count_miss: self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return text
+
+    async def put(self, keys, text: str):
+        if self.max_entries <= 0 or not text: return
+        keys = [key for key in keys if key]
+        for key in keys: self._store(key, text)
+        if self.db_path and keys:
+            await asyncio.to_thread(self._db_put, keys, text)
+
+    def _store(self, key: str, text: str):
+        self._entries[key] = text
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS transcriptions (key TEXT PRIMARY KEY, text TEXT NOT NULL, stored_at REAL NOT NULL)")
+            self._db.execute("DELETE FROM transcriptions WHERE key NOT IN (SELECT key FROM transcriptions ORDER BY stored_at DESC LIMIT ?)",
+                             (self.max_entries * 2,))  # deux clés par vocal (identifiant et contenu)
+            self._db.commit()
+        return self._db
+
+    def _db_get(self, key: str) -> str | None:
+        try:
+            with self._db_lock:
+                row = self._connect().execute("SELECT text FROM transcriptions WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Erreur lecture cache de transcriptions SQLite ({self.db_path}): {e}")
+            return None
+
+    def _db_put(self, keys: list[str], text: str):
+        try:
+            with self._db_lock:
+                db = self._connect()
+                now = time.time()
+                db.executemany("INSERT OR REPLACE INTO transcriptions (key, text, stored_at) VALUES (?, ?, ?)",
+                               [(key, text, now) for key in keys])
+                db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Erreur écriture cache de transcriptions SQLite ({self.db_path}): {e}")
+
+    def close(self):
+        with self._db_lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+voice_cache = TranscriptionCache()
+
+async def preprocess_voice(voice_data: bytes) -> tuple[bytes, str]:
+    """Coupe les silences et réencode en Opus mono 16 kHz avec ffmpeg (si disponible) pour réduire
+    la taille envoyée à Gemini. Renvoie l'audio d'origine si le résultat n'est pas plus petit."""
+    if not VOICE_PREPROCESS or not FFMPEG_PATH: return voice_data, "audio/ogg"
+    started = time.perf_counter()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+            "-af", f"silenceremove=start_periods=1:start_threshold={VOICE_SILENCE_THRESHOLD}"
+                   f":stop_periods=-1:stop_duration=0.7:stop_threshold={VOICE_SILENCE_THRESHOLD}",
+            "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "16k", "-f", "ogg", "pipe:1",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            output, errors = await asyncio.wait_for(process.communicate(voice_data), timeout=30)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            logger.warning("Prétraitement audio ffmpeg trop long, audio d'origine utilisé.")
+            return voice_data, "audio/ogg"
+    except OSError as e:
+        logger.warning(f"Prétraitement audio impossible ({e}), audio d'origine utilisé.")
+        return voice_data, "audio/ogg"
+    if process.returncode != 0 or not output:
+        logger.warning(f"Prétraitement audio ffmpeg en échec (code {process.returncode}): {errors.decode(errors='replace')[:200]}")
+        return voice_data, "audio/ogg"
+    if len(output) >= len(voice_data): return voice_data, "audio/ogg"
+    logger.info(f"Audio prétraité: {len(voice_data)} -> {len(output)} octets en {time.perf_counter() - started:.2f}s.")
+    return output, "audio/ogg"
+
+async def transcribe_voice(voice_data: bytes, user_id: int | None = None, mime_type: str = 'audio/ogg') -> str | None:
+    model = await gemini_client()
+    if not model:
         logger.error("Tentative de transcription mais modèle Gemini non initialisé.")
         return None
     if not voice_data:
@@ -147,14 +1407,15 @@ async def transcribe_voice(voice_data: bytes) -> str | None:
         return None
     try:
         logger.info(f"Préparation de {len(voice_data)} octets audio pour transcription directe par Gemini...")
-        mime_type = 'audio/ogg'
         audio_part = {"mime_type": mime_type, "data": voice_data}
         prompt = "Transcris cet audio en texte."
         logger.info("Envoi de la requête de transcription directe à Gemini...")
-        response = await gemini_model.generate_content_async(
-            [prompt, audio_part],
-            request_options={"timeout": 120}
-        )
+        async with gemini_scheduler.slot("voice", user_id):
+            response = await model.generate_content_async(
+                [prompt, audio_part],
+                request_options={"timeout": 120}
+            )
+        record_gemini_response("voice", response, len(prompt))
         logger.info("Réponse de transcription reçue de Gemini.")
         if response and response.candidates:
             first_candidate = response.candidates[0]
@@ -178,20 +1439,272 @@ async def transcribe_voice(voice_data: bytes) -> str | None:
         else:
             logger.warning(f"Réponse de transcription Gemini vide ou mal formée: {response}")
             return None
+    except GeminiBusyError:
+        raise
     except Exception as e:
         logger.error(f"Erreur lors de la transcription audio avec Gemini: {e}", exc_info=True)
         return None
 
-async def identify_image_anime(image_data: bytes) -> str | None:
-    if not gemini_model: return None
+def pick_photo_size(sizes):
+    """Plus petite version de la photo dont le petit côté atteint PHOTO_MIN_SIDE (Gemini réduit
+    les images de toute façon), sinon la plus grande disponible."""
+    ordered = sorted(sizes, key=lambda size: size.width * size.height)
+    for size in ordered:
+        if min(size.width, size.height) >= PHOTO_MIN_SIDE: return size
+    return ordered[-1]
+
+class MediaDownloader:
+    """Télécharge les fichiers Telegram en flux vers un fichier temporaire (en mémoire jusqu'à
+    `spool_size`, sur disque au-delà), en calculant l'empreinte SHA-256 au passage. Le contenu n'est
+    lu qu'une fois, en un seul `bytes` (le SDK Gemini n'accepte pas de vue mémoire), au lieu des copies
+    successives de `download_as_bytearray()` puis `bytes(...)`.
+
+    `fetch` réserve la taille du fichier sur `memory_budget` pendant tout le bloc : lors d'un afflux de
+    médias, les téléchargements au-delà du budget attendent au lieu de faire grimper la mémoire."""
+
+    def __init__(self, memory_budget: int = MEDIA_MEMORY_BUDGET, spool_size: int = MEDIA_SPOOL_SIZE,
+                 chunk_size: int = 64 * 1024, transport: httpx.AsyncBaseTransport | None = None):
+        self.memory_budget = memory_budget
+        self.spool_size = spool_size
+        self.chunk_size = chunk_size
+        self._transport = transport
+        self._client: httpx.AsyncClient | None = None
+        self._reserved = 0
+        self._budget_changed = asyncio.Condition()
+        self.stats = {"downloads": 0, "bytes": 0, "spilled_to_disk": 0, "waited_for_budget": 0, "peak_reserved": 0}
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(60.0, connect=10.0),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+                transport=self._transport)
+        return self._client
+
+    @contextlib.asynccontextmanager
+    async def fetch(self, telegram_file, max_size: int):
+        """Renvoie `(contenu, empreinte sha256 hexadécimale)` ; la réservation mémoire dure tout le bloc."""
+        reserved = min(telegram_file.file_size or max_size, self.memory_budget)
+        async with self._budget_changed:
+            if self._reserved + reserved > self.memory_budget: self.stats["waited_for_budget"] += 1
+            await self._budget_changed.wait_for(lambda: self._reserved + reserved <= self.memory_budget)
+            self._reserved += reserved
+            self.stats["peak_reserved"] = max(self.stats["peak_reserved"], self._reserved)
+        try:
+            with trace_stage("media_download"):
+                downloaded = await self._download(telegram_file, max_size)
+            yield downloaded
+        finally:
+            async with self._budget_changed:
+                self._reserved -= reserved
+                self._budget_changed.notify_all()
+
+    async def _download(self, telegram_file, max_size: int) -> tuple[bytes, str]:
+        file_path = telegram_file.file_path
+        if not file_path: raise RuntimeError("Fichier Telegram sans file_path, téléchargement impossible.")
+        digest = hashlib.sha256()
+        received = 0
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_size) as spool:
+            if file_path.startswith(('http://', 'https://')):
+                async with self._get_client().stream("GET", file_path) as response:
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        received += len(chunk)
+                        if received > max_size: raise ValueError(f"Fichier Telegram trop volumineux (> {max_size} octets).")
+                        digest.update(chunk)
+                        spool.write(chunk)
+            else:  # serveur Bot API local (mode --local) : le fichier est déjà sur disque
+                received = await asyncio.to_thread(self._copy_local, file_path, spool, digest, max_size)
+            if received > self.spool_size: self.stats["spilled_to_disk"] += 1
+            spool.seek(0)
+            data = spool.read()
+        self.stats["downloads"] += 1
+        self.stats["bytes"] += received
+        return data, digest.hexdigest()
+
+    def _copy_local(self, file_path: str, spool, digest, max_size: int) -> int:
+        received = 0
+        with open(file_path, 'rb') as source:
+            while chunk := source.read(self.chunk_size):
+                received += len(chunk)
+                if received > max_size: raise ValueError(f"Fichier Telegram trop volumineux (> {max_size} octets).")
+                digest.update(chunk)
+                spool.write(chunk)
+        return received
+
+    async def close(self):
+        if self._client:
+            await self._client.aclose()
+            self._client = None
+
+media_downloader = MediaDownloader()
+
+def image_dhash(image_data: bytes) -> int | None:
+    """Hash perceptuel (dHash 64 bits) : gradient horizontal d'une miniature 9x8 en niveaux de gris."""
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(image_data)) as image:
+            image.draft("L", (64, 64))  # JPEG : décodage directement à échelle réduite
+            pixels = image.convert("L").resize((9, 8), Image.Resampling.LANCZOS).tobytes()
+    except Exception as e:
+        logger.warning(f"Calcul du hash perceptuel impossible: {e}")
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+class ImageHashCache:
+    """Identifications d'images déjà faites : accès exact par `file_unique_id` Telegram, puis par
+    distance de Hamming sur le dHash pour les quasi-doublons (recadrage léger, recompression).
+
+    Recherche par bandes : le hash est découpé en 8 octets ; deux hashes à distance <= 7 ont
+    forcément un octet identique, donc seuls les hashes partageant une bande sont comparés."""
+
+    BANDS = 8
+
+    def __init__(self, max_entries: int = IMAGE_CACHE_SIZE, max_distance: int = IMAGE_HASH_MAX_DISTANCE,
+                 db_path: str | None = IMAGE_CACHE_DB):
+        self.max_entries = max_entries
+        self.max_distance = min(max_distance, self.BANDS - 1)
+        self.db_path = db_path
+        self._entries: OrderedDict[int, str] = OrderedDict()
+        self._file_ids: dict[str, int] = {}
+        self._hash_file_ids: dict[int, set[str]] = {}
+        self._bands: list[dict[int, set[int]]] = [{} for _ in range(self.BANDS)]
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self.stats = {"file_id_hits": 0, "hash_hits": 0, "misses": 0, "stores": 0}
+
+    def hit_rate(self) -> float:
+        hits = self.stats["file_id_hits"] + self.stats["hash_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    async def lookup_file_id(self, file_unique_id: str) -> str | None:
+        await self._ensure_loaded()
+        image_hash = self._file_ids.get(file_unique_id)
+        if image_hash is None or image_hash not in self._entries: return None
+        self._entries.move_to_end(image_hash)
+        self.stats["file_id_hits"] += 1
+        return self._entries[image_hash]
+
+    async def lookup_image(self, image_data: bytes) -> tuple[str | None, int | None]:
+        """Nom d'anime d'une image quasi identique déjà identifiée, et le hash calculé."""
+        await self._ensure_loaded()
+        image_hash = await asyncio.to_thread(image_dhash, image_data)
+        if image_hash is None:
+            self.stats["misses"] += 1
+            return None, None
+        best_hash, best_distance = None, self.max_distance + 1
+        candidates = set()
+        for band, buckets in enumerate(self._bands):
+            candidates.update(buckets.get((image_hash >> (8 * band)) & 0xFF, ()))
+        for candidate in candidates:
+            distance = (candidate ^ image_hash).bit_count()
+            if distance < best_distance: best_hash, best_distance = candidate, distance
+        if best_hash is None:
+            self.stats["misses"] += 1
+            return None, image_hash
+        self._entries.move_to_end(best_hash)
+        self.stats["hash_hits"] += 1
+        logger.info(f"Image quasi identique déjà identifiée (distance {best_distance}): '{self._entries[best_hash]}'")
+        return self._entries[best_hash], image_hash
+
+    async def store(self, file_unique_id: str | None, image_hash: int | None, anime_name: str):
+        if image_hash is None: return
+        await self._ensure_loaded()
+        self._add(file_unique_id, image_hash, anime_name)
+        self.stats["stores"] += 1
+        if self.db_path:
+            await asyncio.to_thread(self._db_put, file_unique_id, image_hash, anime_name)
+
+    def _add(self, file_unique_id: str | None, image_hash: int, anime_name: str):
+        if image_hash not in self._entries:
+            for band, buckets in enumerate(self._bands):
+                buckets.setdefault((image_hash >> (8 * band)) & 0xFF, set()).add(image_hash)
+        self._entries[image_hash] = anime_name
+        self._entries.move_to_end(image_hash)
+        if file_unique_id:
+            self._file_ids[file_unique_id] = image_hash
+            self._hash_file_ids.setdefault(image_hash, set()).add(file_unique_id)
+        while len(self._entries) > self.max_entries:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, image_hash: int):
+        del self._entries[image_hash]
+        for band, buckets in enumerate(self._bands):
+            bucket = buckets.get((image_hash >> (8 * band)) & 0xFF)
+            if bucket:
+                bucket.discard(image_hash)
+                if not bucket: del buckets[(image_hash >> (8 * band)) & 0xFF]
+        for file_unique_id in self._hash_file_ids.pop(image_hash, ()):
+            self._file_ids.pop(file_unique_id, None)
+
+    async def _ensure_loaded(self):
+        if self._loaded: return
+        async with self._load_lock:  # les premières recherches concurrentes attendent la fin du chargement
+            if self._loaded: return
+            rows = await asyncio.to_thread(self._db_load) if self.db_path else []
+            for file_unique_id, hash_hex, anime_name in rows:
+                self._add(file_unique_id, int(hash_hex, 16), anime_name)
+            self._loaded = True
+        if rows: logger.info(f"Cache d'images chargé: {len(self._entries)} images identifiées.")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS images (file_unique_id TEXT, dhash TEXT NOT NULL, anime TEXT NOT NULL, stored_at REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS images_stored_at ON images (stored_at)")
+            self._db.commit()
+        return self._db
+
+    def _db_load(self) -> list[tuple[str | None, str, str]]:
+        try:
+            with self._db_lock:
+                return self._connect().execute(
+                    "SELECT file_unique_id, dhash, anime FROM images ORDER BY stored_at DESC LIMIT ?", (self.max_entries,)).fetchall()[::-1]
+        except sqlite3.Error as e:
+            logger.error(f"Erreur lecture cache d'images SQLite ({self.db_path}): {e}")
+            return []
+
+    def _db_put(self, file_unique_id: str | None, image_hash: int, anime_name: str):
+        try:
+            with self._db_lock:
+                db = self._connect()
+                db.execute("INSERT INTO images (file_unique_id, dhash, anime, stored_at) VALUES (?, ?, ?, ?)",
+                           (file_unique_id, f"{image_hash:016x}", anime_name, time.time()))
+                # Borne la table au même nombre d'entrées que la mémoire.
+                db.execute("DELETE FROM images WHERE rowid NOT IN (SELECT rowid FROM images ORDER BY stored_at DESC LIMIT ?)", (self.max_entries,))
+                db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Erreur écriture cache d'images SQLite ({self.db_path}): {e}")
+
+    def close(self):
+        with self._db_lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+image_cache = ImageHashCache()
+
+async def identify_image_anime(image_data: bytes, user_id: int | None = None) -> str | None:
+    model = await gemini_client()
+    if not model: return None
     try:
         logger.info(f"Envoi {len(image_data)} octets image à Gemini...")
         image_part = {"mime_type": "image/jpeg", "data": image_data}
         prompt = """Analyse cette image. Si elle contient un personnage ou une scène reconnaissable d'un anime ou manga, réponds UNIQUEMENT avec le nom le plus probable et le plus connu de cet anime/manga (privilégie le titre anglais ou romaji si possible, mais le plus courant). Ne donne aucune autre information. Si tu ne reconnais pas d'anime/manga spécifique ou si ce n'est pas pertinent, réponds "Inconnu"."""
-        response = await gemini_model.generate_content_async(
-            [prompt, image_part],
-            request_options={"timeout": 60}
-        )
+        async with gemini_scheduler.slot("image", user_id):
+            response = await model.generate_content_async(
+                [prompt, image_part],
+                request_options={"timeout": 60}
+            )
+        record_gemini_response("image", response, len(prompt))
         logger.info("Réponse identification image reçue.")
         if response and response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
              identified_name = response.text.strip()
@@ -204,15 +1717,362 @@ async def identify_image_anime(image_data: bytes) -> str | None:
         else:
             logger.warning(f"Réponse identification image invalide ou bloquée: {response}")
             return None
+    except GeminiBusyError:
+        raise
     except Exception as e:
         logger.error(f"Erreur identification image Gemini: {e}", exc_info=True)
         return None
 
-async def ask_gemini(query: str, static_context: str, chat_history: list) -> str:
-    if not gemini_model: return "Désolé, le service IA est temporairement indisponible."
-    if not static_context: return "Désolé, je ne peux pas accéder à ma base de connaissances actuellement."
+RECOMMENDATION_RE = re.compile(r"recommand|conseill|sugg[eéè]r|similaire|ressembl|genre|propose|des animes? (?:de|d'|du|avec)", re.IGNORECASE)
+
+async def embed_recommendation_query(provider, query: str, user_id: int | None = None) -> np.ndarray | None:
+    """Plongement de la question. Un fournisseur distant passe par le contrôle d'admission comme un
+    appel texte ; en cas d'échec (file pleine, erreur réseau), None : repli sur le filtrage par genre."""
+    try:
+        if provider.local: return provider.embed_query(query)
+        async with gemini_scheduler.slot("text", user_id):
+            return await asyncio.to_thread(provider.embed_query, query)
+    except Exception as e:
+        logger.warning(f"Plongement de la requête impossible ({type(e).__name__}: {e}), recommandation sans similarité.")
+        return None
+
+async def retrieve_catalog_context(query: str, chat_history: list, index: CatalogIndex | None,
+                                   embeddings: CatalogEmbeddings | None = None, user_id: int | None = None) -> str | None:
+    """Extrait du catalogue utile à la requête (top-K des titres/alias proches de la question et
+    des derniers messages, ou candidats pour une recommandation : filtrés par genre et, avec les
+    plongements, classés par similarité avec la question et le titre cité).
+    Retourne None quand rien ne permet de cibler : le catalogue complet est alors envoyé."""
+    if not RETRIEVAL_ENABLED or not index or not index.entries: return None
+    match = index.matcher.match(query)
+    if match and match.is_clear:
+        logger.info(f"Titre résolu localement ({match.method}, score {match.score:.2f}): '{match.entry.title}'")
+        selected: list[CatalogEntry] = [match.entry]
+    else:
+        selected = [entry for _, entry in index.search(query)]
+    previous_turns = [msg['parts'][0] for msg in chat_history[:-1] if msg.get('parts')][-2:]
+    for previous in reversed(previous_turns):
+        for _, entry in index.search(previous, limit=2):
+            if entry not in selected: selected.append(entry)
+    selected = selected[:RETRIEVAL_TOP_K]
+    if RECOMMENDATION_RE.search(query):
+        genre_positions = index.positions_for_genres_in(query)
+        if not genre_positions and selected:
+            genre_positions = index.positions_for_genres_in(" ".join(genre for entry in selected for genre in entry.genres))
+        chosen = {index.positions[entry] for entry in selected}
+        # Le hachage local ne rapproche que des mots : sans genre ni titre cité, il ne sait pas choisir
+        # parmi tout le catalogue, qui est alors envoyé en entier comme avant les plongements.
+        usable = embeddings and len(embeddings) == len(index) and (
+            genre_positions or (match and match.is_clear) or not embeddings.provider.local)
+        vector = await embed_recommendation_query(embeddings.provider, query, user_id) if usable else None
+        if vector is not None:
+            vector = vector / (np.linalg.norm(vector) or 1.0)
+            if match and match.is_clear:  # "des animes comme X" : proches de X autant que de la question
+                vector = vector + embeddings.vector_for([index.positions[match.entry]])
+            candidates = embeddings.nearest(vector, RETRIEVAL_RECOMMENDATION_LIMIT - len(selected),
+                                            among=genre_positions or None, exclude=chosen)
+            logger.info(f"Recommandation : {len(candidates)} candidats par similarité "
+                        f"({'parmi ' + str(len(genre_positions)) + ' du genre' if genre_positions else 'catalogue entier'}).")
+        elif genre_positions:
+            candidates = [position for position in genre_positions if position not in chosen]
+        else:
+            return None
+        selected.extend(index.entries[position] for position in candidates)
+        selected = selected[:RETRIEVAL_RECOMMENDATION_LIMIT]
+    if not selected: return None
+    return "\n\n".join(entry.text for entry in selected)
+
+# Mots qui accompagnent une simple recherche de titre ("vous avez X en vf ?") sans en changer le sens.
+FAST_PATH_FILLER_WORDS = frozenset("""a as au avez avoir auriez ce cest cherche d de des dispo disponible du en est et il
+    j je l la le les lien liens me moi ok salut svp stp t tu un une veux voudrais vf vostfr vous y""".split())
+
+def plain_title_match(query: str, index: CatalogIndex | None) -> CatalogEntry | None:
+    """Entrée du catalogue quand la requête n'est qu'un titre (abréviation, fautes de frappe et mots de
+    liaison compris) résolu sans ambiguïté. None pour le reste, laissé à Gemini : recommandations,
+    questions sur un titre, relances, titres ambigus."""
+    if not index or not index.entries or RECOMMENDATION_RE.search(query): return None
+    match = index.matcher.match(query)
+    if match and match.is_clear and match.method != "fuzzy": return match.entry
+    remaining = " ".join(word for word in normalize_title(query).split() if word not in FAST_PATH_FILLER_WORDS)
+    match = index.matcher.match(remaining) if remaining else None
+    if not match or not match.is_clear: return None
+    if match.method != "fuzzy": return match.entry
+    # Correspondance floue : le reste de la requête doit être le titre lui-même, pas une phrase qui le cite.
+    threshold = MATCH_CLEAR_SCORE if len(remaining) >= 8 else MATCH_CLEAR_SCORE_SHORT
+    for name in match.entry.names:
+        normalized = normalize_title(name)
+        if normalized and 1 - edit_distance(remaining, normalized) / max(len(remaining), len(normalized)) >= threshold:
+            return match.entry
+    return None
+
+def render_catalog_answer(entry: CatalogEntry) -> str:
+    """Réponse Markdown construite directement depuis l'entrée, au format de la règle 5 du prompt :
+    titre en gras, puis une puce par ligne du catalogue (saisons, statuts, liens), sans alias ni genres."""
+    lines = [f"**{entry.title}**"]
+    for position, line in enumerate(entry.text.splitlines()):
+        if position == 0: line = CATALOG_TITLE_RE.sub('', line, count=1)
+        if CATALOG_GENRE_RE.match(line) or not CATALOG_HASHTAG_RE.sub('', line).strip(): continue
+        line = re.sub(r'^\s*(?:[*+-]\s+|\d+\.\s+)', '', CATALOG_ALIAS_RE.sub('', line)).strip(" -–—:")
+        if line: lines.append(f"* {line}")
+    if len(lines) == 1: return f"**{entry.title}** est disponible dans le catalogue."
+    return "\n".join(lines)
+
+ERROR_RESPONSE_PREFIXES = ("désolé", "erreur", "hmm", "je ne peux pas", "impossible")
+
+def is_error_response(text: str | None) -> bool:
+    return not text or text.isspace() or text.lower().startswith(ERROR_RESPONSE_PREFIXES)
+
+class ResponseCache:
+    """Cache LRU+TTL des réponses de Gemini, avec un niveau SQLite optionnel qui survit aux redémarrages.
+
+    La clé inclut la version du catalogue : une mise à jour du catalogue invalide le cache d'elle-même.
+    Les réponses d'erreur ("Désolé...", etc.) ne sont jamais mises en cache."""
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, ttl: int = RESPONSE_CACHE_TTL,
+                 max_chars: int = RESPONSE_CACHE_MAX_CHARS, db_path: str | None = RESPONSE_CACHE_DB):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_chars = max_chars
+        self.db_path = db_path
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._chars = 0
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl > 0
+
+    @staticmethod
+    def make_key(query: str, chat_history: list, catalog_version: str | None, history_summary: str = "") -> str:
+        # Seuls les derniers messages utilisateur précédant la question et le résumé des tours plus
+        # anciens (envoyé avec le prompt) influencent la réponse attendue.
+        previous_turns = [normalize_title(msg['parts'][0]) for msg in chat_history[:-1]
+                          if msg.get('role') == 'user' and msg.get('parts')][-2:]
+        raw = "\0".join([catalog_version or "", normalize_title(query), *previous_turns])
+        if history_summary: raw += "\0résumé:" + hashlib.sha256(history_summary.encode('utf-8')).hexdigest()
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    async def get(self, key: str) -> str | None:
+        if not self.enabled: return None
+        now = time.time()
+        cached = self._entries.get(key)
+        if cached:
+            expires_at, response = cached
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return response
+            self._remove(key)
+        if self.db_path:
+            row = await asyncio.to_thread(self._db_get, key, now)
+            if row:
+                self._store(key, row[1], row[0])
+                self.stats["disk_hits"] += 1
+                return row[1]
+        self.stats["misses"] += 1
+        return None
 
-    system_prompt = f"""Tu es {BOT_NAME}, un assistant IA expert en animes, créé par {CREATOR_NAME} ({CREATOR_LINK}) pour le catalogue Telegram de {CREATOR_PSEUDO} ({MAIN_CHANNEL_NAME} : {MAIN_CHANNEL_LINK}, Collection: {COLLECTION_LINK}).
+    async def put(self, key: str, response: str):
+        if not self.enabled or is_error_response(response): return
+        expires_at = time.time() + self.ttl
+        self._store(key, response, expires_at)
+        self.stats["stores"] += 1
+        if self.db_path:
+            await asyncio.to_thread(self._db_put, key, response, expires_at)
+
+    def hit_rate(self) -> float:
+        hits = self.stats["hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def _store(self, key: str, response: str, expires_at: float):
+        if len(response) > self.max_chars: return
+        self._remove(key)
+        self._entries[key] = (expires_at, response)
+        self._chars += len(response)
+        while len(self._entries) > self.max_entries or self._chars > self.max_chars:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._chars -= len(evicted)
+            self.stats["evictions"] += 1
+
+    def _remove(self, key: str):
+        cached = self._entries.pop(key, None)
+        if cached: self._chars -= len(cached[1])
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._db.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+        return self._db
+
+    def _db_get(self, key: str, now: float) -> tuple[float, str] | None:
+        try:
+            with self._db_lock:
+                return self._connect().execute(
+                    "SELECT expires_at, response FROM responses WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Erreur lecture cache réponses SQLite ({self.db_path}): {e}")
+            return None
+
+    def _db_put(self, key: str, response: str, expires_at: float):
+        try:
+            with self._db_lock:
+                db = self._connect()
+                db.execute("INSERT OR REPLACE INTO responses (key, response, expires_at) VALUES (?, ?, ?)", (key, response, expires_at))
+                db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Erreur écriture cache réponses SQLite ({self.db_path}): {e}")
+
+    def close(self):
+        with self._db_lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+response_cache = ResponseCache()
+
+class GeminiContextCache:
+    """Cache de contexte explicite Gemini : instructions système + catalogue complet, créé une fois
+    par version du catalogue. Seuls l'historique et la question sont envoyés à chaque requête.
+
+    `create` et `bind` peuvent être remplacés (client Gemini factice en local) ; par défaut ils
+    utilisent `genai.caching.CachedContent` et `GenerativeModel.from_cached_content`."""
+
+    def __init__(self, model_name: str = GEMINI_MODEL, ttl: int = GEMINI_CONTEXT_CACHE_TTL,
+                 enabled: bool = GEMINI_CONTEXT_CACHE, create=None, bind=None):
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self.ttl = ttl
+        self.enabled = enabled
+        self._create = create or self._create_with_sdk
+        self._bind = bind or self._bind_with_sdk
+        self._version: str | None = None
+        self._cached_content = None
+        self._model = None
+        self._expires_at = 0.0
+        self._retry_at: dict[str, float] = {}  # version -> prochaine tentative de création après un échec
+        self._create_failures: dict[str, int] = {}
+        self._lock = asyncio.Lock()
+        self._extend_task: asyncio.Task | None = None
+        self.stats = {
+            "cached_requests": 0, "full_requests": 0, "cached_seconds_total": 0.0, "full_seconds_total": 0.0,
+            "prompt_tokens_total": 0, "cached_tokens_total": 0, "caches_created": 0,
+        }
+
+    def _create_with_sdk(self, catalog_prompt: str):
+        import google.generativeai as genai
+        return genai.caching.CachedContent.create(
+            model=self.model_name,
+            display_name=f"tengo-catalogue-{self._version}",
+            system_instruction=SYSTEM_PROMPT,
+            contents=[catalog_prompt],
+            ttl=datetime.timedelta(seconds=self.ttl))
+
+    @staticmethod
+    def _bind_with_sdk(cached_content):
+        import google.generativeai as genai
+        return genai.GenerativeModel.from_cached_content(cached_content)
+
+    def available(self, catalog_version: str | None) -> bool:
+        """Vrai si le catalogue complet de cette version est (ou sera) servi depuis le cache de contexte."""
+        return (self.enabled and bool(catalog_version)
+                and self._retry_at.get(catalog_version, 0.0) <= time.monotonic())
+
+    def _usable(self, catalog_version: str) -> bool:
+        # Un cache expiré côté Gemini n'existe plus : le renvoyer ferait échouer la requête.
+        return (self._version == catalog_version and self._model is not None
+                and self._expires_at - time.monotonic() > GEMINI_CONTEXT_CACHE_EXPIRY_MARGIN)
+
+    async def model_for(self, catalog_version: str, catalog_prompt: str):
+        if not self.available(catalog_version): return None
+        if self._usable(catalog_version):
+            if self._expires_at - time.monotonic() < self.ttl * GEMINI_CONTEXT_CACHE_REFRESH_RATIO:
+                self._schedule_extend()
+            return self._model
+        async with self._lock:
+            if self._usable(catalog_version):
+                return self._model
+            if not self.available(catalog_version): return None
+            expired = self._expires_at <= time.monotonic()
+            previous = self._cached_content
+            self._version = catalog_version
+            try:
+                started = time.perf_counter()
+                cached_content = await asyncio.to_thread(self._create, catalog_prompt)
+                self._model = self._bind(cached_content)
+                self._cached_content = cached_content
+                self._expires_at = time.monotonic() + self.ttl
+                self.stats["caches_created"] += 1
+                self._create_failures.pop(catalog_version, None)
+                self._retry_at.pop(catalog_version, None)
+                logger.info(f"Cache de contexte Gemini créé pour le catalogue {catalog_version} en {time.perf_counter() - started:.2f}s.")
+            except Exception as e:
+                failures = self._create_failures[catalog_version] = self._create_failures.get(catalog_version, 0) + 1
+                delay = min(GEMINI_CONTEXT_CACHE_RETRY_MAX, GEMINI_CONTEXT_CACHE_RETRY_BACKOFF * 2 ** (failures - 1))
+                self._retry_at[catalog_version] = time.monotonic() + delay
+                logger.warning(f"Création du cache de contexte Gemini impossible (catalogue {catalog_version}), "
+                               f"prompt complet utilisé, nouvel essai dans {delay:.0f}s: {e}")
+                self._version = self._model = self._cached_content = None
+                self._expires_at = 0.0
+                return None
+            if previous is not None and not expired:
+                await asyncio.to_thread(self._delete, previous)
+            return self._model
+
+    def _schedule_extend(self):
+        if self._extend_task and not self._extend_task.done(): return
+        self._extend_task = asyncio.create_task(self._extend())
+
+    async def _extend(self):
+        cached_content = self._cached_content
+        try:
+            await asyncio.to_thread(cached_content.update, ttl=datetime.timedelta(seconds=self.ttl))
+            if cached_content is self._cached_content:
+                self._expires_at = time.monotonic() + self.ttl
+            logger.info(f"Cache de contexte Gemini prolongé de {self.ttl}s (catalogue {self._version}).")
+        except Exception as e:
+            logger.warning(f"Prolongation du cache de contexte Gemini impossible, il sera recréé: {e}")
+            if cached_content is self._cached_content:
+                self._version = self._model = self._cached_content = None
+
+    @staticmethod
+    def _delete(cached_content):
+        try: cached_content.delete()
+        except Exception as e: logger.warning(f"Suppression de l'ancien cache de contexte Gemini impossible: {e}")
+
+    def record(self, response, elapsed: float, cached: bool):
+        mode = "cached" if cached else "full"
+        self.stats[f"{mode}_requests"] += 1
+        self.stats[f"{mode}_seconds_total"] += elapsed
+        usage = getattr(response, 'usage_metadata', None)
+        if not usage: return
+        prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+        cached_tokens = getattr(usage, 'cached_content_token_count', 0) or 0
+        self.stats["prompt_tokens_total"] += prompt_tokens
+        self.stats["cached_tokens_total"] += cached_tokens
+        logger.info(f"Gemini ({mode}): {elapsed:.2f}s, {prompt_tokens} tokens de prompt dont {cached_tokens} servis par le cache.")
+
+    def savings(self) -> dict:
+        """Latence moyenne par mode et part des tokens de prompt servis par le cache."""
+        stats = self.stats
+        return {
+            "cached_avg_seconds": stats["cached_seconds_total"] / stats["cached_requests"] if stats["cached_requests"] else None,
+            "full_avg_seconds": stats["full_seconds_total"] / stats["full_requests"] if stats["full_requests"] else None,
+            "cached_token_ratio": stats["cached_tokens_total"] / stats["prompt_tokens_total"] if stats["prompt_tokens_total"] else 0.0,
+        }
+
+    async def close(self):
+        if self._extend_task and not self._extend_task.done():
+            self._extend_task.cancel()
+        # Le cache est laissé à expirer côté Gemini : un redémarrage rapide le recréera de toute façon.
+        self._version = self._model = self._cached_content = None
+
+gemini_context_cache = GeminiContextCache()
+
+SYSTEM_PROMPT = f"""Tu es {BOT_NAME}, un assistant IA expert en animes, créé par {CREATOR_NAME} ({CREATOR_LINK}) pour le catalogue Telegram de {CREATOR_PSEUDO} ({MAIN_CHANNEL_NAME} : {MAIN_CHANNEL_LINK}, Collection: {COLLECTION_LINK}).
 
 **MISSION PRINCIPALE :** Aider les utilisateurs à trouver des informations précises sur les animes **présents dans le CONTEXTE (le catalogue fourni)**.
 
@@ -257,43 +2117,137 @@ async def ask_gemini(query: str, static_context: str, chat_history: list) -> str
 
 6.  **CONFIDENTIALITÉ ABSOLUE DE LA SOURCE :** Ne mentionne JAMAIS le fichier, l'export, la date, le contexte statique, ou tes mécanismes internes de recherche/correction. Agis comme une interface directe au catalogue.
 """
+
+def build_catalog_prompt(static_context: str) -> str:
+    return f"""CONTEXTE (Export du catalogue d'animes - Ta SEULE source pour la disponibilité, les détails et les liens. Contient des `(Alias: ...)` pour t'aider) :
+--- DEBUT DU CONTENU EXPORTÉ ---
+{static_context}
+--- FIN DU CONTENU EXPORTÉ ---
+"""
+
+def build_request_prompt(query: str, chat_history: list, history_summary: str = "") -> str:
     formatted_history = "\n".join(
         [f"Utilisateur: {msg['parts'][0]}" if msg['role'] == 'user' else f"{BOT_NAME}: {msg['parts'][0]}"
          for msg in chat_history if msg.get('parts')]
     )
-
-    logger.info(f"Préparation du prompt OPTIMISÉ pour Gemini. Requête: '{query}'. Taille contexte: {len(static_context)} chars. Hist: {len(chat_history)} msgs.")
-
-    full_prompt = f"""{system_prompt}
-
-HISTORIQUE DE LA CONVERSATION :
+    if history_summary:
+        formatted_history = f"Mémoire des échanges précédents (résumé) :\n{history_summary}\n\nDerniers échanges :\n{formatted_history}"
+    return f"""HISTORIQUE DE LA CONVERSATION :
 --- DEBUT HISTORIQUE ---
 {formatted_history if formatted_history else "Aucun historique pour cette conversation."}
 --- FIN HISTORIQUE ---
 
-CONTEXTE (Export du catalogue d'animes - Ta SEULE source pour la disponibilité, les détails et les liens. Contient des `(Alias: ...)` pour t'aider) :
---- DEBUT DU CONTENU EXPORTÉ ---
-{static_context}
---- FIN DU CONTENU EXPORTÉ ---
-
 QUESTION ACTUELLE DE L'UTILISATEUR :
 "{query}"
 
 TA RÉPONSE ({BOT_NAME} - Applique rigoureusement les étapes 1, 2, 3 et les règles. Format Markdown. N'affiche PAS les alias dans la réponse finale) :
 """
 
+HISTORY_SUMMARY_PROMPT = f"""Tu mets à jour la mémoire d'une conversation entre un utilisateur et {BOT_NAME}, assistant d'un catalogue d'animes.
+Réponds UNIQUEMENT avec la nouvelle mémoire, en {HISTORY_SUMMARY_MAX_CHARS} caractères maximum, sous cette forme exacte :
+Titres évoqués : <titres exacts des animes dont il a été question, séparés par des virgules>
+Précisions de l'utilisateur : <équivalences de noms, corrections, préférences ; ex. "Tate no Yuusha = The Rising of the Shield Hero">
+Demande en cours : <ce que l'utilisateur cherche encore, ou "aucune">
+Ne recopie ni les liens, ni le détail des saisons, ni les réponses elles-mêmes.
+"""
+
+async def summarize_history(previous_summary: str, turns: list[tuple[str, str]]) -> str | None:
+    """Fusionne `turns` dans la mémoire `previous_summary` (travail de fond : abandonné si Gemini est occupé,
+    repris après un prochain échange)."""
+    if not turns: return None
+    model = await gemini_client()
+    if not model: return None
+    formatted_turns = "\n".join(f"Utilisateur: {text}" if role == "user" else f"{BOT_NAME}: {text[:1500]}" for role, text in turns)
+    prompt = (f"{HISTORY_SUMMARY_PROMPT}\nMÉMOIRE ACTUELLE :\n{previous_summary or 'Vide.'}\n\n"
+              f"ÉCHANGES À INTÉGRER :\n{formatted_turns}\n\nNOUVELLE MÉMOIRE :")
     try:
-        logger.info(f"Envoi requête OPTIMISÉE à Gemini...")
-        response = await gemini_model.generate_content_async(
-            full_prompt,
-            request_options={"timeout": 180}
-            )
+        async with gemini_scheduler.slot("summary"):
+            response = await model.generate_content_async(prompt, request_options={"timeout": 60})
+        record_gemini_response("summary", response, len(prompt))
+        return response.text.strip() or None
+    except GeminiBusyError:
+        return None
+    except Exception as e:
+        logger.warning(f"Erreur lors du résumé de l'historique avec Gemini: {e}")
+        return None
+
+VOICE_QUERY_PLACEHOLDER = "(Question posée dans le message vocal joint)"
+VOICE_FAST_PATH_INSTRUCTIONS = """La question de l'utilisateur est dans le message vocal joint. Commence ta réponse par une ligne `TRANSCRIPTION: <transcription exacte du vocal>`, puis réponds à la question à partir de la ligne suivante.
+"""
+VOICE_TRANSCRIPT_RE = re.compile(r"\s*\**TRANSCRIPTION\**\s*:\s*([^\n]*)\n", re.IGNORECASE)
+
+def split_voice_transcript(text: str) -> tuple[str | None, str]:
+    """Sépare la ligne `TRANSCRIPTION:` d'une réponse du chemin rapide vocal du reste de la réponse."""
+    match = VOICE_TRANSCRIPT_RE.match(text)
+    if not match: return None, text
+    return match.group(1).strip().strip('"*_ ') or None, text[match.end():].lstrip()
+
+def _chunk_text(chunk) -> str:
+    try:
+        return chunk.text
+    except (ValueError, AttributeError):
+        return ""
+
+async def ask_gemini(query: str, static_context: str, chat_history: list, catalog_version: str | None = None,
+                     on_partial=None, user_id: int | None = None, audio_part: dict | None = None,
+                     history_summary: str = "") -> str:
+    """`catalog_version` indique que `static_context` est le catalogue complet de cette version :
+    le préfixe (instructions + catalogue) peut alors être servi depuis le cache de contexte Gemini.
+    Avec `on_partial`, la réponse est reçue en streaming et le texte cumulé lui est passé à chaque fragment.
+    Avec `audio_part`, la question est le vocal joint : la réponse commence par sa transcription
+    (voir `split_voice_transcript`), qui n'est pas transmise à `on_partial`."""
+    base_model = await gemini_client()
+    if not base_model: return "Désolé, le service IA est temporairement indisponible."
+    if not static_context: return "Désolé, je ne peux pas accéder à ma base de connaissances actuellement."
+
+    logger.info(f"Préparation du prompt OPTIMISÉ pour Gemini. Requête: '{query}'. Taille contexte: {len(static_context)} chars. Hist: {len(chat_history)} msgs.")
+
+    with trace_stage("prompt_build"):
+        catalog_prompt = build_catalog_prompt(static_context)
+        request_prompt = build_request_prompt(query, chat_history, history_summary)
+    if audio_part:
+        request_prompt = f"{VOICE_FAST_PATH_INSTRUCTIONS}\n{request_prompt}"
+        if on_partial:
+            forward_partial = on_partial
+            async def on_partial(text: str):
+                transcript, answer = split_voice_transcript(text)
+                if transcript and answer: await forward_partial(answer)
+    model, prompt = base_model, f"{SYSTEM_PROMPT}\n{catalog_prompt}\n{request_prompt}"
+    if catalog_version and gemini_context_cache.enabled:
+        cached_model = await gemini_context_cache.model_for(catalog_version, catalog_prompt)
+        if cached_model:
+            model, prompt = cached_model, request_prompt
+    contents = [prompt, audio_part] if audio_part else prompt
+
+    try:
+        logger.info(f"Envoi requête OPTIMISÉE à Gemini{' (préfixe en cache)' if model is not base_model else ''}...")
+        streamed: list[str] = []
+        async with gemini_scheduler.slot("voice" if audio_part else "text", user_id):
+            started = time.perf_counter()
+            if on_partial:
+                response = await model.generate_content_async(
+                    contents,
+                    stream=True,
+                    request_options={"timeout": 180}
+                    )
+                async for chunk in response:
+                    text = _chunk_text(chunk)
+                    if text:
+                        streamed.append(text)
+                        await on_partial("".join(streamed))
+            else:
+                response = await model.generate_content_async(
+                    contents,
+                    request_options={"timeout": 180}
+                    )
+        gemini_context_cache.record(response, time.perf_counter() - started, cached=model is not base_model)
+        record_gemini_response("voice" if audio_part else "text", response, len(prompt))
         logger.info("Réponse reçue de Gemini (optimisé).")
 
         if response and response.candidates:
             first_candidate = response.candidates[0]
             if first_candidate.content and first_candidate.content.parts:
-                return first_candidate.content.parts[0].text
+                return "".join(streamed) if streamed else first_candidate.content.parts[0].text
             elif first_candidate.finish_reason and first_candidate.finish_reason != 1:
                  reason = first_candidate.finish_reason
                  map_r = {3:"Sécurité", 2:"Longueur Max", 4:"Récitation", 5:"Autre"}
@@ -315,101 +2269,794 @@ TA RÉPONSE ({BOT_NAME} - Applique rigoureusement les étapes 1, 2, 3 et les rè
             logger.warning(f"Réponse Gemini vide ou mal formée (optimisé): {response}")
             return "Désolé, il y a eu un problème de communication avec l'IA."
 
+    except GeminiBusyError as e:
+        logger.warning(f"Requête refusée, Gemini saturé: {e}")
+        return BUSY_MESSAGE
     except Exception as e:
         logger.error(f"Erreur lors de l'appel à Gemini (optimisé): {e}", exc_info=True)
         if "deadline exceeded" in str(e).lower() or "timeout" in str(e).lower():
              return "Désolé, la requête a pris trop de temps. Veuillez réessayer ou simplifier votre demande."
         return "Désolé, une erreur technique est survenue lors de la communication avec l'IA."
 
+class ChatHistory:
+    """Historique d'un chat : les HISTORY_LENGTH derniers tours `(rôle, texte)` et le résumé des
+    tours plus anciens. Une liste plutôt qu'un deque borné, qui réserve un bloc de 64 cases par chat.
+    `generation` change à chaque effacement (/start) : un résumé lancé avant est alors ignoré."""
+    __slots__ = ("turns", "summary", "last_used", "generation")
+
+    def __init__(self, turns=(), summary: str = ""):
+        self.turns: list[tuple[str, str]] = list(turns)[-HISTORY_LENGTH:]
+        self.summary = summary
+        self.last_used = time.monotonic()
+        self.generation = 0
+
+    def append(self, role: str, text: str):
+        self.turns.append((role, text))
+        if len(self.turns) > HISTORY_LENGTH: del self.turns[0]
+
+    def messages(self) -> list[dict]:
+        """Format attendu par les prompts Gemini et les clés de cache."""
+        return [{"role": role, "parts": [text]} for role, text in self.turns]
+
+HISTORY_ROLES = {"u": "user", "m": "model"}
+
+class SQLiteHistoryBackend:
+    """Persistance des historiques : une ligne par chat (tours en JSON compact), écrite par lots."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._db: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS chat_history (chat_id INTEGER PRIMARY KEY, turns TEXT NOT NULL, updated_at REAL NOT NULL)")
+            self._db.commit()
+        return self._db
+
+    def load(self, chat_id: int) -> tuple[list[tuple[str, str]], str]:
+        with self._lock:
+            row = self._connect().execute("SELECT turns FROM chat_history WHERE chat_id = ?", (chat_id,)).fetchone()
+        if not row: return [], ""
+        record = json.loads(row[0])
+        if isinstance(record, list): record = {"t": record}  # lignes écrites avant les résumés
+        return [(HISTORY_ROLES[role], text) for role, text in record.get("t", [])], record.get("s", "")
+
+    def save_many(self, items: dict[int, tuple]):
+        """`items` : chat_id -> (tours, résumé) ; un historique vide supprime la ligne."""
+        now = time.time()
+        upserts = [(chat_id, json.dumps({"s": summary, "t": [(role[0], text) for role, text in turns]},
+                                        ensure_ascii=False, separators=(",", ":")), now)
+                   for chat_id, (turns, summary) in items.items() if turns or summary]
+        deletes = [(chat_id,) for chat_id, (turns, summary) in items.items() if not turns and not summary]
+        with self._lock:
+            db = self._connect()
+            with db:
+                if upserts: db.executemany("INSERT OR REPLACE INTO chat_history (chat_id, turns, updated_at) VALUES (?, ?, ?)", upserts)
+                if deletes: db.executemany("DELETE FROM chat_history WHERE chat_id = ?", deletes)
+
+    def close(self):
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+class HistoryStore:
+    """Historiques de conversation : niveau mémoire LRU (`max_chats`, chats inactifs depuis
+    `idle_ttl` secondes évincés) devant un backend persistant optionnel (`load`, `save_many`, `close`).
+
+    Les modifications sont notées puis écrites par lots toutes les `flush_interval` secondes, et à
+    l'arrêt. Un chat évincé de la mémoire est rechargé depuis le backend à son prochain message.
+
+    Résumé glissant : au-delà de `summary_trigger` tours, `schedule_summary` condense en tâche de fond
+    tous les tours sauf les `verbatim_turns` derniers dans le résumé du chat, puis les retire."""
+
+    def __init__(self, backend=None, max_chats: int = HISTORY_CACHE_CHATS, idle_ttl: float = HISTORY_IDLE_TTL,
+                 flush_interval: float = HISTORY_FLUSH_INTERVAL, summary_trigger: int = HISTORY_SUMMARY_TRIGGER,
+                 verbatim_turns: int = HISTORY_VERBATIM_TURNS):
+        self.backend = backend
+        self.max_chats = max_chats
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self.summary_trigger = summary_trigger
+        self.verbatim_turns = verbatim_turns
+        self._chats: OrderedDict[int, ChatHistory] = OrderedDict()
+        self._pending: dict[int, tuple] = {}
+        self._summarizing: dict[int, asyncio.Task] = {}
+        self._flush_task: asyncio.Task | None = None
+        self.stats = {"loads": 0, "evicted": 0, "flushes": 0, "written": 0, "summaries": 0, "summary_failures": 0}
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    async def _entry(self, chat_id: int) -> ChatHistory:
+        history = self._chats.get(chat_id)
+        if history is None:
+            turns, summary = [], ""
+            if chat_id in self._pending:  # évincé de la mémoire avant d'avoir été écrit
+                turns, summary = self._pending[chat_id]
+            elif self.backend:
+                self.stats["loads"] += 1
+                try: turns, summary = await asyncio.to_thread(self.backend.load, chat_id)
+                except Exception as e: logger.error(f"Lecture de l'historique du chat {chat_id} impossible: {e}")
+            history = self._chats.setdefault(chat_id, ChatHistory(turns, summary))
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+                self.stats["evicted"] += 1
+        self._chats.move_to_end(chat_id)
+        history.last_used = time.monotonic()
+        return history
+
+    def _changed(self, chat_id: int, history: ChatHistory):
+        if self.backend: self._pending[chat_id] = (tuple(history.turns), history.summary)
+
+    async def messages(self, chat_id: int) -> list[dict]:
+        return (await self._entry(chat_id)).messages()
+
+    async def summary(self, chat_id: int) -> str:
+        return (await self._entry(chat_id)).summary
+
+    async def append(self, chat_id: int, role: str, text: str):
+        history = await self._entry(chat_id)
+        history.append(role, text)
+        self._changed(chat_id, history)
+
+    async def pop_last(self, chat_id: int, role: str | None = None):
+        history = await self._entry(chat_id)
+        if history.turns and (role is None or history.turns[-1][0] == role):
+            history.turns.pop()
+            self._changed(chat_id, history)
+
+    async def clear(self, chat_id: int):
+        history = await self._entry(chat_id)
+        history.turns.clear()
+        history.summary = ""
+        history.generation += 1
+        self._changed(chat_id, history)
+
+    def schedule_summary(self, chat_id: int, summarize):
+        """Lance `summarize(résumé, tours) -> nouveau résumé | None` en tâche de fond si le chat a
+        dépassé `summary_trigger` tours (au plus un résumé en cours par chat)."""
+        history = self._chats.get(chat_id)
+        if not history or len(history.turns) <= self.summary_trigger or chat_id in self._summarizing: return
+        task = asyncio.create_task(self._summarize(chat_id, history, summarize))
+        self._summarizing[chat_id] = task
+        task.add_done_callback(lambda _: self._summarizing.pop(chat_id, None))
+
+    async def _summarize(self, chat_id: int, history: ChatHistory, summarize):
+        older = history.turns[:-self.verbatim_turns] if self.verbatim_turns else list(history.turns)
+        generation = history.generation
+        try:
+            new_summary = await summarize(history.summary, older)
+        except Exception as e:
+            logger.warning(f"Résumé de l'historique du chat {chat_id} impossible: {e}")
+            new_summary = None
+        if not new_summary:
+            self.stats["summary_failures"] += 1
+            return
+        if self._chats.get(chat_id) is not history: return  # évincé et rechargé entre-temps
+        if history.generation != generation: return  # effacé (/start) pendant le résumé
+        summarized = {id(turn) for turn in older}
+        history.turns = [turn for turn in history.turns if id(turn) not in summarized]
+        history.summary = new_summary[:HISTORY_SUMMARY_MAX_CHARS]
+        self._changed(chat_id, history)
+        self.stats["summaries"] += 1
+        logger.info(f"Historique du chat {chat_id} résumé: {len(older)} tours -> {len(history.summary)} caractères.")
+
+    def evict_idle(self) -> int:
+        cutoff = time.monotonic() - self.idle_ttl
+        idle = [chat_id for chat_id, history in self._chats.items() if history.last_used < cutoff]
+        for chat_id in idle: del self._chats[chat_id]
+        self.stats["evicted"] += len(idle)
+        return len(idle)
+
+    async def flush(self):
+        if not self._pending or not self.backend: return
+        pending, self._pending = self._pending, {}
+        try:
+            await asyncio.to_thread(self.backend.save_many, pending)
+        except Exception as e:
+            logger.error(f"Écriture des historiques impossible ({len(pending)} chats), nouvel essai au prochain lot: {e}")
+            for chat_id, turns in pending.items(): self._pending.setdefault(chat_id, turns)
+            return
+        self.stats["flushes"] += 1
+        self.stats["written"] += len(pending)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if self.idle_ttl > 0 and self.evict_idle():
+                logger.info(f"Historiques: {len(self._chats)} chats en mémoire ({self.stats}).")
+
+    def start(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            try: await self._flush_task
+            except asyncio.CancelledError: pass
+        self._flush_task = None
+        for task in list(self._summarizing.values()): task.cancel()
+        await self.flush()
+        if self.backend: self.backend.close()
+
+history_store = HistoryStore(SQLiteHistoryBackend(HISTORY_DB) if HISTORY_DB else None)
+
+class InFlightAbandoned(Exception):
+    """Le calcul partagé a été annulé avant d'aboutir : l'abonné doit relancer sa propre requête."""
+
+class SingleFlight:
+    """Partage un même calcul entre les requêtes identiques en cours (une seule requête Gemini)."""
+
+    def __init__(self):
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self.shared = 0
+
+    async def run(self, key: str, factory):
+        while (future := self._in_flight.get(key)) is not None:
+            self.shared += 1
+            logger.info(f"Requête identique déjà en cours, résultat partagé ({self.shared} depuis le démarrage).")
+            try:
+                return await asyncio.shield(future)
+            except InFlightAbandoned:
+                logger.info("Requête partagée annulée par son initiateur, relance de la requête.")
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await factory()
+        except BaseException as e:
+            # Une annulation ne concerne que l'initiateur : les abonnés reçoivent InFlightAbandoned et relancent.
+            future.set_exception(InFlightAbandoned() if isinstance(e, asyncio.CancelledError) else e)
+            future.exception()  # marque l'exception comme récupérée s'il n'y a aucun abonné
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._in_flight[key]
+
+class ChatCoalescer:
+    """Sérialise le traitement par chat et fusionne les messages texte envoyés en rafale.
+
+    Un message arrivé dans un chat inactif est traité aussitôt. Si une autre requête du chat est
+    en attente ou en cours, il attend `debounce` secondes ; seul le dernier arrivé traite alors le
+    lot (tous les messages en attente, joints), sous le verrou du chat."""
+
+    def __init__(self, debounce: float = CHAT_DEBOUNCE):
+        self.debounce = debounce
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._pending: dict[int, list[str]] = {}
+        self._sequence: dict[int, int] = {}
+        self._users: dict[int, int] = {}
+        self.merged = 0
+
+    def _enter(self, chat_id: int) -> asyncio.Lock:
+        self._users[chat_id] = self._users.get(chat_id, 0) + 1
+        return self._locks.setdefault(chat_id, asyncio.Lock())
+
+    def _exit(self, chat_id: int):
+        self._users[chat_id] -= 1
+        if not self._users[chat_id]:
+            for state in (self._users, self._locks, self._pending, self._sequence):
+                state.pop(chat_id, None)
+
+    @contextlib.asynccontextmanager
+    async def batch(self, chat_id: int, text: str):
+        """Fournit le texte fusionné à traiter, ou None si un message plus récent s'en charge."""
+        lock = self._enter(chat_id)
+        try:
+            self._pending.setdefault(chat_id, []).append(text)
+            sequence = self._sequence[chat_id] = self._sequence.get(chat_id, 0) + 1
+            if self.debounce > 0 and self._users[chat_id] > 1: await asyncio.sleep(self.debounce)
+            if self._sequence[chat_id] != sequence:
+                yield None
+                return
+            async with lock:
+                texts = self._pending.pop(chat_id, [])
+                if len(texts) > 1:
+                    self.merged += len(texts) - 1
+                    logger.info(f"{len(texts)} messages rapprochés fusionnés en une requête (Chat {chat_id}).")
+                yield "\n".join(texts) if texts else None
+        finally:
+            self._exit(chat_id)
+
+    @contextlib.asynccontextmanager
+    async def serialized(self, chat_id: int):
+        lock = self._enter(chat_id)
+        try:
+            async with lock:
+                yield
+        finally:
+            self._exit(chat_id)
+
+in_flight_requests = SingleFlight()
+chat_coalescer = ChatCoalescer()
+
+class TokenBucket:
+    """Seau à jetons : `rate` jetons par seconde, au plus `capacity` en réserve."""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class OutboundRequest:
+    __slots__ = ("bot", "method", "chat_id", "kwargs", "kind", "future", "context", "queued_at", "attempts")
+
+    def __init__(self, bot, method: str, chat_id: int, kwargs: dict, kind: str, future: asyncio.Future):
+        self.bot = bot
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.kind = kind
+        self.future = future
+        self.context = contextvars.copy_context()  # trace de la mise à jour d'origine
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+    @property
+    def edit_key(self) -> tuple[int, int] | None:
+        return (self.chat_id, self.kwargs["message_id"]) if self.method == "edit_message_text" else None
+
+def _copy_outcome(source: asyncio.Future, target: asyncio.Future):
+    if target.done(): return
+    if source.cancelled(): target.cancel()
+    elif source.exception(): target.set_exception(source.exception())
+    else: target.set_result(source.result())
+
+class TelegramSendQueue:
+    """File unique des envois et éditions vers Telegram.
+
+    Un seau à jetons global (TELEGRAM_GLOBAL_RATE/s, partagé en parts égales entre les WORKERS) et un par chat (TELEGRAM_CHAT_RATE/s, rafales de
+    TELEGRAM_CHAT_BURST) espacent les appels ; les chats sont servis à tour de rôle, et les requêtes d'un
+    même chat une par une, dans l'ordre. Sur RetryAfter, la requête est remise en tête et le chat mis en
+    pause le temps demandé. Une édition encore en file est remplacée par la suivante du même message :
+    seule la dernière version est envoyée. Chaque appel renvoie un future du résultat : l'attendre ou non
+    (`detach`) est au choix de l'appelant."""
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE / max(1, WORKERS), chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: int = TELEGRAM_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chats: dict[int, deque[OutboundRequest]] = {}
+        self._buckets: dict[int, TokenBucket] = {}
+        self._paused_until: dict[int, float] = {}
+        self._busy: set[int] = set()
+        self._pending_edits: dict[tuple[int, int], OutboundRequest] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._wakeup: asyncio.Event | None = None
+        self._dispatcher: asyncio.Task | None = None
+        self.stats = {"sent": 0, "edited": 0, "coalesced": 0, "retry_after": 0, "failed": 0}
+
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self._chats.values()) + len(self._busy)
+
+    def submit(self, bot, method: str, chat_id: int, kind: str = "", **kwargs) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = loop.create_task(self._run())
+        request = OutboundRequest(bot, method, chat_id, kwargs, kind, loop.create_future())
+        key = request.edit_key
+        if key and key in self._pending_edits:
+            superseded = self._pending_edits[key]
+            superseded.kwargs, superseded.kind = kwargs, kind
+            self.stats["coalesced"] += 1
+            return superseded.future
+        if key: self._pending_edits[key] = request
+        self._chats.setdefault(chat_id, deque()).append(request)
+        self._wakeup.set()
+        return request.future
+
+    def send_message(self, bot, chat_id: int, text: str, kind: str = "", **kwargs) -> asyncio.Future:
+        return self.submit(bot, "send_message", chat_id, kind, text=text, **kwargs)
+
+    def edit_message_text(self, bot, chat_id: int, message_id: int, text: str, kind: str = "", **kwargs) -> asyncio.Future:
+        return self.submit(bot, "edit_message_text", chat_id, kind, message_id=message_id, text=text, **kwargs)
+
+    def reply(self, message, text: str, kind: str = "", **kwargs) -> asyncio.Future:
+        """`Message.reply_text` via la file : citation du message d'origine hors chats privés, comme PTB."""
+        if "reply_to_message_id" not in kwargs and message.chat.type != ChatType.PRIVATE:
+            kwargs["reply_to_message_id"] = message.message_id
+        return self.send_message(message.get_bot(), message.chat_id, text, kind, **kwargs)
+
+    @staticmethod
+    def detach(future: asyncio.Future) -> asyncio.Future:
+        """Envoi sans attente du résultat : un échec est seulement journalisé."""
+        def log_failure(done: asyncio.Future):
+            if not done.cancelled() and done.exception():
+                logger.warning(f"Envoi Telegram en arrière-plan échoué: {done.exception()}")
+        future.add_done_callback(log_failure)
+        return future
+
+    def spawn(self, coro) -> asyncio.Task:
+        """Tâche de suivi d'une réponse déjà en file (confirmation, repli) : le handler n'attend pas."""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None: bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._dispatch_ready()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+
+    def _dispatch_ready(self) -> float | None:
+        """Lance chaque requête en tête de file dont le chat et le seau global le permettent ;
+        renvoie le délai avant la prochaine possible (None : rien en attente)."""
+        now = time.monotonic()
+        next_delay = None
+        for chat_id in list(self._chats):
+            if chat_id in self._busy: continue
+            delay = max(self._paused_until.get(chat_id, 0.0) - now, self._bucket(chat_id).wait_time(now),
+                        self.global_bucket.wait_time(now))
+            if delay > 0:
+                next_delay = delay if next_delay is None else min(next_delay, delay)
+                continue
+            queue = self._chats.pop(chat_id)
+            request = queue.popleft()
+            if queue: self._chats[chat_id] = queue  # remis en fin : tourniquet entre chats
+            if request.edit_key: self._pending_edits.pop(request.edit_key, None)
+            self._paused_until.pop(chat_id, None)
+            self._bucket(chat_id).take(now)
+            self.global_bucket.take(now)
+            self._busy.add(chat_id)
+            task = request.context.run(asyncio.get_running_loop().create_task, self._send(request))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if len(self._buckets) > len(self._chats) + 1000:
+            self._buckets = {chat_id: bucket for chat_id, bucket in self._buckets.items()
+                             if chat_id in self._chats or chat_id in self._busy or not bucket.is_full(now)}
+        return next_delay
+
+    async def _send(self, request: OutboundRequest):
+        edit = request.method == "edit_message_text"
+        STAGE_SECONDS.labels("telegram_queue", request.kind).observe(time.monotonic() - request.queued_at)
+        try:
+            with trace_stage("telegram_edit" if edit else "telegram_send", request.kind):
+                result = await getattr(request.bot, request.method)(chat_id=request.chat_id, **request.kwargs)
+        except RetryAfter as e:
+            self.stats["retry_after"] += 1
+            request.attempts += 1
+            if request.attempts > TELEGRAM_RETRY_AFTER_LIMIT:
+                self.stats["failed"] += 1
+                if not request.future.done(): request.future.set_exception(e)
+                return
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else float(e.retry_after)
+            logger.warning(f"Flood control Telegram (Chat {request.chat_id}) : nouvel essai dans {delay:.0f}s ({request.attempts}/{TELEGRAM_RETRY_AFTER_LIMIT}).")
+            self._paused_until[request.chat_id] = time.monotonic() + delay
+            self._requeue(request)
+        except Exception as e:
+            self.stats["failed"] += 1
+            if not request.future.done(): request.future.set_exception(e)
+        else:
+            self.stats["edited" if edit else "sent"] += 1
+            if not request.future.done(): request.future.set_result(result)
+        finally:
+            self._busy.discard(request.chat_id)
+            self._wakeup.set()
+
+    def _requeue(self, request: OutboundRequest):
+        key = request.edit_key
+        newer = self._pending_edits.get(key) if key else None
+        if newer:  # une version plus récente attend déjà : l'ancienne n'est pas renvoyée
+            newer.future.add_done_callback(lambda done: _copy_outcome(done, request.future))
+            return
+        if key: self._pending_edits[key] = request
+        queue = self._chats.pop(request.chat_id, deque())
+        queue.appendleft(request)
+        self._chats[request.chat_id] = queue
+
+    async def drain(self):
+        while self._chats or self._busy or self._tasks:
+            await asyncio.sleep(0.05)
+
+    async def close(self, timeout: float = 10.0):
+        """Termine les envois en cours (au plus `timeout` secondes) puis arrête la file."""
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self.drain(), timeout)
+        for task in [self._dispatcher, *self._tasks]:
+            if task and not task.done(): task.cancel()
+        for queue in self._chats.values():
+            for request in queue:
+                if not request.future.done(): request.future.cancel()
+        self._chats.clear()
+        self._pending_edits.clear()
+        self._dispatcher = None
+
+telegram_sender = TelegramSendQueue()
+
+class StreamingReply:
+    """Affiche une réponse en cours de génération en éditant un seul message Telegram.
+
+    Les éditions sont espacées d'au moins `min_interval` secondes (limites de Telegram) ; chaque
+    version partielle passe par `markdown_to_telegram_html`. Sans message d'attente, le premier
+    fragment est envoyé en réponse puis édité ; cet envoi n'est pas attendu pendant que l'appel Gemini
+    occupe son créneau, `settle()` le récupère ensuite. L'édition finale reste à la charge de l'appelant."""
+
+    def __init__(self, bot, chat_id: int, reply_to_message_id: int, message=None, min_interval: float = STREAM_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.message = message
+        self.min_interval = min_interval
+        self.started_at = time.perf_counter()
+        self.first_visible_at: float | None = None
+        self.edits = 0
+        self._last_edit = 0.0
+        self._last_html = None
+        self._first_send: asyncio.Future | None = None
+
+    async def update(self, partial_md: str):
+        now = time.perf_counter()
+        if now - self._last_edit < self.min_interval or (self._first_send and not self.message): return
+        partial_html = markdown_to_telegram_html(partial_md)
+        if len(partial_html) + 2 > TELEGRAM_MAX_MESSAGE_LENGTH:
+            partial_html = split_telegram_html(partial_html, TELEGRAM_MAX_MESSAGE_LENGTH - 2)[0]  # la suite viendra dans d'autres messages
+        if not partial_html or partial_html == self._last_html: return
+        self._last_edit = now
+        try:
+            if self.message:
+                # Sans attendre Telegram : une édition encore en file est remplacée par la suivante.
+                telegram_sender.detach(telegram_sender.edit_message_text(
+                    self.bot, self.chat_id, self.message.message_id, f"{partial_html} …", kind="partial",
+                    parse_mode=ParseMode.HTML, disable_web_page_preview=True))
+            else:
+                self._first_send = telegram_sender.send_message(
+                    self.bot, self.chat_id, f"{partial_html} …", kind="partial", reply_to_message_id=self.reply_to_message_id,
+                    parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+                self._first_send.add_done_callback(self._first_sent)
+        except Exception as e:
+            logger.warning(f"Édition progressive ignorée (Chat {self.chat_id}): {e}")
+            return
+        self._last_html = partial_html
+        self.edits += 1
+        if self.first_visible_at is None and self.message:
+            self._visible(now)
+
+    def _visible(self, now: float):
+        self.first_visible_at = now
+        logger.info(f"Premier fragment visible après {now - self.started_at:.2f}s (Chat {self.chat_id}).")
+
+    def _first_sent(self, future: asyncio.Future):
+        if future.cancelled() or future.exception():
+            logger.warning(f"Édition progressive ignorée (Chat {self.chat_id}): {None if future.cancelled() else future.exception()}")
+            self._first_send = None  # le fragment suivant retente l'envoi
+            self._last_html = None
+            self.edits -= 1
+            return
+        self.message = future.result()
+        self._visible(time.perf_counter())
+
+    async def settle(self):
+        """Message affichant la réponse partielle (ou None), une fois le premier envoi terminé."""
+        if self._first_send and not self.message: await asyncio.wait({self._first_send})
+        return self.message
+
+def queue_html_chunks(bot, chat_id: int, chunks: list[str], message=None, reply_to_message_id: int | None = None) -> list[asyncio.Future]:
+    """Met en file une réponse découpée par `split_telegram_html`. Le premier morceau remplace le message
+    d'attente `message` (ou répond au message de l'utilisateur) ; les suivants sont envoyés à la suite,
+    la file gardant l'ordre des envois du chat."""
+    options = {"parse_mode": ParseMode.HTML, "disable_web_page_preview": True}
+    if message:
+        first = telegram_sender.edit_message_text(bot, chat_id, message.message_id, chunks[0], kind="final", **options)
+    else:
+        first = telegram_sender.send_message(bot, chat_id, chunks[0], kind="final", reply_to_message_id=reply_to_message_id, **options)
+    return [first] + [telegram_sender.send_message(bot, chat_id, chunk, kind="final", **options) for chunk in chunks[1:]]
+
+async def wait_html_chunks(replies: list[asyncio.Future], chat_id: int, edited_first: bool) -> list[tuple[int, BaseException]]:
+    """Attend les envois de `queue_html_chunks` et renvoie les morceaux en échec (position, erreur).
+    Une édition finale identique au dernier fragment affiché n'en est pas un."""
+    results = await asyncio.gather(*replies, return_exceptions=True)
+    failures = []
+    for position, result in enumerate(results):
+        if not isinstance(result, BaseException): continue
+        if position == 0 and edited_first and isinstance(result, BadRequest) and "message is not modified" in str(result).lower():
+            logger.debug(f"Premier morceau identique au dernier fragment affiché (Chat {chat_id}).")
+            continue
+        failures.append((position, result))
+    return failures
+
+HTML_LINK_RE = re.compile(r'<a href="([^"]*)">(.*?)</a>', re.DOTALL)
+
+def html_chunk_to_plain_texts(chunk: str, limit: int = TELEGRAM_MAX_MESSAGE_LENGTH) -> list[str]:
+    """Texte brut d'un morceau HTML (liens sous la forme « texte (url) »), redécoupé pour tenir dans `limit`."""
+    plain = HTML_CHUNK_TAG_RE.sub("", HTML_LINK_RE.sub(lambda m: f"{m.group(2)} ({html.unescape(m.group(1))})", chunk))
+    # Découpe sur le texte échappé : aucune entité n'est coupée, et chaque morceau raccourcit une fois déséchappé.
+    return [html.unescape(piece) for piece in split_telegram_html(html.escape(html.unescape(plain), quote=False), limit)]
+
 async def process_query_and_respond(
     user_query: str,
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
-    processing_message = None
-):
+    processing_message = None,
+    voice_part: dict | None = None
+) -> str | None:
+    """Avec `voice_part` (vocaux courts, cache de contexte actif), `user_query` est ignorée : la transcription
+    et la réponse sont obtenues en un seul appel à Gemini. Renvoie la requête traitée (la transcription
+    dans ce cas), ou None."""
     chat_id = update.effective_chat.id
     message_id = update.effective_message.id
     user_info = update.effective_user
     username = user_info.username or user_info.first_name
 
-    if not user_query or user_query.isspace():
+    if voice_part is None and (not user_query or user_query.isspace()):
         logger.warning(f"Requête vide reçue de {username} (Chat ID: {chat_id}).")
         error_text = "Hmm, votre message semble vide. Que puis-je faire pour vous ?"
         try:
             if processing_message:
-                await context.bot.edit_message_text(chat_id=chat_id, message_id=processing_message.message_id, text=error_text)
+                await telegram_sender.edit_message_text(context.bot, chat_id, processing_message.message_id, error_text)
             else:
-                await update.effective_message.reply_text(error_text, reply_to_message_id=message_id)
+                await telegram_sender.reply(update.effective_message, error_text, reply_to_message_id=message_id)
         except Exception as e:
             logger.error(f"Impossible d'envoyer le message 'requête vide' à {username}: {e}")
-        return
-
-    logger.info(f"Traitement de la requête de {username} (Chat ID: {chat_id}): '{user_query[:100]}...'")
+        return None
 
-    chat_history = context.chat_data.setdefault('history', deque(maxlen=HISTORY_LENGTH))
-    if not chat_history or chat_history[-1].get("role") != "user" or chat_history[-1].get("parts", [""])[0] != user_query:
-         chat_history.append({"role": "user", "parts": [user_query]})
-         logger.debug(f"Requête ajoutée à l'historique (Chat {chat_id}). Nouvelle taille: {len(chat_history)}")
+    started = time.perf_counter()
+    answer_path = "voice" if voice_part is not None else "gemini"
+    history_list = await history_store.messages(chat_id)
+    history_summary = await history_store.summary(chat_id)
+    if voice_part is not None:
+        logger.info(f"Traitement du message vocal court de {username} (Chat ID: {chat_id}) en un seul appel Gemini.")
+    elif not history_list or history_list[-1]["role"] != "user" or history_list[-1]["parts"][0] != user_query:
+         await history_store.append(chat_id, "user", user_query)
+         history_list.append({"role": "user", "parts": [user_query]})
+         logger.debug(f"Requête ajoutée à l'historique (Chat {chat_id}). Nouvelle taille: {len(history_list)}")
     else:
          logger.debug(f"Requête identique à la précédente, non ajoutée à l'historique (Chat {chat_id}).")
-    history_list = list(chat_history)
+    if voice_part is None:
+        logger.info(f"Traitement de la requête de {username} (Chat ID: {chat_id}): '{user_query[:100]}...'")
 
-    static_channel_context, file_read_error_msg = read_markdown_export(MARKDOWN_EXPORT_PATH)
+    with trace_stage("catalog"):
+        static_channel_context, file_read_error_msg = await catalog_cache.get()
     if not static_channel_context:
          error_text = file_read_error_msg or "Erreur critique : impossible d'accéder aux données nécessaires."
          logger.error(f"Échec lecture contexte pour {username}: {error_text}")
-         if chat_history and chat_history[-1].get("role") == "user":
-             chat_history.pop()
+         if voice_part is None:
+             await history_store.pop_last(chat_id, role="user")
          try:
              if processing_message:
-                 await context.bot.edit_message_text(chat_id=chat_id, message_id=processing_message.message_id, text=error_text)
+                 await telegram_sender.edit_message_text(context.bot, chat_id, processing_message.message_id, error_text)
              else:
-                 await update.effective_message.reply_text(error_text, reply_to_message_id=message_id)
+                 await telegram_sender.reply(update.effective_message, error_text, reply_to_message_id=message_id)
          except Exception as e:
              logger.error(f"Impossible d'envoyer l'erreur de lecture de fichier à {username}: {e}")
-         return
-
-    gemini_response_md = await ask_gemini(user_query, static_channel_context, history_list)
-
-    is_error_response = gemini_response_md.lower().startswith(("désolé", "erreur", "hmm", "je ne peux pas", "impossible"))
-    if not is_error_response and gemini_response_md and not gemini_response_md.isspace():
-        chat_history.append({"role": "model", "parts": [gemini_response_md]})
-        context.chat_data['history'] = chat_history
-        logger.info(f"Réponse modèle ajoutée à l'historique (Chat {chat_id}). Taille: {len(chat_history)}")
+         return None
+
+    snapshot = catalog_cache.snapshot
+    if voice_part is not None:
+        streaming = StreamingReply(context.bot, chat_id, message_id, processing_message) if GEMINI_STREAMING else None
+        # Pas de ciblage possible sans le texte : catalogue complet, dont le préfixe est servi par le cache de contexte.
+        gemini_response_md = await ask_gemini(VOICE_QUERY_PLACEHOLDER, static_channel_context, history_list,
+                                              catalog_version=snapshot.version if snapshot else None,
+                                              on_partial=streaming.update if streaming else None,
+                                              user_id=user_info.id, audio_part=voice_part, history_summary=history_summary)
+        if streaming and await streaming.settle(): processing_message = streaming.message
+        user_query, gemini_response_md = split_voice_transcript(gemini_response_md)
+        if user_query:
+            logger.info(f"Texte transcrit (chemin rapide) pour {username}: '{user_query[:100]}...'")
+            await history_store.append(chat_id, "user", user_query)
+            if not is_error_response(gemini_response_md):
+                await response_cache.put(response_cache.make_key(user_query, history_list + [{"role": "user", "parts": [user_query]}],
+                                                                 snapshot.version if snapshot else None, history_summary), gemini_response_md)
+        elif not is_error_response(gemini_response_md):
+            await history_store.append(chat_id, "user", "(Message vocal)")
+    else:
+        fast_entry = plain_title_match(user_query, snapshot.index if snapshot else None) if FAST_PATH_ENABLED else None
+        if fast_entry:
+            with trace_stage("fast_path"):
+                gemini_response_md = render_catalog_answer(fast_entry)
+            answer_path = "fast"
+            logger.info(f"Réponse construite depuis le catalogue, sans Gemini, pour {username}: '{fast_entry.title}'.")
+        else:
+            cache_key = response_cache.make_key(user_query, history_list, snapshot.version if snapshot else None, history_summary)
+            gemini_response_md = await response_cache.get(cache_key)
+            if gemini_response_md is not None:
+                answer_path = "cache"
+                logger.info(f"Réponse servie depuis le cache pour {username} (taux de succès: {response_cache.hit_rate():.0%}).")
+            else:
+                streaming = StreamingReply(context.bot, chat_id, message_id, processing_message) if GEMINI_STREAMING else None
+
+                async def generate_response() -> str:
+                    try:
+                        with trace_stage("retrieval"):
+                            retrieved_context = await retrieve_catalog_context(user_query, history_list, snapshot.index if snapshot else None,
+                                                                               snapshot.embeddings if snapshot else None, user_info.id)
+                    except Exception as e:
+                        logger.error(f"Erreur sélection du catalogue pour {username}, catalogue complet envoyé: {e}", exc_info=True)
+                        retrieved_context = None
+                    if retrieved_context:
+                        logger.info(f"Contexte ciblé pour {username}: {len(retrieved_context)} chars (catalogue complet: {len(static_channel_context)} chars).")
+                    response_md = await ask_gemini(user_query, retrieved_context or static_channel_context, history_list,
+                                                   catalog_version=None if retrieved_context or not snapshot else snapshot.version,
+                                                   on_partial=streaming.update if streaming else None, user_id=user_info.id,
+                                                   history_summary=history_summary)
+                    await response_cache.put(cache_key, response_md)
+                    return response_md
+
+                gemini_response_md = await in_flight_requests.run(cache_key, generate_response)
+                if streaming and await streaming.settle():
+                    processing_message = streaming.message
+                    logger.info(f"Réponse diffusée en {streaming.edits} éditions pour {username} (Chat ID: {chat_id}).")
+
+    if not is_error_response(gemini_response_md):
+        await history_store.append(chat_id, "model", gemini_response_md)
+        logger.info(f"Réponse modèle ajoutée à l'historique (Chat {chat_id}).")
     else:
         logger.info(f"Réponse modèle (erreur ou vide) non ajoutée à l'historique (Chat {chat_id}). Réponse: '{gemini_response_md[:100]}...'")
 
-    gemini_response_html = markdown_to_telegram_html(gemini_response_md)
+    with trace_stage("render"):
+        gemini_response_html = markdown_to_telegram_html(gemini_response_md)
+        chunks = split_telegram_html(gemini_response_html or "...")
 
-    try:
-        if processing_message:
-            await context.bot.edit_message_text(
-                chat_id=chat_id, message_id=processing_message.message_id,
-                text=gemini_response_html or "...", parse_mode=ParseMode.HTML,
-                disable_web_page_preview=True )
-            logger.info(f"Réponse éditée envoyée à {username} (Chat ID: {chat_id})")
-        else:
-            await update.effective_message.reply_html(
-                text=gemini_response_html or "...", reply_to_message_id=message_id,
-                disable_web_page_preview=True )
-            logger.info(f"Nouvelle réponse envoyée à {username} (Chat ID: {chat_id})")
-    except BadRequest as e:
-        logger.error(f"Erreur BadRequest lors de l'envoi HTML à {username}: {e}. Tentative avec Markdown brut.")
-        fallback_text = gemini_response_md + "\n\n_(Erreur d'affichage : formatage complexe non supporté)_"
-        await send_fallback_response(context, chat_id, processing_message, message_id, fallback_text, "", username)
-    except Exception as e:
-        logger.error(f"Erreur inattendue lors de l'envoi de la réponse à {username}: {e}", exc_info=True)
-        fallback_text = gemini_response_md + "\n\n_(Erreur technique lors de l'affichage de la réponse)_"
-        await send_fallback_response(context, chat_id, processing_message, message_id, fallback_text, "", username)
+    replies = queue_html_chunks(context.bot, chat_id, chunks, processing_message, reply_to_message_id=message_id)
+
+    async def confirm_delivery():
+        try:
+            await deliver()
+        finally:
+            # Mesurés une fois la réponse remise (ou abandonnée) : durée et trace incluent les envois Telegram.
+            ANSWER_SECONDS.labels(answer_path).observe(time.perf_counter() - started)
+            logger.info(f"Trace requête ({answer_path}, Chat {chat_id}): {trace_summary()}")
+
+    async def deliver():
+        failures = await wait_html_chunks(replies, chat_id, processing_message is not None)
+        if not failures:
+            logger.info(f"Réponse envoyée à {username} (Chat ID: {chat_id}) en {len(chunks)} message(s).")
+            return
+        for position, e in failures:
+            if isinstance(e, BadRequest):
+                logger.error(f"Erreur BadRequest lors de l'envoi HTML du morceau {position + 1}/{len(chunks)} à {username}: {e}. Renvoi en texte brut.")
+            else:
+                logger.error(f"Erreur inattendue lors de l'envoi du morceau {position + 1}/{len(chunks)} à {username}: {e}", exc_info=e)
+        error_indicator = ("(Erreur d'affichage : formatage complexe non supporté)" if any(isinstance(e, BadRequest) for _, e in failures)
+                           else "(Erreur technique lors de l'affichage de la réponse)")
+        await send_fallback_response(context, chat_id, processing_message if failures[0][0] == 0 else None, message_id,
+                                     [chunks[position] for position, _ in failures], error_indicator, username,
+                                     reply=failures[0][0] == 0)
+
+    telegram_sender.spawn(confirm_delivery())  # réponse en file : le handler rend la main sans attendre Telegram
+    if HISTORY_SUMMARY: history_store.schedule_summary(chat_id, summarize_history)  # après l'envoi : aucune latence ajoutée
+    return user_query
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     chat_id = update.effective_chat.id
     username = user.username or user.first_name
     logger.info(f"Commande /start reçue de {username} (Chat ID: {chat_id})")
-    if 'history' in context.chat_data:
-        context.chat_data['history'].clear()
-        logger.info(f"Historique de conversation effacé pour {username} (Chat ID: {chat_id})")
+    await history_store.clear(chat_id)
+    logger.info(f"Historique de conversation effacé pour {username} (Chat ID: {chat_id})")
     text = (f"👋 Bonjour {user.mention_html()} !\n\n"
             f"Je suis <b>{BOT_NAME}</b>, votre assistant expert pour rechercher des animes dans le catalogue de <b>{MAIN_CHANNEL_NAME}</b> ({CREATOR_PSEUDO}).\n\n"
             "Comment puis-je vous aider ?\n"
@@ -421,7 +3068,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 [InlineKeyboardButton("📂 Collection Complète", url=COLLECTION_LINK)],
                 [InlineKeyboardButton("❓ Aide (/help)", callback_data="help_callback")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    try: await update.message.reply_html(text, reply_markup=reply_markup)
+    try: await telegram_sender.reply(update.message, text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
     except Exception as e: logger.error(f"Erreur envoi message /start à {username}: {e}")
 
 async def help_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -465,14 +3112,14 @@ Je suis votre expert pour explorer le catalogue d'animes de <a href="{MAIN_CHANN
                 [InlineKeyboardButton("📂 Collection Complète", url=COLLECTION_LINK)]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     try:
-        await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+        await telegram_sender.send_message(context.bot, chat_id, text, reply_markup=reply_markup, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
     except BadRequest as e:
          logger.error(f"Erreur BadRequest envoi aide HTML: {e}. Fallback texte.")
          fallback_text = f"Aide {BOT_NAME}: Recherche animes (noms variés, image, vocal) dans catalogue {MAIN_CHANNEL_NAME}. Recommandations possibles. Liens: Créateur {CREATOR_LINK}, Catalogue {MAIN_CHANNEL_LINK}, Collection {COLLECTION_LINK}."
-         await context.bot.send_message(chat_id=chat_id, text=fallback_text)
+         await telegram_sender.send_message(context.bot, chat_id, fallback_text)
     except Exception as e:
          logger.error(f"Erreur générale envoi aide: {e}")
-         await context.bot.send_message(chat_id=chat_id, text="Impossible d'afficher l'aide pour le moment.")
+         await telegram_sender.send_message(context.bot, chat_id, "Impossible d'afficher l'aide pour le moment.")
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.message; voice = message.voice
@@ -481,104 +3128,612 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     logger.info(f"Message vocal reçu de {username} (Chat ID: {chat_id}, Durée: {voice.duration}s, Taille: {voice.file_size} octets)")
     if voice.file_size > MAX_VOICE_SIZE:
         logger.warning(f"Message vocal de {username} trop volumineux ({voice.file_size} > {MAX_VOICE_SIZE})")
-        await message.reply_text(f"Désolé, ce message vocal est trop volumineux (max {MAX_VOICE_SIZE // (1024*1024)} Mo).")
+        await telegram_sender.reply(message, f"Désolé, ce message vocal est trop volumineux (max {MAX_VOICE_SIZE // (1024*1024)} Mo).")
+        return
+    transcribed_text = await voice_cache.get(voice.file_unique_id, count_miss=False)
+    if transcribed_text:
+        logger.info(f"Message vocal de {username} déjà transcrit (file_unique_id), téléchargement évité.")
+    elif gemini_scheduler.overloaded():
+        logger.warning(f"Message vocal de {username} refusé: file Gemini pleine.")
+        await telegram_sender.reply(message, BUSY_MESSAGE)
         return
     processing_message = None
-    try: processing_message = await message.reply_text("🗣️ Traitement de votre message vocal...")
+    try: processing_message = await telegram_sender.reply(message, "🗣️ Traitement de votre message vocal...")
     except Exception as e: logger.error(f"Impossible d'envoyer le message 'Traitement vocal...' à {username}: {e}")
     try:
-        voice_file = await voice.get_file()
-        voice_data = bytes(await voice_file.download_as_bytearray())
-        logger.info(f"Téléchargement audio OK ({len(voice_data)} octets) pour {username}.")
-        transcribed_text = await transcribe_voice(voice_data)
+        if not transcribed_text:
+            async with media_downloader.fetch(await voice.get_file(), MAX_VOICE_SIZE) as (voice_data, voice_digest):
+                logger.info(f"Téléchargement audio OK ({len(voice_data)} octets) pour {username}.")
+                content_key = voice_cache.content_key(voice_digest)
+                transcribed_text = await voice_cache.get(content_key)
+                if transcribed_text: await voice_cache.put((voice.file_unique_id,), transcribed_text)
+                else:
+                    voice_data, mime_type = await preprocess_voice(voice_data)
+                    snapshot = catalog_cache.snapshot
+                    # Un seul appel seulement si le catalogue complet est servi par le cache de contexte ; sinon,
+                    # transcription d'abord, puis chemin rapide / ciblage comme pour un message texte.
+                    if voice.duration <= VOICE_FAST_PATH_MAX_DURATION and gemini_context_cache.available(snapshot.version if snapshot else None):
+                        async with chat_coalescer.serialized(chat_id):
+                            transcribed_text = await process_query_and_respond(
+                                None, update, context, processing_message, voice_part={"mime_type": mime_type, "data": voice_data})
+                        await voice_cache.put((voice.file_unique_id, content_key), transcribed_text)
+                        return
+                    transcribed_text = await transcribe_voice(voice_data, user_id=user_info.id, mime_type=mime_type)
+                    await voice_cache.put((voice.file_unique_id, content_key), transcribed_text)
+                del voice_data
+        logger.info(f"Cache de transcriptions: taux de succès {voice_cache.hit_rate():.0%}")
         if transcribed_text:
             logger.info(f"Texte transcrit pour {username}: '{transcribed_text[:100]}...'")
-            await process_query_and_respond(transcribed_text, update, context, processing_message)
+            async with chat_coalescer.serialized(chat_id):
+                await process_query_and_respond(transcribed_text, update, context, processing_message)
         else:
             logger.warning(f"Échec de la transcription pour {username} (Chat ID: {chat_id}).")
             error_text = "Désolé, je n'ai pas pu comprendre ou traiter ce message vocal. Veuillez réessayer ou envoyer un message texte."
-            if processing_message: await context.bot.edit_message_text(chat_id=chat_id, message_id=processing_message.message_id, text=error_text)
-            else: await message.reply_text(error_text, reply_to_message_id=message.message_id)
+            if processing_message: await telegram_sender.edit_message_text(context.bot, chat_id, processing_message.message_id, error_text)
+            else: await telegram_sender.reply(message, error_text, reply_to_message_id=message.message_id)
+    except GeminiBusyError as e:
+        logger.warning(f"Message vocal de {username} non traité, Gemini saturé: {e}")
+        try:
+            if processing_message: await telegram_sender.edit_message_text(context.bot, chat_id, processing_message.message_id, BUSY_MESSAGE)
+            else: await telegram_sender.reply(message, BUSY_MESSAGE, reply_to_message_id=message.message_id)
+        except Exception as send_e: logger.error(f"Impossible d'envoyer le message 'occupé' à {username}: {send_e}")
     except Exception as e:
         logger.error(f"Erreur générale lors du traitement du message vocal de {username}: {e}", exc_info=True)
         error_text = "Une erreur inattendue est survenue lors du traitement de votre message vocal."
         try:
-            if processing_message: await context.bot.edit_message_text(chat_id=chat_id, message_id=processing_message.message_id, text=error_text)
-            else: await message.reply_text(error_text, reply_to_message_id=message.message_id)
+            if processing_message: await telegram_sender.edit_message_text(context.bot, chat_id, processing_message.message_id, error_text)
+            else: await telegram_sender.reply(message, error_text, reply_to_message_id=message.message_id)
         except Exception as send_e: logger.error(f"Impossible d'envoyer l'erreur de traitement vocal à {username}: {send_e}")
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.message
     if not message.photo: return
-    photo = message.photo[-1]
+    photo = pick_photo_size(message.photo)
     user_info = update.effective_user; username = user_info.username or user_info.first_name
     chat_id = update.effective_chat.id
-    logger.info(f"Photo reçue de {username} (Chat ID: {chat_id}, Taille: {photo.file_size} octets)")
+    logger.info(f"Photo reçue de {username} (Chat ID: {chat_id}, Version: {photo.width}x{photo.height}, Taille: {photo.file_size} octets)")
     if photo.file_size > MAX_IMAGE_SIZE:
         logger.warning(f"Photo de {username} trop volumineuse ({photo.file_size} > {MAX_IMAGE_SIZE})")
-        await message.reply_text(f"Désolé, cette image est trop volumineuse (max {MAX_IMAGE_SIZE // (1024*1024)} Mo).")
+        await telegram_sender.reply(message, f"Désolé, cette image est trop volumineuse (max {MAX_IMAGE_SIZE // (1024*1024)} Mo).")
+        return
+    identified_query = await image_cache.lookup_file_id(photo.file_unique_id)
+    if identified_query:
+        logger.info(f"Image de {username} déjà identifiée (file_unique_id), téléchargement évité.")
+    elif gemini_scheduler.overloaded():
+        logger.warning(f"Photo de {username} refusée: file Gemini pleine.")
+        await telegram_sender.reply(message, BUSY_MESSAGE)
         return
     processing_message = None
-    try: processing_message = await message.reply_text("🖼️ Analyse de l'image...")
+    try: processing_message = await telegram_sender.reply(message, "🖼️ Analyse de l'image...")
     except Exception as e: logger.error(f"Impossible d'envoyer le message 'Analyse image...' à {username}: {e}")
     try:
-        image_file = await photo.get_file()
-        image_data = bytes(await image_file.download_as_bytearray())
-        logger.info(f"Téléchargement image OK ({len(image_data)} octets) pour {username}.")
-        identified_query = await identify_image_anime(image_data)
+        if not identified_query:
+            async with media_downloader.fetch(await photo.get_file(), MAX_IMAGE_SIZE) as (image_data, _):
+                logger.info(f"Téléchargement image OK ({len(image_data)} octets) pour {username}.")
+                identified_query, image_hash = await image_cache.lookup_image(image_data)
+                if not identified_query:
+                    identified_query = await identify_image_anime(image_data, user_id=user_info.id)
+                # Aussi sur un quasi-doublon : le prochain renvoi de cette variante évitera le téléchargement.
+                if identified_query: await image_cache.store(photo.file_unique_id, image_hash, identified_query)
+                del image_data
+            logger.info(f"Cache d'images: taux de succès {image_cache.hit_rate():.0%} ({image_cache.stats})")
         if identified_query:
             logger.info(f"Anime identifié depuis l'image de {username}: '{identified_query}'")
             query_for_processing = identified_query
             history_note_query = f"(Image envoyée par l'utilisateur, identifiée comme : {identified_query})"
-            chat_history = context.chat_data.setdefault('history', deque(maxlen=HISTORY_LENGTH))
-            chat_history.append({"role": "user", "parts": [history_note_query]})
-            await process_query_and_respond(query_for_processing, update, context, processing_message)
+            async with chat_coalescer.serialized(chat_id):
+                await history_store.append(chat_id, "user", history_note_query)
+                await process_query_and_respond(query_for_processing, update, context, processing_message)
         else:
             logger.info(f"Impossible d'identifier un anime dans l'image de {username}.")
             error_text = "Désolé, je n'ai pas réussi à reconnaître un anime spécifique dans cette image. Vous pouvez essayer avec le nom ?"
-            if processing_message: await context.bot.edit_message_text(chat_id=chat_id, message_id=processing_message.message_id, text=error_text)
-            else: await message.reply_text(error_text, reply_to_message_id=message.message_id)
+            if processing_message: await telegram_sender.edit_message_text(context.bot, chat_id, processing_message.message_id, error_text)
+            else: await telegram_sender.reply(message, error_text, reply_to_message_id=message.message_id)
+    except GeminiBusyError as e:
+        logger.warning(f"Photo de {username} non traitée, Gemini saturé: {e}")
+        try:
+            if processing_message: await telegram_sender.edit_message_text(context.bot, chat_id, processing_message.message_id, BUSY_MESSAGE)
+            else: await telegram_sender.reply(message, BUSY_MESSAGE, reply_to_message_id=message.message_id)
+        except Exception as send_e: logger.error(f"Impossible d'envoyer le message 'occupé' à {username}: {send_e}")
     except Exception as e:
         logger.error(f"Erreur générale lors du traitement de la photo de {username}: {e}", exc_info=True)
         error_text = "Une erreur inattendue est survenue lors de l'analyse de l'image."
         try:
-            if processing_message: await context.bot.edit_message_text(chat_id=chat_id, message_id=processing_message.message_id, text=error_text)
-            else: await message.reply_text(error_text, reply_to_message_id=message.message_id)
+            if processing_message: await telegram_sender.edit_message_text(context.bot, chat_id, processing_message.message_id, error_text)
+            else: await telegram_sender.reply(message, error_text, reply_to_message_id=message.message_id)
         except Exception as send_e: logger.error(f"Impossible d'envoyer l'erreur de traitement photo à {username}: {send_e}")
 
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.edited_message:
         logger.info(f"Message édité ignoré de {update.effective_user.username or update.effective_user.first_name}")
         return
-    user_query = update.message.text
-    await process_query_and_respond(user_query, update, context, processing_message=None)
+    async with chat_coalescer.batch(update.effective_chat.id, update.message.text) as user_query:
+        if user_query is None: return
+        await process_query_and_respond(user_query, update, context, processing_message=None)
 
 async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     command = update.message.text
     username = update.effective_user.username or update.effective_user.first_name
     logger.info(f"Commande inconnue '{command}' reçue de {username}")
-    await update.message.reply_text("Désolé, je ne reconnais pas cette commande. Utilisez /help pour voir ce que je peux faire.")
+    await telegram_sender.reply(update.message, "Désolé, je ne reconnais pas cette commande. Utilisez /help pour voir ce que je peux faire.")
+
+async def send_fallback_response(context: ContextTypes.DEFAULT_TYPE, chat_id: int, processing_message, original_msg_id: int,
+                                 failed_chunks: list[str], error_indicator: str, username: str, reply: bool = True):
+    """Renvoie en texte brut les seuls morceaux HTML refusés, chacun redécoupé à la taille d'un message.
+    Le premier remplace `processing_message` s'il est fourni, sinon il répond au message d'origine si `reply`."""
+    logger.warning(f"Tentative d'envoi de réponse fallback à {username} (Chat ID: {chat_id}, {len(failed_chunks)} morceau(x)).")
+    texts = [text for chunk in failed_chunks[:-1] for text in html_chunk_to_plain_texts(chunk)]
+    texts += html_chunk_to_plain_texts(failed_chunks[-1] + (f"\n\n{html.escape(error_indicator, quote=False)}" if error_indicator else ""))
+    options = {"parse_mode": None, "disable_web_page_preview": True}
+    sends = []
+    for position, text in enumerate(texts):
+        if position == 0 and processing_message:
+            sends.append(telegram_sender.edit_message_text(context.bot, chat_id, processing_message.message_id, text, **options))
+        else:
+            reply_to = original_msg_id if position == 0 and reply else None
+            sends.append(telegram_sender.send_message(context.bot, chat_id, text, reply_to_message_id=reply_to, **options))
+    results = await asyncio.gather(*sends, return_exceptions=True)
+    final_e = next((result for result in results if isinstance(result, BaseException)), None)
+    if final_e is None:
+        logger.info(f"Réponse fallback envoyée avec succès à {username} ({len(texts)} message(s)).")
+        return
+    logger.error(f"ÉCHEC CRITIQUE : Impossible d'envoyer MÊME la réponse fallback à {username}: {final_e}", exc_info=final_e)
+    try:
+        await telegram_sender.send_message(context.bot, chat_id, "Désolé, une erreur est survenue lors de l'affichage de ma réponse.", reply_to_message_id=original_msg_id)
+    except Exception as ultra_final_e:
+         logger.critical(f"Impossible d'envoyer le message d'erreur final à {username}: {ultra_final_e}")
+
+# Durées du démarrage en secondes : "imports" et "ready"/"first_update" depuis STARTUP_STARTED,
+# "gemini_client" et "catalog" pour chaque branche du préchauffage.
+startup_timings: dict[str, float] = {}
+_warm_up_task: asyncio.Task | None = None
+
+async def warm_up() -> None:
+    """Création du client Gemini (import du SDK) et chargement + parsing du catalogue, en parallèle
+    l'un de l'autre et de la poignée de main Telegram (getMe, deleteWebhook/setWebhook)."""
+    async def timed(phase: str, awaitable):
+        started = time.perf_counter()
+        try: return await awaitable
+        finally: startup_timings[phase] = time.perf_counter() - started
+
+    model, (_, catalog_error) = await asyncio.gather(
+        timed("gemini_client", asyncio.to_thread(get_gemini_model)), timed("catalog", catalog_cache.get()))
+    if not model:
+        logger.critical("ERREUR CRITIQUE: Modèle Gemini non initialisé, seules les réponses tirées du catalogue seront servies.")
+    if catalog_error:
+        logger.warning(f"Catalogue non chargé au démarrage, nouvel essai à la première requête: {catalog_error}")
+
+def start_warm_up(loop: asyncio.AbstractEventLoop | None = None) -> asyncio.Task:
+    """Lance le préchauffage une seule fois ; à appeler avant `Application.initialize()`."""
+    global _warm_up_task
+    if _warm_up_task is None:
+        startup_timings["imports"] = time.perf_counter() - STARTUP_STARTED
+        _warm_up_task = (loop or asyncio.get_running_loop()).create_task(warm_up())
+    return _warm_up_task
+
+async def on_startup(application: Application) -> None:
+    await start_warm_up()
+    catalog_cache.start_background_refresh()
+    history_store.start()
+    startup_timings["ready"] = time.perf_counter() - STARTUP_STARTED
+    logger.info(f"Démarrage en {startup_timings['ready']:.2f}s : imports {startup_timings['imports']:.2f}s, "
+                f"puis en parallèle de la poignée de main Telegram client Gemini {startup_timings['gemini_client']:.2f}s "
+                f"et catalogue {startup_timings['catalog']:.2f}s.")
+
+async def report_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Dernier groupe : la première mise à jour traitée mesure le démarrage de bout en bout."""
+    if "first_update" in startup_timings: return
+    startup_timings["first_update"] = time.perf_counter() - STARTUP_STARTED
+    logger.info(f"Première mise à jour traitée {startup_timings['first_update']:.2f}s après le lancement du processus.")
+
+async def on_shutdown(application: Application) -> None:
+    await telegram_sender.close()
+    await catalog_cache.stop_background_refresh()
+    await history_store.close()
+    response_cache.close()
+    await gemini_context_cache.close()
+    image_cache.close()
+    voice_cache.close()
+    await media_downloader.close()
+
+# Seuls les messages et le bouton d'aide sont traités : inutile de recevoir le reste.
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Superviseur des workers, dans l'ingress seulement (WORKERS > 0, voir WorkerSupervisor).
+worker_supervisor = None
+
+class BotStatsCollector:
+    """Expose à Prometheus, au moment de la collecte, les compteurs déjà tenus par les caches,
+    le scheduler Gemini, le catalogue et les historiques."""
+
+    def collect(self):
+        cache_requests = CounterMetricFamily("tengo_cache_requests", "Consultations des caches", labels=["cache", "result"])
+        for result, key in (("hit", "hits"), ("disk_hit", "disk_hits"), ("miss", "misses")):
+            cache_requests.add_metric(["response", result], response_cache.stats[key])
+        for result, key in (("hit", "file_id_hits"), ("hash_hit", "hash_hits"), ("miss", "misses")):
+            cache_requests.add_metric(["image", result], image_cache.stats[key])
+        cache_requests.add_metric(["voice", "hit"], voice_cache.hits)
+        cache_requests.add_metric(["voice", "miss"], voice_cache.misses)
+        yield cache_requests
+        hit_ratio = GaugeMetricFamily("tengo_cache_hit_ratio", "Taux de succès des caches", labels=["cache"])
+        for name, cache in (("response", response_cache), ("image", image_cache), ("voice", voice_cache)):
+            hit_ratio.add_metric([name], cache.hit_rate())
+        yield hit_ratio
+        queue_depth = GaugeMetricFamily("tengo_gemini_queue_depth", "Requêtes en attente d'un créneau Gemini", labels=["kind"])
+        for kind, depth in gemini_scheduler.queue_depths().items(): queue_depth.add_metric([kind], depth)
+        yield queue_depth
+        yield GaugeMetricFamily("tengo_gemini_in_flight", "Appels Gemini en cours", value=gemini_scheduler.in_flight)
+        yield GaugeMetricFamily("tengo_gemini_concurrency_limit", "Limite de concurrence Gemini (AIMD)", value=gemini_scheduler.limit)
+        scheduler_events = CounterMetricFamily("tengo_gemini_scheduler_events", "Événements du contrôle d'admission", labels=["event"])
+        for event, count in gemini_scheduler.stats.items(): scheduler_events.add_metric([event], count)
+        yield scheduler_events
+        catalog_events = CounterMetricFamily("tengo_catalog_events", "Chargements du catalogue", labels=["event"])
+        for event in ("cold_fetch_count", "warm_fetch_count", "not_modified", "fetch_failures", "stale_served",
+                      "embeddings_computed", "embeddings_reused", "embedding_failures"):
+            catalog_events.add_metric([event], catalog_cache.metrics[event])
+        yield catalog_events
+        snapshot = catalog_cache.snapshot
+        yield GaugeMetricFamily("tengo_catalog_entries", "Entrées du catalogue chargé", value=len(snapshot.index) if snapshot and snapshot.index else 0)
+        yield GaugeMetricFamily("tengo_history_cached_chats", "Historiques gardés en mémoire", value=len(history_store))
+        history_events = CounterMetricFamily("tengo_history_events", "Événements du stockage des historiques", labels=["event"])
+        for event, count in history_store.stats.items(): history_events.add_metric([event], count)
+        yield history_events
+        outbound = CounterMetricFamily("tengo_telegram_outbound", "Appels sortants vers Telegram", labels=["event"])
+        for event, count in telegram_sender.stats.items(): outbound.add_metric([event], count)
+        yield outbound
+        yield GaugeMetricFamily("tengo_telegram_outbound_pending", "Envois et éditions en attente", value=telegram_sender.pending())
+        startup = GaugeMetricFamily("tengo_startup_seconds", "Durées du démarrage", labels=["phase"])
+        for phase, seconds in startup_timings.items(): startup.add_metric([phase], seconds)
+        yield startup
+        if worker_supervisor:
+            yield GaugeMetricFamily("tengo_workers_alive", "Workers en vie (ingress)", value=WORKERS - len(worker_supervisor.dead()))
+            yield CounterMetricFamily("tengo_worker_restarts", "Workers relancés après un arrêt (ingress)", value=worker_supervisor.restarts)
+
+REGISTRY.register(BotStatsCollector())
+
+async def begin_update_trace(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Groupe -1 : ouvre la trace de la mise à jour avant les handlers, qui s'exécutent dans la même tâche."""
+    start_trace(f"u{update.update_id}")
+
+def build_application(updater: bool = True) -> Application:
+    builder = (Application.builder().token(TELEGRAM_BOT_TOKEN)
+               .connect_timeout(30).read_timeout(40).write_timeout(40).pool_timeout(30)
+               .concurrent_updates(TELEGRAM_CONCURRENT_UPDATES)
+               .post_init(on_startup)
+               .post_shutdown(on_shutdown))
+    if not updater: builder = builder.updater(None)
+    application = builder.build()
+
+    application.add_handler(TypeHandler(Update, begin_update_trace), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command_handler))
+    application.add_handler(MessageHandler(filters.VOICE & ~filters.COMMAND, handle_voice))
+    application.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND, handle_photo))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.UpdateType.EDITED_MESSAGE, handle_text_message))
+    application.add_handler(CallbackQueryHandler(help_callback_handler, pattern="^help_callback$"))
+    application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
+    application.add_handler(TypeHandler(Update, report_first_update), group=1)
+    return application
+
+def create_webhook_app(application: Application, secret: str, path: str = WEBHOOK_PATH):
+    """Serveur aiohttp du mode webhook : `POST path` reçoit les mises à jour (en-tête
+    X-Telegram-Bot-Api-Secret-Token vérifié) et les place dans la file de l'application ;
+    `GET /healthz` renvoie l'état du bot et `GET /metrics` les métriques Prometheus."""
+    from aiohttp import web
+
+    async def receive_update(request: web.Request) -> web.Response:
+        # En octets : compare_digest refuse les chaînes non ASCII (TypeError, donc une 500 au lieu d'une 403),
+        # et aiohttp garde les octets non UTF-8 d'un en-tête sous forme de surrogates.
+        received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode("utf-8", "surrogateescape")
+        if not hmac.compare_digest(received, secret.encode()):
+            logger.warning(f"Webhook: requête refusée (secret invalide) depuis {request.remote}")
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception as e:
+            logger.warning(f"Webhook: mise à jour illisible: {e}")
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        snapshot = catalog_cache.snapshot
+        # L'ingress d'un déploiement à workers ne charge pas le catalogue : il est sain si tous ses workers tournent.
+        dead_workers = worker_supervisor.dead() if worker_supervisor else []
+        healthy = application.running and not dead_workers and (snapshot is not None or WORKERS > 0)
+        return web.json_response({
+            "status": "ok" if healthy else "degraded",
+            "catalog_version": snapshot.version if snapshot else None,
+            "dead_workers": dead_workers,
+            "update_queue": application.update_queue.qsize(),
+            "gemini": gemini_scheduler.stats,
+        }, status=200 if healthy else 503)
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(body=generate_latest(REGISTRY), content_type="text/plain", charset="utf-8")
+
+    web_app = web.Application()
+    web_app.router.add_post(path, receive_update)
+    web_app.router.add_get("/healthz", health)
+    web_app.router.add_get("/metrics", metrics)
+    return web_app
+
+def stop_event() -> asyncio.Event:
+    """Événement déclenché par SIGINT/SIGTERM, pour les boucles qui ne passent pas par run_polling."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError): loop.add_signal_handler(sig, stop.set)
+    return stop
+
+async def run_webhook(application: Application):
+    """Mode webhook. Sans WEBHOOK_URL, le webhook n'est pas déclaré à Telegram : le serveur peut alors
+    être testé en local en lui envoyant des mises à jour enregistrées."""
+    from aiohttp import web
+
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    runner = web.AppRunner(create_webhook_app(application, secret))
+    await runner.setup()
+    stop = stop_event()
+    if application.post_init: start_warm_up()
+    async with application:
+        if application.post_init: await application.post_init(application)
+        await application.start()
+        try:
+            await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+            if WEBHOOK_URL:
+                await application.bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=secret,
+                                                  allowed_updates=ALLOWED_UPDATES, drop_pending_updates=False)
+                logger.info(f"Webhook déclaré: {WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH}")
+            else:
+                logger.warning(f"WEBHOOK_URL absent : webhook non déclaré à Telegram (test local, secret: {secret}).")
+            logger.info(f"{BOT_NAME} écoute les webhooks sur {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}...")
+            await stop.wait()
+        finally:
+            await runner.cleanup()
+            await application.stop()
+            if application.post_shutdown: await application.post_shutdown(application)
+
+class SQLiteUpdateQueue:
+    """File d'entrée partagée entre l'ingress et les workers (WORKERS > 0).
+
+    Chaque mise à jour est rangée dans la partition `chat_id % partitions` et chaque worker ne lit que
+    la sienne : tous les messages d'un chat passent par le même worker, dans l'ordre d'arrivée.
+    Livraison au moins une fois : `take` réserve les lignes (pid et heure du worker), `ack` ne les
+    supprime qu'une fois traitées, et `release_claims` rend au redémarrage celles d'un worker tué."""
+
+    def __init__(self, db_path: str, partitions: int):
+        self.db_path = db_path
+        self.partitions = max(1, partitions)
+        self._db: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS updates (id INTEGER PRIMARY KEY, partition INTEGER NOT NULL, payload TEXT NOT NULL, "
+                             "claimed_by INTEGER, claimed_at REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS updates_partition ON updates (partition, id)")
+            self._db.commit()
+        return self._db
+
+    @staticmethod
+    def chat_id_of(payload: dict) -> int:
+        callback_query = payload.get("callback_query") or {}
+        message = payload.get("message") or payload.get("edited_message") or callback_query.get("message") or {}
+        chat_id = (message.get("chat") or {}).get("id")
+        if chat_id is None: chat_id = (callback_query.get("from") or {}).get("id", 0)
+        return chat_id
+
+    def put_many(self, payloads: list[dict]):
+        rows = [(self.chat_id_of(payload) % self.partitions, json.dumps(payload, separators=(",", ":")))
+                for payload in payloads]
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.executemany("INSERT INTO updates (partition, payload) VALUES (?, ?)", rows)
+
+    def put(self, payload: dict):
+        self.put_many([payload])
+
+    def take(self, partition: int, limit: int = 100) -> list[tuple[int, dict]]:
+        """Réserve et renvoie (id, mise à jour) pour les plus anciennes mises à jour libres de la partition
+        (un seul lecteur par partition). Elles restent dans la file jusqu'à `ack`."""
+        with self._lock:
+            db = self._connect()
+            with db:
+                rows = db.execute("SELECT id, payload FROM updates WHERE partition = ? AND claimed_by IS NULL ORDER BY id LIMIT ?",
+                                  (partition, limit)).fetchall()
+                if rows:
+                    db.execute("UPDATE updates SET claimed_by = ?, claimed_at = ? WHERE partition = ? AND claimed_by IS NULL AND id <= ?",
+                               (os.getpid(), time.time(), partition, rows[-1][0]))
+        return [(row_id, json.loads(payload)) for row_id, payload in rows]
+
+    def ack(self, ids: list[int]):
+        """Supprime les mises à jour traitées."""
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.executemany("DELETE FROM updates WHERE id = ?", [(row_id,) for row_id in ids])
+
+    def release_claims(self, partition: int) -> int:
+        """Rend à la file les mises à jour réservées mais jamais confirmées (worker tué en cours de traitement)."""
+        with self._lock:
+            db = self._connect()
+            with db:
+                return db.execute("UPDATE updates SET claimed_by = NULL, claimed_at = NULL WHERE partition = ? AND claimed_by IS NOT NULL",
+                                  (partition,)).rowcount
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM updates").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+async def consume_updates(update_queue: SQLiteUpdateQueue, partition: int, dispatch, stop: asyncio.Event, batch_size: int = 100):
+    """Boucle d'un worker : lance `dispatch` sur les mises à jour de sa partition, dans l'ordre, au plus
+    `batch_size` à la fois, et ne les retire de la file qu'une fois `dispatch` terminé. À l'arrêt, les
+    traitements en cours sont attendus ; un worker tué laisse les siens à son remplaçant."""
+    released = await asyncio.to_thread(update_queue.release_claims, partition)
+    if released: logger.warning(f"Worker {partition}: {released} mises à jour non confirmées reprises.")
+    running: set[asyncio.Task] = set()
+    processed: list[int] = []
+
+    async def process(row_id: int, payload: dict):
+        try:
+            await dispatch(payload)
+        except Exception as e:
+            logger.error(f"Worker {partition}: erreur traitement mise à jour {payload.get('update_id')}: {e}", exc_info=True)
+        finally:
+            processed.append(row_id)
+
+    async def ack():
+        if not processed: return
+        ids = processed.copy()
+        processed.clear()
+        try:
+            await asyncio.to_thread(update_queue.ack, ids)
+        except sqlite3.Error as e:
+            logger.error(f"Worker {partition}: confirmation dans la file impossible: {e}")
+            processed.extend(ids)
 
-async def send_fallback_response(context: ContextTypes.DEFAULT_TYPE, chat_id: int, processing_message, original_msg_id: int, fallback_text: str, error_indicator: str, username: str):
-    logger.warning(f"Tentative d'envoi de réponse fallback à {username} (Chat ID: {chat_id}).")
-    full_fallback_text = fallback_text
+    stopped = asyncio.create_task(stop.wait())
     try:
-        if processing_message:
-            await context.bot.edit_message_text(
-                chat_id=chat_id, message_id=processing_message.message_id, text=full_fallback_text,
-                parse_mode=None, disable_web_page_preview=True )
-        else:
-            await context.bot.send_message(
-                chat_id=chat_id, text=full_fallback_text, reply_to_message_id=original_msg_id,
-                parse_mode=None, disable_web_page_preview=True )
-        logger.info(f"Réponse fallback envoyée avec succès à {username}")
-    except Exception as final_e:
-        logger.error(f"ÉCHEC CRITIQUE : Impossible d'envoyer MÊME la réponse fallback à {username}: {final_e}", exc_info=True)
+        while not stop.is_set():
+            await ack()
+            rows = []
+            if len(running) < batch_size:
+                try:
+                    rows = await asyncio.to_thread(update_queue.take, partition, batch_size - len(running))
+                except sqlite3.Error as e:
+                    logger.error(f"Worker {partition}: lecture de la file impossible: {e}")
+            for row_id, payload in rows:
+                task = asyncio.create_task(process(row_id, payload))
+                running.add(task)
+                task.add_done_callback(running.discard)
+            if not rows:
+                await asyncio.wait({stopped, *running}, timeout=WORKER_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+        if running: await asyncio.gather(*running)
+        await ack()
+    finally:
+        stopped.cancel()
+
+def build_ingress_application(update_queue: SQLiteUpdateQueue, updater: bool = True) -> Application:
+    """Application de l'ingress : ne traite rien, range chaque mise à jour dans la file partagée.
+    Sans concurrent_updates, l'ordre d'arrivée est conservé."""
+    builder = (Application.builder().token(TELEGRAM_BOT_TOKEN)
+               .connect_timeout(30).read_timeout(40).write_timeout(40).pool_timeout(30))
+    if not updater: builder = builder.updater(None)
+    application = builder.build()
+
+    async def enqueue(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await asyncio.to_thread(update_queue.put, update.to_dict())
+
+    application.add_handler(TypeHandler(Update, enqueue))
+    return application
+
+async def run_worker(partition: int, partitions: int):
+    update_queue = SQLiteUpdateQueue(UPDATE_QUEUE_DB, partitions)
+    application = build_application(updater=False)
+    stop = stop_event()
+
+    async def dispatch(payload: dict):
+        update = Update.de_json(payload, application.bot)
+        await application.update_processor.process_update(update, application.process_update(update))
+
+    if METRICS_PORT: start_http_server(METRICS_PORT + 1 + partition)
+    catalog_cache.build_embeddings = False  # calculés par l'ingress, seulement relus ici
+    start_warm_up()
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        logger.info(f"Worker {partition + 1}/{partitions} démarré (pid {os.getpid()}).")
         try:
-            if not processing_message:
-                 await context.bot.send_message(chat_id=chat_id, text="Désolé, une erreur est survenue lors de l'affichage de ma réponse.", reply_to_message_id=original_msg_id)
-        except Exception as ultra_final_e:
-             logger.critical(f"Impossible d'envoyer le message d'erreur final à {username}: {ultra_final_e}")
+            await consume_updates(update_queue, partition, dispatch, stop)
+        finally:
+            await application.stop()
+            await application.post_shutdown(application)
+            update_queue.close()
+
+def worker_process(partition: int, partitions: int):
+    asyncio.run(run_worker(partition, partitions))
+
+async def maintain_catalog_embeddings(stop: threading.Event):
+    """Ingress avec workers : seul processus à calculer les plongements, à chaque nouvelle version du catalogue."""
+    await catalog_cache.refresh()
+    catalog_cache.start_background_refresh()
+    try:
+        await asyncio.to_thread(stop.wait)
+    finally:
+        await catalog_cache.stop_background_refresh()
+
+class WorkerSupervisor:
+    """Lance les processus workers et relance ceux qui s'arrêtent : sans worker, les mises à jour de sa
+    partition s'accumulent dans la file et ses chats restent sans réponse. Un worker qui retombe peu
+    après sa relance attend de plus en plus longtemps (1 s, 2 s, 4 s... jusqu'à WORKER_RESTART_BACKOFF_MAX)."""
+
+    def __init__(self, count: int, target=worker_process, check_interval: float = WORKER_CHECK_INTERVAL):
+        self.count = count
+        self.target = target
+        self.check_interval = check_interval
+        self._context = multiprocessing.get_context("spawn")
+        self.processes: dict[int, multiprocessing.Process] = {}
+        self._started_at: dict[int, float] = {}
+        self._failures: dict[int, int] = {}
+        self._restart_at: dict[int, float] = {}
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.restarts = 0
+
+    def _spawn(self, partition: int):
+        process = self._context.Process(target=self.target, args=(partition, self.count), name=f"tengo-worker-{partition}")
+        process.start()
+        self.processes[partition] = process
+        self._started_at[partition] = time.monotonic()
+
+    def start(self):
+        for partition in range(self.count): self._spawn(partition)
+        self._thread = threading.Thread(target=self._watch, name="tengo-worker-supervisor", daemon=True)
+        self._thread.start()
+
+    def dead(self) -> list[int]:
+        return [partition for partition, process in self.processes.items() if not process.is_alive()]
+
+    def check(self):
+        now = time.monotonic()
+        for partition in self.dead():
+            if partition not in self._restart_at:
+                lived = now - self._started_at[partition]
+                failures = 1 if lived > WORKER_RESTART_BACKOFF_MAX else self._failures.get(partition, 0) + 1
+                self._failures[partition] = failures
+                delay = min(WORKER_RESTART_BACKOFF_MAX, 2.0 ** (failures - 1))
+                self._restart_at[partition] = now + delay
+                logger.error(f"Worker {partition + 1}/{self.count} arrêté (code {self.processes[partition].exitcode}) après {lived:.0f}s, "
+                             f"relance dans {delay:.0f}s : ses chats sont en attente.")
+            if now >= self._restart_at[partition]:
+                del self._restart_at[partition]
+                self._spawn(partition)
+                self.restarts += 1
+                logger.warning(f"Worker {partition + 1}/{self.count} relancé (pid {self.processes[partition].pid}).")
+
+    def _watch(self):
+        while not self._stop.wait(self.check_interval):
+            try: self.check()
+            except Exception as e: logger.error(f"Supervision des workers en échec: {e}", exc_info=True)
+
+    def stop(self, timeout: float = 30):
+        self._stop.set()
+        if self._thread: self._thread.join()
+        for process in self.processes.values():
+            if process.is_alive(): process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=timeout)
 
 def main() -> None:
     if not TELEGRAM_BOT_TOKEN: logger.critical("ERREUR CRITIQUE: TELEGRAM_BOT_TOKEN manquant."); return
@@ -592,36 +3747,66 @@ def main() -> None:
              except Exception: pass
          return
 
-    if not gemini_model: logger.critical("ERREUR CRITIQUE: Modèle Gemini non initialisé."); return
-
     logger.info(f"Démarrage de {BOT_NAME}...")
     if is_url:
         logger.info(f"Utilisation du fichier Markdown depuis URL: {MARKDOWN_EXPORT_PATH}")
     else:
         logger.info(f"Utilisation du fichier Markdown local: {os.path.abspath(MARKDOWN_EXPORT_PATH)}")
-    logger.info(f"Modèle Gemini utilisé: {gemini_model.model_name}")
 
+    global worker_supervisor
+    embeddings_thread = embeddings_stop = None
     try:
-        application = (Application.builder().token(TELEGRAM_BOT_TOKEN)
-                       .connect_timeout(30).read_timeout(40).write_timeout(40).pool_timeout(30)
-                       .concurrent_updates(10)
-                       .build())
-
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command_handler))
-        application.add_handler(MessageHandler(filters.VOICE & ~filters.COMMAND, handle_voice))
-        application.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND, handle_photo))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.UpdateType.EDITED_MESSAGE, handle_text_message))
-        application.add_handler(CallbackQueryHandler(help_callback_handler, pattern="^help_callback$"))
-        application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
-
-        logger.info(f"{BOT_NAME} est prêt et écoute les mises à jour Telegram...")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if WORKERS > 0:
+            # Les workers partagent historiques et caches via SQLite (HISTORY_DB, RESPONSE_CACHE_DB, VOICE_CACHE_DB, IMAGE_CACHE_DB).
+            if not HISTORY_DB:
+                logger.critical("ERREUR CRITIQUE: HISTORY_DB est requis avec WORKERS (historiques partagés entre workers).")
+                return
+            if embedding_provider:
+                embeddings_stop = threading.Event()
+                embeddings_thread = threading.Thread(target=asyncio.run, args=(maintain_catalog_embeddings(embeddings_stop),),
+                                                     name="tengo-embeddings", daemon=True)
+                embeddings_thread.start()
+            worker_supervisor = WorkerSupervisor(WORKERS)
+            worker_supervisor.start()
+            update_queue = SQLiteUpdateQueue(UPDATE_QUEUE_DB, WORKERS)
+            logger.info(f"{BOT_NAME} : ingress démarré, {WORKERS} workers, file partagée {UPDATE_QUEUE_DB}, "
+                        f"caches partagés {RESPONSE_CACHE_DB} et {VOICE_CACHE_DB}.")
+            if TELEGRAM_MODE == "webhook":
+                asyncio.run(run_webhook(build_ingress_application(update_queue, updater=False)))
+            else:
+                if METRICS_PORT: start_http_server(METRICS_PORT)
+                build_ingress_application(update_queue).run_polling(allowed_updates=ALLOWED_UPDATES)
+            update_queue.close()
+        elif TELEGRAM_MODE == "webhook":
+            asyncio.run(run_webhook(build_application(updater=False)))
+        else:
+            application = build_application()
+            if METRICS_PORT: start_http_server(METRICS_PORT)
+            # run_polling reprend la boucle courante : le préchauffage y tourne pendant getMe/deleteWebhook.
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            start_warm_up(loop)
+            logger.info(f"{BOT_NAME} est prêt et écoute les mises à jour Telegram...")
+            application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
     except Exception as e:
         logger.critical(f"Erreur critique lors de l'initialisation ou de l'exécution du bot: {e}", exc_info=True)
     finally:
+        if worker_supervisor: worker_supervisor.stop()
+        if embeddings_thread:
+            embeddings_stop.set()
+            embeddings_thread.join(timeout=30)
         logger.info(f"Arrêt de {BOT_NAME}... Script terminé.")
 
+async def build_catalog_embeddings():
+    """`python tengo.py embeddings` : calcule ou met à jour les plongements du catalogue hors ligne."""
+    if not embedding_provider: logger.critical("EMBEDDING_PROVIDER vide : aucun plongement à calculer."); return
+    try:
+        await catalog_cache.refresh()
+        await catalog_cache.wait_for_embeddings()
+    finally:
+        await catalog_cache.stop_background_refresh()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if sys.argv[1:] == ["embeddings"]: asyncio.run(build_catalog_embeddings())
+    else: main()
\ No newline at end of file